@@ -3,8 +3,3 @@
 # license that can be found in the LICENSE file.
 
 from . import core
-from . import commands
-from . import occam
-from . import chisel
-from . import piecewise
-from . import razor
@@ -0,0 +1,261 @@
+# Copyright (c) 2022 SRI International All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import abc
+import logging
+import re
+import threading
+from typing import List, Dict, Any, Iterable, Iterator, Tuple, Union
+
+from .core import Volume, ProDeBenchError
+
+# Enough connections for parallel builds streaming their output at the same time
+MAX_POOL_SIZE = 64
+
+
+class ExecStream:
+
+    def __init__(self, chunks: Iterable[Tuple[str, bytes]], exit_code) -> None:
+        super().__init__()
+        self._chunks = chunks
+        self._exit_code = exit_code
+
+    def __iter__(self) -> Iterator[Tuple[str, bytes]]:
+        return iter(self._chunks)
+
+    @property
+    def exit_code(self) -> int:
+        # Only available after the output has been consumed
+        return self._exit_code()
+
+
+class Backend(abc.ABC):
+
+    @abc.abstractmethod
+    def run(self, image: str, name: str, volumes: List[Volume], **options) -> str:
+        pass
+
+    @abc.abstractmethod
+    def stop(self, name: str):
+        pass
+
+    @abc.abstractmethod
+    def remove(self, name: str):
+        pass
+
+    @abc.abstractmethod
+    def containers(self, all: bool = False, filters: Dict[str, Any] = None) -> List[Any]:
+        pass
+
+    @abc.abstractmethod
+    def images(self, name: str) -> List[Any]:
+        pass
+
+    @abc.abstractmethod
+    def remove_image(self, name: str):
+        pass
+
+    @abc.abstractmethod
+    def image_id(self, name: str) -> str:
+        pass
+
+    @abc.abstractmethod
+    def load_image(self, data: Union[bytes, Iterable[bytes]], loaded: List[str] = None) -> List[str]:
+        pass
+
+    @abc.abstractmethod
+    def save_images(self, names: List[str]) -> Iterator[bytes]:
+        pass
+
+    @abc.abstractmethod
+    def container_id(self, name: str) -> str:
+        pass
+
+    @abc.abstractmethod
+    def stats(self, name: str) -> Iterator[Dict[str, Any]]:
+        pass
+
+    @abc.abstractmethod
+    def diff(self, name: str) -> List[Tuple[str, int]]:
+        pass
+
+    @abc.abstractmethod
+    def exec_stream(self, name: str, cmd: List[str], environment: Dict[str, str] = None,
+                    workdir: str = None) -> ExecStream:
+        pass
+
+    @abc.abstractmethod
+    def put_archive(self, name: str, path: str, data: Union[bytes, Iterable[bytes]]):
+        pass
+
+    @abc.abstractmethod
+    def get_archive(self, name: str, path: str) -> Iterator[bytes]:
+        pass
+
+    def exec_check(self, name: str, cmd: List[str], **kwargs) -> Iterator[Tuple[str, bytes]]:
+        stream = self.exec_stream(name, cmd, **kwargs)
+        yield from stream
+
+        if stream.exit_code != 0:
+            raise ProDeBenchError(f"Failed to execute command {' '.join(cmd)} in {name}", stream.exit_code)
+
+
+class DockerApiBackend(Backend):
+
+    def __init__(self) -> None:
+        super().__init__()
+        import docker
+
+        self.errors = docker.errors
+        self.client = docker.from_env(max_pool_size=MAX_POOL_SIZE)
+
+        # Commands can print nothing for longer than the default read timeout, e.g., long links or reductions,
+        # so their output is read from a client without timeout
+        self.stream_client = docker.from_env(max_pool_size=MAX_POOL_SIZE, timeout=None,
+                                             version=self.client.api.api_version)
+
+    def run(self, image: str, name: str, volumes: List[Volume], **options) -> str:
+        try:
+            self.client.images.get(image)
+        except self.errors.ImageNotFound:
+            logging.info(f"Pulling image {image}")
+            self.client.images.pull(image)
+
+        binds = {v.host_dir: {'bind': v.container_dir, 'mode': 'rw'} for v in volumes}
+
+        try:
+            container = self.client.containers.run(image, name=name, volumes=binds, tty=True, detach=True, **options)
+        except self.errors.APIError as e:
+            raise ProDeBenchError(f"Failed to start container {name}: {e.explanation}")
+
+        return container.id
+
+    def stop(self, name: str):
+        try:
+            self.client.api.stop(name)
+        except self.errors.APIError as e:
+            raise ProDeBenchError(f"Failed to stop container {name}: {e.explanation}")
+
+    def remove(self, name: str):
+        try:
+            self.client.api.remove_container(name)
+        except self.errors.APIError as e:
+            raise ProDeBenchError(f"Failed to remove container {name}: {e.explanation}")
+
+    def containers(self, all: bool = False, filters: Dict[str, Any] = None) -> List[Any]:
+        return self.client.containers.list(all=all, filters=filters)
+
+    def images(self, name: str) -> List[Any]:
+        return self.client.images.list(name)
+
+    def remove_image(self, name: str):
+        try:
+            self.client.api.remove_image(name, force=True)
+        except self.errors.APIError as e:
+            raise ProDeBenchError(f"Failed to remove image {name}: {e.explanation}")
+
+    def image_id(self, name: str) -> str:
+        return self.client.api.inspect_container(name)['Image']
+
+    def load_image(self, data: Union[bytes, Iterable[bytes]], loaded: List[str] = None) -> List[str]:
+        # Like `docker load`, a stream of chunks is sent as it is produced. The images are added to `loaded`
+        # as they are reported, so that the caller knows them even when the load fails
+        loaded = [] if loaded is None else loaded
+
+        try:
+            for status in self.client.api.load_image(data, quiet=True):
+                if 'error' in status:
+                    raise ProDeBenchError(f"Failed to load image: {status['error']}")
+
+                m = re.match(r'^Loaded image(?: ID)?: (.+)$', status.get('stream', '').strip())
+                if m:
+                    loaded.append(m.group(1))
+        except self.errors.APIError as e:
+            raise ProDeBenchError(f"Failed to load image: {e.explanation}")
+
+        return loaded
+
+    def save_images(self, names: List[str]) -> Iterator[bytes]:
+        # Like `docker save` of several images, layers shared by the images are only saved once
+        # docker-py only saves one image at a time, its client is also a requests session of the Engine API.
+        # Large images take a while before the first bytes, they are read without timeout like the exec output
+        import requests
+
+        api = self.stream_client.api
+        url = f"{api.base_url}/v{api.api_version}/images/get"
+
+        try:
+            response = api.get(url, params={'names': names}, stream=True, timeout=api.timeout)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            raise ProDeBenchError(f"Failed to save images {', '.join(names)}: {e}")
+
+        def chunks():
+            with response:
+                yield from response.iter_content(1 << 20)
+
+        return chunks()
+
+    def container_id(self, name: str) -> str:
+        return self.client.api.inspect_container(name)['Id']
+
+    def stats(self, name: str) -> Iterator[Dict[str, Any]]:
+        return self.client.api.stats(name, decode=True, stream=True)
+
+    def diff(self, name: str) -> List[Tuple[str, int]]:
+        # Changed paths of the container filesystem, kind is 0 for modified, 1 for added and 2 for deleted
+        try:
+            changes = self.client.api.diff(name) or []
+        except self.errors.APIError as e:
+            raise ProDeBenchError(f"Failed to inspect changes of {name}: {e.explanation}")
+
+        return [(c['Path'], c['Kind']) for c in changes]
+
+    def exec_stream(self, name: str, cmd: List[str], environment: Dict[str, str] = None,
+                    workdir: str = None) -> ExecStream:
+        api = self.client.api
+
+        try:
+            exec_id = api.exec_create(name, cmd, environment=environment, workdir=workdir)['Id']
+            output = self.stream_client.api.exec_start(exec_id, stream=True, demux=True)
+        except self.errors.APIError as e:
+            raise ProDeBenchError(f"Failed to execute command in {name}: {e.explanation}")
+
+        def chunks():
+            for stdout, stderr in output:
+                if stdout:
+                    yield 'stdout', stdout
+                if stderr:
+                    yield 'stderr', stderr
+
+        return ExecStream(chunks(), lambda: api.exec_inspect(exec_id)['ExitCode'])
+
+    def put_archive(self, name: str, path: str, data: Union[bytes, Iterable[bytes]]):
+        try:
+            self.client.api.put_archive(name, path, data)
+        except self.errors.APIError as e:
+            raise ProDeBenchError(f"Failed to copy into {name}:{path}: {e.explanation}")
+
+    def get_archive(self, name: str, path: str) -> Iterator[bytes]:
+        try:
+            stream, _ = self.client.api.get_archive(name, path)
+        except self.errors.APIError as e:
+            raise ProDeBenchError(f"Failed to copy from {name}:{path}: {e.explanation}")
+
+        return stream
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend() -> Backend:
+    # One client shared by all the commands and threads, created on first use
+    global _backend
+
+    with _backend_lock:
+        if _backend is None:
+            _backend = DockerApiBackend()
+
+    return _backend
@@ -3,13 +3,104 @@
 # license that can be found in the LICENSE file.
 
 import csv
+import hashlib
 import logging
 import os
-import subprocess
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Iterable, Iterator, Callable, Set, Tuple
+
+import click
 
 from . import core
+from .backend import get_backend
+from .cache import CACHE_COLUMNS, build_environment, read_log
+from .container import ContainerWrapper
+from .logpump import LogPump, CONSOLE_MODES
+from .resources import ResourceSampler, RESOURCE_COLUMNS
+from .results import ResultStore, RESULTS_DB, print_stage_profile
+from .stats import repeat_options, print_summary, CV_THRESHOLD
+
+# Lines written by the build commands around each stage, with the time in the container in nanoseconds:
+# `##pdbench-stage begin <stage> <time>` and `##pdbench-stage end <stage> <return code> <time>`
+STAGE_MARKER = '##pdbench-stage'
+
+# Measurements reported by the build commands, saved with the results: `##pdbench-metric <name> <value>`
+METRIC_MARKER = '##pdbench-metric'
+
+
+def stage_command(name: str, cmd: str) -> str:
+    # Same return code as the command, a group instead of a sub shell keeps `cd` and variables for the next stages
+    return f'{{ echo "{STAGE_MARKER} begin {name} $(date +%s%N)"; {cmd}; pdbench_rc=$?;' \
+           f' echo "{STAGE_MARKER} end {name} $pdbench_rc $(date +%s%N)"; (exit $pdbench_rc); }}'
+
+
+class StageTimer:
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.stages: List[Dict[str, Any]] = []
+        self.metrics: Dict[str, float] = {}
+        self._started: Dict[str, int] = {}
+        self._partial = b''
+
+    def watch(self, chunks: Iterable[Tuple[str, bytes]]) -> Iterator[Tuple[str, bytes]]:
+        # Passes the output through, markers are searched in the complete lines of stdout
+        for stream, data in chunks:
+            if stream == 'stdout':
+                self._scan(data)
+
+            yield stream, data
+
+        # Stages without an end marker were interrupted
+        for name in self._started:
+            self.stages.append({'Stage': name, 'ReturnCode': None, 'DurationNs': None})
+
+        self._started = {}
+
+    def _scan(self, data: bytes):
+        buffer = self._partial + data
+        end = buffer.rfind(b'\n') + 1
+        self._partial = buffer[end:]
+
+        if b'##pdbench-' not in buffer[:end]:
+            return
+
+        for line in buffer[:end].decode(errors='replace').splitlines():
+            if line.startswith(STAGE_MARKER):
+                self._marker(line.split()[1:])
+
+            elif line.startswith(METRIC_MARKER):
+                self._metric(line.split()[1:])
+
+    def _marker(self, fields: List[str]):
+        try:
+            if fields[0] == 'begin':
+                self._started[fields[1]] = int(fields[2])
+
+            elif fields[0] == 'end' and fields[1] in self._started:
+                start = self._started.pop(fields[1])
+                self.stages.append({
+                    'Stage': fields[1],
+                    'ReturnCode': int(fields[2]),
+                    'DurationNs': int(fields[3]) - start,
+                })
+        except (IndexError, ValueError):
+            logging.debug(f"Ignoring malformed stage marker {' '.join(fields)}")
+
+    def _metric(self, fields: List[str]):
+        try:
+            value = float(fields[1])
+            self.metrics[fields[0]] = int(value) if value.is_integer() else value
+        except (IndexError, ValueError):
+            logging.debug(f"Ignoring malformed metric marker {' '.join(fields)}")
+
+    def failed_stage(self) -> str:
+        return next((s['Stage'] for s in self.stages if s['ReturnCode'] != 0), '')
 
 
 class ResultWriter:
@@ -18,12 +109,22 @@ class ResultWriter:
         self.framework = framework
         self.columns = columns
         self.results_file = core.project_relative_location(f'data/{framework}/{framework}-pdbench.csv')
-        self.results = []
+        self.result_ids = []
+        self._lock = threading.Lock()
 
-        logging.info(f'Saving results in {self.results_file}')
+        logging.info(f'Saving results in {self.results_file} and {RESULTS_DB}')
 
         exists = os.path.exists(self.results_file)
 
+        self.store = ResultStore()
+
+        if exists:
+            self._upgrade_columns()
+
+            # Results saved before the results database existed
+            if not self.store.has_results(framework):
+                self.store.import_csv(framework, self.results_file)
+
         mode = 'a' if exists else 'w'
 
         self._fp = open(self.results_file, mode, newline='')
@@ -32,31 +133,121 @@ class ResultWriter:
         if not exists:
             self.writer.writerow(self.columns)
 
+    def _upgrade_columns(self):
+        # Rewriting results saved with an older set of columns, new columns are left empty
+        with open(self.results_file, newline='') as f:
+            reader = csv.DictReader(f)
+            header = reader.fieldnames or []
+
+            if header == self.columns:
+                return
+
+            rows = list(reader)
+
+        self.columns = self.columns + [c for c in header if c not in self.columns]
+        logging.info(f"Updating columns of {self.results_file}")
+
+        with open(f"{self.results_file}.tmp", 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=self.columns, restval='', extrasaction='ignore',
+                                    quoting=csv.QUOTE_MINIMAL)
+            writer.writeheader()
+            writer.writerows(rows)
+
+        os.replace(f"{self.results_file}.tmp", self.results_file)
+
+    def previous_results(self, **filters) -> Iterable[Dict[str, Any]]:
+        return self.store.results(frameworks=[self.framework], **filters)
+
     def flush(self):
         if self._fp and not self._fp.closed:
             self._fp.flush()
 
     def close(self):
-        core.print_table(self.results, self.columns)
+        rows = [[r.get(c, '') for c in self.columns] for r in self.store.results(self.result_ids)]
+        core.print_table(rows, self.columns)
+
         if self._fp and not self._fp.closed:
             self._fp.close()
 
-    def add(self, result: Dict[str, Any]):
-        row = [result[c] for c in self.columns]
+        self.store.close()
+
+    def add(self, result: Dict[str, Any], stages: List[Dict[str, Any]] = None):
+        row = [result.get(c, '') for c in self.columns]
+
+        # Builds running in parallel report their results from worker threads
+        with self._lock:
+            result_id = self.store.add(self.framework, result)
+            self.result_ids.append(result_id)
+
+            if stages:
+                self.store.add_stages(result_id, stages)
+
+            self.writer.writerow(row)
+            self.flush()
+
+
+def build_options(f):
+    f = repeat_options(f)
+    f = click.option('--no-stats', is_flag=True, help='Do not sample CPU, memory, I/O and PIDs of the containers')(f)
+    f = click.option('--compress-logs', is_flag=True, help='Write gzip compressed build logs')(f)
+    f = click.option('--console', type=click.Choice(CONSOLE_MODES),
+                     help='Build output on the console, defaults to tee for one job and prefix for parallel jobs')(f)
+    f = click.option('--hash-contents', is_flag=True,
+                     help='Hash file contents of the examples for --incremental instead of sizes and mtimes')(f)
+    f = click.option('-i', '--incremental', is_flag=True,
+                     help='Skip examples unchanged since their last successful build')(f)
+    f = click.option('-j', '--jobs', default=1, show_default=True, type=click.IntRange(min=1),
+                     help='Number of examples to build in parallel')(f)
+    return f
+
 
-        self.results.append(row)
-        self.writer.writerow(row)
-        self.flush()
+def example_fingerprint(dir_path: str, cmd: str, image_id: str, hash_contents: bool = False) -> str:
+    h = hashlib.sha256()
+    h.update(f"{cmd}\0{image_id}\0{'contents' if hash_contents else 'stat'}\0".encode())
+
+    for folder, subs, files in os.walk(dir_path):
+        subs.sort()
+
+        for name in sorted(files):
+            path = os.path.join(folder, name)
+            st = os.lstat(path)
+            h.update(f"{os.path.relpath(path, dir_path)}\0{st.st_size}\0".encode())
+
+            if not hash_contents:
+                h.update(f"{st.st_mtime_ns}\0".encode())
+
+            elif os.path.isfile(path) and not os.path.islink(path):
+                with open(path, 'rb') as fp:
+                    for chunk in iter(lambda: fp.read(1 << 20), b''):
+                        h.update(chunk)
+
+    return h.hexdigest()
 
 
 class PdbBuilder:
-    def __init__(self, framework: str, container_name: str) -> None:
+    def __init__(self, framework: str, containers: List[ContainerWrapper], jobs: int = 1,
+                 incremental: bool = False, hash_contents: bool = False, console: str = None,
+                 compress_logs: bool = False, no_stats: bool = False, repeat: int = 1, warmup: int = 0,
+                 cv_threshold: float = CV_THRESHOLD, extra_columns: List[str] = None) -> None:
         super().__init__()
         self.framework = framework
-        self.container_name = container_name
+        self.containers = containers
+        self.jobs = jobs
+        self.incremental = incremental
+        self.hash_contents = hash_contents
+        self.console = console
+        self.compress_logs = compress_logs
+        self.stats = not no_stats
+        self.shared_containers = False
+        self.repeat = repeat
+        self.warmup = warmup
+        self.cv_threshold = cv_threshold
         self.results = ResultWriter(
-            framework, ['Project', 'ReturnCode', 'StartTime', 'Duration', 'LogPrefix']
+            framework,
+            ['Project', 'ReturnCode', 'StartTime', 'Duration', 'LogPrefix', 'Fingerprint', 'WallTimeNs'] +
+            RESOURCE_COLUMNS + ['Series', 'Trial', 'FailedStage'] + CACHE_COLUMNS + (extra_columns or [])
         )
+        self._image_ids = {}
 
     def __enter__(self):
         return self
@@ -65,63 +256,187 @@ class PdbBuilder:
         self.close()
 
     def close(self):
+        # Wall times of the successful trials of this session
+        durations = self.results.store.durations(['project'], ids=self.results.result_ids, status='success') \
+            if self.repeat > 1 else None
+
+        # Stages of the builds of this session
+        stages = self.results.store.stage_profile(['project'], ids=self.results.result_ids)
+
         self.results.close()
 
-    def build(self, project_name: str, cmd: str) -> int:
-        logging.info(f"Building project {project_name} in {self.container_name} container")
+        if stages:
+            print_stage_profile(stages, ['project'])
+
+        if durations:
+            print_summary(durations, ['project'], self.cv_threshold)
+
+    def fingerprint(self, project_name: str, cmd: str, container: ContainerWrapper) -> str:
+        if container.name not in self._image_ids:
+            self._image_ids[container.name] = container.image_id()
+
+        # Examples are in the first volume of the container
+        return example_fingerprint(
+            os.path.join(container.volumes[0].host_dir, project_name), cmd,
+            self._image_ids[container.name], self.hash_contents
+        )
+
+    def successful_fingerprints(self) -> Set[str]:
+        return {
+            r['Fingerprint'] for r in self.results.previous_results(status='success') if r.get('Fingerprint')
+        }
+
+    def build(self, project_name: str, cmd: str, container: ContainerWrapper = None, parallel: bool = False) -> int:
+        container = container or self.containers[0]
+
+        for i in range(1, self.warmup + 1):
+            logging.info(f"Warm-up build {i} of {self.warmup} of {project_name}")
+            return_code = self.build_trial(project_name, cmd, container, parallel, f'-w{i}', record=False)
+
+            if return_code != 0:
+                return return_code
+
+        if self.repeat == 1:
+            return self.build_trial(project_name, cmd, container, parallel)
+
+        # Trials of the same build share a series, a failed trial ends the series
+        series = uuid.uuid4().hex[:12]
+
+        for trial in range(1, self.repeat + 1):
+            logging.info(f"Trial {trial} of {self.repeat} of {project_name}")
+            return_code = self.build_trial(project_name, cmd, container, parallel, f'-t{trial}',
+                                           {'Series': series, 'Trial': trial})
+
+            if return_code != 0:
+                break
+
+        return return_code
+
+    def build_trial(self, project_name: str, cmd: str, container: ContainerWrapper, parallel: bool = False,
+                    suffix: str = '', trial: Dict[str, Any] = None, record: bool = True) -> int:
+        logging.info(f"Building project {project_name} in {container.name} container")
 
         core.make_dirs(core.project_relative_location(f"logs/{self.framework}"))
 
-        docker_cmd = [
-            'docker', 'exec',
-            '--interactive', self.container_name,
-            'bash', '-c', cmd
-        ]
+        exec_cmd = ['bash', '-c', cmd]
 
         e = project_name.replace('/', '_')
 
         start_time = datetime.now()
-        d = start_time.strftime('%Y-%m-%d_%H-%M')
+        d = start_time.strftime('%Y-%m-%d_%H-%M') + suffix
 
-        docker_process = subprocess.Popen(
-            docker_cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
+        console = self.console or ('prefix' if parallel else 'tee')
+        log_prefix = core.project_relative_location(f"logs/{self.framework}/{e}-{d}")
+        sampler = ResourceSampler(container.name)
+        timer = StageTimer()
+        environment, cache_log = build_environment()
 
-        stdout_process = subprocess.Popen(
-            ["tee", core.project_relative_location(f"logs/{self.framework}/{e}-{d}.stdout")],
-            stdin=docker_process.stdout
-        )
+        # Resource usage is read for the whole container, it is left blank when builds share one
+        sample = self.stats and not self.shared_containers
 
-        stderr_process = subprocess.Popen(
-            ["tee", core.project_relative_location(f"logs/{self.framework}/{e}-{d}.stderr")],
-            stdin=docker_process.stderr
-        )
+        if sample:
+            sampler.start()
 
-        docker_process.stdout.close()
-        docker_process.stderr.close()
+        try:
+            start_ns = time.monotonic_ns()
+            stream = get_backend().exec_stream(container.name, exec_cmd, environment)
 
-        stdout_process.communicate()
-        stderr_process.communicate()
+            with LogPump(log_prefix, console, project_name, self.compress_logs) as pump:
+                pump.pump(timer.watch(stream))
 
-        return_code = docker_process.wait()
-        end_time = datetime.now()
+            return_code = stream.exit_code
+            wall_time_ns = time.monotonic_ns() - start_ns
+            end_time = datetime.now()
+        finally:
+            if sample:
+                sampler.stop()
 
         if return_code != 0:
-            logging.error(f"Failed to execute command {core.command_list_to_str(docker_cmd)}")
+            logging.error(f"Failed to execute command {core.command_list_to_str(exec_cmd)} in {container.name}")
+
+        cache_stats = read_log(cache_log)
+        if cache_stats:
+            logging.info(f"Compiler cache of {project_name}: {cache_stats['CacheHits']} hits, "
+                         f"{cache_stats['CacheMisses']} misses, {cache_stats['CacheSkipped']} not cacheable")
+
+        # Warm-up builds are only recorded when they fail
+        if not record and return_code == 0:
+            return return_code
 
         delta = end_time - start_time
         duration = str(delta).split('.', 2)[0]  # Restricting resolution to second
 
+        # Fingerprint of the example including the build outputs, the next incremental build
+        # skips the example if nothing changed after this build. Only incremental builds walk the example
+        fingerprint = self.fingerprint(project_name, cmd, container) if self.incremental else None
+
         self.results.add(
             {
-                'Project': d,
+                'Project': project_name,
                 'ReturnCode': return_code,
                 'StartTime': start_time.strftime('%Y-%m-%d %H:%M:%S'),
                 'Duration': duration,
-                'LogPrefix': f"logs/{self.framework}/{e}-{d}"
-            }
+                'LogPrefix': f"logs/{self.framework}/{e}-{d}",
+                'Fingerprint': fingerprint,
+                'WallTimeNs': wall_time_ns,
+                **sampler.results(),
+                **(trial or {}),
+                'FailedStage': timer.failed_stage(),
+                **cache_stats,
+                **timer.metrics,
+            },
+            timer.stages
         )
 
         return return_code
+
+    def build_all(self, examples: Iterable[str], command: Callable[[str], str]) -> Dict[str, int]:
+        if self.incremental:
+            successful = self.successful_fingerprints()
+            examples = [e for e in examples if not self.unchanged(e, command(e), successful)]
+
+        # At least one build per replica container
+        jobs = max(self.jobs, len(self.containers))
+
+        if jobs <= 1:
+            return {e: self.build(e, command(e)) for e in examples}
+
+        logging.info(f"Building examples with {jobs} parallel jobs in {len(self.containers)} container(s)")
+
+        self.shared_containers = jobs > len(self.containers)
+        if self.stats and self.shared_containers:
+            logging.warning("Resource usage is not recorded, parallel builds share containers (start with --replicas)")
+
+        # Workers take the next example from a shared queue as soon as they are free,
+        # so slow examples do not hold back the other containers
+        pending = queue.Queue()
+        for e in examples:
+            pending.put(e)
+
+        return_codes = {}
+
+        def worker(container: ContainerWrapper):
+            while True:
+                try:
+                    e = pending.get_nowait()
+                except queue.Empty:
+                    return
+
+                return_codes[e] = self.build(e, command(e), container, True)
+
+        with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix=f'pdb-{self.framework}') as executor:
+            workers = [executor.submit(worker, self.containers[i % len(self.containers)]) for i in range(jobs)]
+
+        for w in workers:
+            w.result()
+
+        return return_codes
+
+    def unchanged(self, project_name: str, cmd: str, successful: Set[str]) -> bool:
+        # With replicas the last build could have happened in any of the example copies
+        for c in self.containers:
+            if self.fingerprint(project_name, cmd, c) in successful:
+                logging.info(f"Skipping {project_name}, unchanged since its last successful build in {c.name}")
+                return True
+
+        return False
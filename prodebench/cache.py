@@ -0,0 +1,223 @@
+# Copyright (c) 2022 SRI International All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import logging
+import os
+import shutil
+import uuid
+from typing import Dict, Any, Tuple
+
+from . import core
+
+CACHE_VOLUME = core.Volume(
+    core.project_relative_location('data/cache'),
+    '/pdbench/cache'
+)
+
+CACHE_COLUMNS = ['CacheHits', 'CacheMisses', 'CacheSkipped']
+
+# Compilers run through the cache when the bin directory of the volume is first in PATH
+COMPILERS = ['cc', 'c++', 'gcc', 'g++', 'clang', 'clang++']
+
+# Compiler wrapper, the cache key is the hash of the compiler, the working directory, the flags and
+# the preprocessed source. Object files and bitcode (-flto, -emit-llvm) are cached the same way
+WRAPPER = r'''#!/usr/bin/env bash
+# Usage: pdbench-cc <compiler> <args>, or through the links named after the compilers
+
+cache_dir="$(cd "$(dirname "${BASH_SOURCE[0]}")/.." && pwd)"
+bin_dir="${cache_dir}/bin"
+
+if [[ $(basename "$0") == pdbench-cc ]]; then
+    compiler="$1"
+    shift
+else
+    compiler="$(basename "$0")"
+fi
+
+# Real compiler, the first one in PATH outside of the cache
+if [[ $compiler != */* ]]; then
+    IFS=: read -ra dirs <<< "$PATH"
+    for d in "${dirs[@]}"; do
+        if [[ $d != "$bin_dir" && -x $d/$compiler ]]; then
+            real="$d/$compiler"
+            break
+        fi
+    done
+
+    if [[ -z $real ]]; then
+        echo "pdbench-cc: $compiler not found" >&2
+        exit 127
+    fi
+
+    compiler="$real"
+fi
+
+# Compilers called by a cached compiler, e.g., clang by musl-clang, are not cached again
+if [[ -n $PDBENCH_CC_ACTIVE ]]; then
+    exec "$compiler" "$@"
+fi
+export PDBENCH_CC_ACTIVE=1
+
+log() {
+    [[ -n $PDBENCH_CACHE_LOG ]] && echo "$1" >> "$PDBENCH_CACHE_LOG"
+}
+
+# Only the compilation of a single C/C++ source to an output file is cached
+mode=""
+output=""
+sources=0
+cacheable=1
+deps=0
+dep_file=0
+dep_target=0
+pre=()
+args=("$@")
+
+for ((i = 0; i < ${#args[@]}; i++)); do
+    a="${args[i]}"
+
+    case "$a" in
+        -c|-S) mode="$a"; continue ;;
+        -o) output="${args[i + 1]}"; i=$((i + 1)); continue ;;
+        -o*) output="${a#-o}"; continue ;;
+        -MF|-MT|-MQ) [[ $a == -MF ]] && dep_file=1 || dep_target=1
+                     pre+=("$a" "${args[i + 1]}"); i=$((i + 1)); continue ;;
+        -MD|-MMD) deps=1 ;;
+        -E|-M|-MM|-|-save-temps*|-x|-v|-###|--version) cacheable=0 ;;
+        *.c|*.cc|*.cpp|*.cxx|*.C|*.m|*.i|*.ii) [[ $a != -* ]] && sources=$((sources + 1)) ;;
+    esac
+
+    pre+=("$a")
+done
+
+if [[ -z $mode ]]; then
+    exec "$compiler" "$@"
+fi
+
+# Dependency files are written by the preprocessor, they only have the same target with -MT or -MQ
+if [[ $deps == 1 && ($dep_file == 0 || $dep_target == 0) ]]; then
+    cacheable=0
+fi
+
+if [[ $cacheable == 0 || $sources != 1 || -z $output || $output == - ]]; then
+    log skipped
+    exec "$compiler" "$@"
+fi
+
+key=$(
+    set -o pipefail
+    {
+        echo "$compiler $mode $PWD"
+        stat -L -c '%s %Y' "$compiler"
+        printf '%s\n' "${pre[@]}"
+        "$compiler" "${pre[@]}" -E 2> /dev/null
+    } | sha256sum
+) || { log skipped; exec "$compiler" "$@"; }
+
+entry="${cache_dir}/objects/${key:0:2}/${key:0:64}"
+
+if [[ -f $entry.out ]] && cp "$entry.out" "$output"; then
+    [[ -f $entry.err ]] && cat "$entry.err" >&2
+    log hit
+    exit 0
+fi
+
+err="$(mktemp)"
+"$compiler" "$@" 2> "$err"
+rc=$?
+cat "$err" >&2
+
+# Entries are renamed into place, concurrent builds never see a partial one
+if [[ $rc == 0 && -f $output ]] && mkdir -p "$(dirname "$entry")"; then
+    cp "$err" "$entry.err.$$" && mv -f "$entry.err.$$" "$entry.err"
+    cp "$output" "$entry.out.$$" && mv -f "$entry.out.$$" "$entry.out"
+fi
+
+rm -f "$err"
+log miss
+exit $rc
+'''
+
+
+def install(host_dir: str = CACHE_VOLUME.host_dir):
+    # Wrapper and compiler links are written on the host, the volume is shared by all the containers
+    bin_dir = os.path.join(host_dir, 'bin')
+    core.make_dirs(bin_dir)
+    core.make_dirs(os.path.join(host_dir, 'logs'))
+
+    core.write_executable_script(os.path.join(bin_dir, 'pdbench-cc'), WRAPPER)
+
+    for c in COMPILERS:
+        link = os.path.join(bin_dir, c)
+        if not os.path.islink(link):
+            os.symlink('pdbench-cc', link)
+
+
+def setup_command() -> str:
+    # Compilers of the build go through the cache if the container was started with it
+    return f'if [ -d {CACHE_VOLUME.container_dir}/bin ]; then export PATH={CACHE_VOLUME.container_dir}/bin:$PATH; fi'
+
+
+def build_environment() -> Tuple[Dict[str, str], str]:
+    # Each build logs the outcome of its compilations in its own file
+    name = f"logs/{uuid.uuid4().hex}.log"
+
+    return {'PDBENCH_CACHE_LOG': f"{CACHE_VOLUME.container_dir}/{name}"}, os.path.join(CACHE_VOLUME.host_dir, name)
+
+
+def read_log(log_file: str) -> Dict[str, Any]:
+    # Builds without the cache leave no log
+    if not os.path.exists(log_file):
+        return {}
+
+    with open(log_file) as f:
+        outcomes = f.read().split()
+
+    os.remove(log_file)
+
+    return {
+        'CacheHits': outcomes.count('hit'),
+        'CacheMisses': outcomes.count('miss'),
+        'CacheSkipped': outcomes.count('skipped'),
+    }
+
+
+@core.cli.group(
+    name="cache",
+    help="Manage the compiler cache shared by the framework containers"
+)
+def cache():
+    pass
+
+
+@cache.command(
+    name="status",
+    help="Show the number and size of the cached compiler outputs"
+)
+def cache_status():
+    from humanfriendly import format_size
+
+    objects = os.path.join(CACHE_VOLUME.host_dir, 'objects')
+    entries, size = 0, 0
+
+    for folder, _, files in os.walk(objects):
+        for name in files:
+            if name.endswith('.out'):
+                entries += 1
+            size += os.lstat(os.path.join(folder, name)).st_size
+
+    core.print_table([[CACHE_VOLUME.host_dir, entries, format_size(size)]], ['Directory', 'Entries', 'Size'])
+
+
+@cache.command(
+    name="clear",
+    help="Remove the cached compiler outputs"
+)
+def cache_clear():
+    objects = os.path.join(CACHE_VOLUME.host_dir, 'objects')
+
+    if os.path.isdir(objects):
+        shutil.rmtree(objects)
+
+    logging.info(f"Cleared {objects}")
@@ -5,13 +5,17 @@
 import logging
 from typing import List
 import os
+import shutil
 import click
-import docker
-import requests
 
 from . import builder
+from . import cache
 from . import container
 from . import core
+from . import discovery
+from . import runner
+from . import stats
+from .backend import get_backend
 
 
 import json
@@ -26,8 +30,117 @@ examples_volume = core.Volume(
 )
 
 chisel_container = container.ContainerWrapper(CHISEL_IMAGE, CHISEL_CONTAINER_NAME, [examples_volume])
+
+chisel_adapter = runner.Adapter(
+    'chisel', 'CHISEL', CHISEL_IMAGE, ['bash', 'adapter_chisel.sh'], 'Chisel', '/chisel_bins'
+)
 container_example_path = '/chisel-bench'
 
+# Scripts and oracle results of the examples volume, shared by the reductions running in the container
+PDBENCH_DIR = '.pdbench'
+
+ORACLE_COLUMNS = ['OracleHits', 'OracleMisses', 'OracleHitRate', 'OracleSecondsSaved']
+
+# Found before chisel in PATH, runs chisel with its oracle wrapped by pdbench-oracle. The oracle is the first
+# argument which is an executable file, the source files of the program follow it
+CHISEL_SHIM = r'''#!/usr/bin/env bash
+
+bin_dir="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+
+IFS=: read -ra dirs <<< "$PATH"
+for d in "${dirs[@]}"; do
+    if [[ $d != "$bin_dir" && -x $d/chisel ]]; then
+        real="$d/chisel"
+        break
+    fi
+done
+
+if [[ -z $real ]]; then
+    echo "chisel not found" >&2
+    exit 127
+fi
+
+args=()
+oracle=""
+sources=()
+
+for a in "$@"; do
+    if [[ -z $oracle && $a != -* && -f $a && -x $a ]]; then
+        oracle="$(realpath "$a")"
+        oracle_index=${#args[@]}
+    elif [[ -n $oracle && $a != -* && -f $a ]]; then
+        sources+=("$(realpath "$a")")
+    fi
+
+    args+=("$a")
+done
+
+if [[ -z $oracle || ${#sources[@]} == 0 ]]; then
+    exec "$real" "$@"
+fi
+
+memo="$(mktemp "${TMPDIR:-/tmp}/pdbench-oracle.XXXXXX")"
+{
+    echo '#!/usr/bin/env bash'
+    printf 'exec %q' "${bin_dir}/pdbench-oracle"
+    printf ' %q' "$oracle" "${sources[@]}"
+    echo
+} > "$memo"
+chmod +x "$memo"
+
+args[oracle_index]="$memo"
+"$real" "${args[@]}"
+rc=$?
+
+rm -f "$memo"
+exit $rc
+'''
+
+# Oracle returning the result saved for the same candidate, the key is the hash of the oracle script,
+# the directory it runs in and the source files. Other inputs of the oracle, e.g., the test files next to it,
+# are not hashed, the results are cleared with `chisel oracle-cache clear` when they change. Results are
+# renamed into place, concurrent reductions never see a partial one
+ORACLE_WRAPPER = r'''#!/usr/bin/env bash
+# Usage: pdbench-oracle <oracle> <source files>
+
+cache_dir="$(cd "$(dirname "${BASH_SOURCE[0]}")/.." && pwd)/oracle-cache"
+oracle="$1"
+shift
+
+log() {
+    [[ -n $PDBENCH_ORACLE_LOG ]] && echo "$1" >> "$PDBENCH_ORACLE_LOG"
+}
+
+key=$(
+    set -o pipefail
+    {
+        echo "$PWD"
+        cat "$oracle"
+        for f in "$@"; do
+            echo "$f"
+            cat "$f"
+        done
+    } | sha256sum
+) || exec "$oracle"
+
+entry="${cache_dir}/${key:0:2}/${key:0:64}"
+
+if [[ -f $entry ]] && read -r rc elapsed < "$entry"; then
+    log "hit $elapsed"
+    exit "$rc"
+fi
+
+start=$(date +%s%N)
+"$oracle"
+rc=$?
+elapsed=$(($(date +%s%N) - start))
+
+mkdir -p "$(dirname "$entry")" && echo "$rc $elapsed" > "$entry.$$" && mv -f "$entry.$$" "$entry"
+
+log "miss $elapsed"
+exit $rc
+'''
+
 
 @core.cli.group(
     name="chisel",
@@ -46,8 +159,7 @@ def chisel_build_image_cmd():
 
 
 def chisel_build_image():
-    client = docker.from_env()
-    existing_images = client.images.list(CHISEL_IMAGE)
+    existing_images = get_backend().images(CHISEL_IMAGE)
 
     if existing_images:
         logging.info("Chisel image found; to rebuild remove it first")
@@ -62,6 +174,7 @@ def chisel_build_image():
 
     core.make_parent_dirs(docker_file_path)
 
+    import requests
     r = requests.get(url)
     with open(docker_file_path, 'w') as f:
         f.write(r.text)
@@ -76,9 +189,12 @@ def chisel_build_image():
     name="start",
     help="Pull the chisel image and start the container"
 )
-def chisel_start():
+@click.option('-r', '--replicas', default=1, show_default=True, type=click.IntRange(min=1),
+              help='Number of containers to start, examples are built across all of them')
+@click.option('--cache', is_flag=True, help='Mount the compiler cache shared by the containers, see the cache command')
+def chisel_start(replicas: int = 1, cache: bool = False):
     chisel_build_image()
-    chisel_container.start(['--privileged'])
+    chisel_container.start({'privileged': True}, replicas, cache)
 
 
 @chisel.command(
@@ -157,12 +273,10 @@ def chisel_reset():
     name="run-config",
     help="Run the configurations for Chisel in the config file"
 )
-def chisel_run():
-    OUTPUT_DIR=json.load(open('config.json','r+'))['OUTPUT_DIR']
-    OUTPUT_DIR_CHISEL=os.path.join(OUTPUT_DIR,'Chisel')
-    CHISEL_CONTAINER_OUTPUT='/chisel_bins'
-    ARGS=['./sources/management_script.sh',CHISEL_IMAGE,'config.json','bash','adapter_chisel.sh',OUTPUT_DIR_CHISEL,CHISEL_CONTAINER_OUTPUT]
-    core.process_check_call(ARGS)
+@stats.repeat_options
+@runner.jobs_option
+def chisel_run(**options):
+    runner.run_trials(chisel_adapter, **options)
 
 @chisel.group(
     name="examples",
@@ -177,15 +291,11 @@ def chisel_examples():
     help="Copy defaults examples into examples volume"
 )
 def chisel_examples_copy():
-    core.process_check_call(
-        [
-            'docker', 'exec',
-            '--interactive', CHISEL_CONTAINER_NAME,
-            'cp', '-rv', f'{container_example_path}/.',
-            examples_volume.container_dir
-        ]
-    )
+    chisel_container.copy_to_volume(container_example_path, examples_volume)
+    write_scripts()
 
+
+def write_scripts():
     # This one needs us to source some variables before building
     # We are creating a wrapper bash script.
 
@@ -212,6 +322,26 @@ fi
 export CC=clang
 export CHISEL_BENCHMARK_HOME="${SCRIPT_PATH}"
 
+CACHE_SETUP
+
+# With PDBENCH_ORACLE_MEMO set, candidates already tested by the oracle are not tested again, see pdbench-oracle
+if [[ -n $PDBENCH_ORACLE_MEMO ]]; then
+    export PATH="${SCRIPT_PATH}/PDBENCH_DIR/bin:$PATH"
+    export PDBENCH_ORACLE_LOG="$(mktemp)"
+fi
+
+oracle_metrics() {
+    [[ -n $PDBENCH_ORACLE_LOG ]] || return 0
+    awk '{ n[$1]++; if ($1 == "hit") saved += $2 }
+        END {
+            printf "METRIC_MARKER OracleHits %d\\n", n["hit"]
+            printf "METRIC_MARKER OracleMisses %d\\n", n["miss"]
+            if (n["hit"] + n["miss"]) printf "METRIC_MARKER OracleHitRate %.4f\\n", n["hit"] / (n["hit"] + n["miss"])
+            printf "METRIC_MARKER OracleSecondsSaved %.3f\\n", saved / 1e9
+        }' "$PDBENCH_ORACLE_LOG"
+    rm -f "$PDBENCH_ORACLE_LOG"
+}
+
 pushd "${SCRIPT_PATH}/${project}" > /dev/null || exit 1
 
 # Needed if Chisel is being run with build system integration 
@@ -219,42 +349,62 @@ export NAME=`echo $(basename $(pwd)) | sed 's/bsysi_//g'`
 
 # If the project being debloated has the bsysi_ prefix
 if echo $(basename $(pwd)) | grep -q 'bsysi' ; then
-    . ../prepare
-    cp ../chisel_files/chisel.mk .
+    PREPARE_STAGE
 fi
 echo "Reducing in ${project}"
-make -f chisel.mk reduce || exit 1
+REDUCE_STAGE || { oracle_metrics; exit 1; }
+oracle_metrics
 
 popd > /dev/null || exit 1
 '''
 
-    script_path = os.path.join(examples_volume.host_dir, 'pdbench_wrapper.sh')
-    core.write_executable_script(script_path, cmds)
+    # Stage markers are added to the build output, see builder.stage_command
+    cmds = cmds.replace('CACHE_SETUP', cache.setup_command())
+    cmds = cmds.replace('PDBENCH_DIR', PDBENCH_DIR).replace('METRIC_MARKER', builder.METRIC_MARKER)
+    cmds = cmds.replace('PREPARE_STAGE',
+                        builder.stage_command('prepare', '. ../prepare && cp ../chisel_files/chisel.mk .'))
+    cmds = cmds.replace('REDUCE_STAGE', builder.stage_command('reduce', 'make -f chisel.mk reduce'))
+
+    for c in chisel_container.instances():
+        script_path = os.path.join(c.volumes[0].host_dir, 'pdbench_wrapper.sh')
+        core.write_executable_script(script_path, cmds)
+
+        bin_dir = os.path.join(c.volumes[0].host_dir, PDBENCH_DIR, 'bin')
+        core.make_dirs(bin_dir)
+        core.write_executable_script(os.path.join(bin_dir, 'chisel'), CHISEL_SHIM)
+        core.write_executable_script(os.path.join(bin_dir, 'pdbench-oracle'), ORACLE_WRAPPER)
 
 
 @chisel_examples.command(
     name="list",
     help="List examples"
 )
-def chisel_examples_list():
-    for d in example_build_directories():
-        print(d)
+@click.option('--refresh', is_flag=True, help='List every directory again instead of using the discovery index')
+@click.option('-l', '--long', is_flag=True, help='Show the size and last build of the examples')
+def chisel_examples_list(refresh: bool = False, long: bool = False):
+    discovery.print_examples(examples(refresh), long)
+
+
+# Skipping lib and original dirs
+IGNORE_DIRS = ('lib', 'original', 'chisel_files', '.git')
 
 
 def filter_condition(dir_path: str, files: List[str]) -> bool:
-    # Skipping lib and original dirs
-    IGNORE_DIRS = ['lib', 'original', 'chisel_files', '.git']
-    return not any([dir in dir_path for dir in IGNORE_DIRS]) and \
-        'bsysi_' in dir_path or 'chisel.mk' in files
+    return 'chisel.mk' in files or \
+        'bsysi_' in dir_path and not any(d in dir_path for d in IGNORE_DIRS)
+
 
+def examples(refresh: bool = False) -> List[discovery.Example]:
+    return discovery.discover('chisel', examples_volume.host_dir, filter_condition, refresh)
 
-def example_build_directories():
-    example_dir = examples_volume.host_dir
-    return core.find_rel_paths(example_dir, filter_condition)
 
+def example_build_directories(refresh: bool = False) -> List[str]:
+    return [e.name for e in examples(refresh)]
 
-def build_command(example: str) -> str:
-    return f'{examples_volume.container_dir}/pdbench_wrapper.sh {example}'
+
+def build_command(example: str, memo_oracle: bool = False) -> str:
+    memo = 'PDBENCH_ORACLE_MEMO=1 ' if memo_oracle else ''
+    return f'{memo}{examples_volume.container_dir}/pdbench_wrapper.sh {example}'
 
 
 @chisel_examples.command(
@@ -262,16 +412,63 @@ def build_command(example: str) -> str:
     help="Build example(s) in examples volume"
 )
 @click.option('-e', '--example', help='Name of the example, if not specified, build all')
-def chisel_examples_build(example: str = None):
-    b = builder.PdbBuilder('chisel', CHISEL_CONTAINER_NAME)
+@click.option('--refresh', is_flag=True, help='List every directory again instead of using the discovery index')
+@click.option('--memo-oracle', is_flag=True,
+              help='Reuse the oracle results of candidates already tested, see the oracle-cache command')
+@builder.build_options
+def chisel_examples_build(example: str = None, refresh: bool = False, memo_oracle: bool = False, **options):
+    if memo_oracle and (options['repeat'] > 1 or options['warmup']):
+        logging.warning("Trials after the first mostly reuse the oracle results of the previous ones")
+
+    # Scripts of volumes copied by older versions are updated
+    write_scripts()
+
+    b = builder.PdbBuilder('chisel', chisel_container.instances(), extra_columns=ORACLE_COLUMNS, **options)
 
     try:
         if example:
-            b.build(example, build_command(example))
+            b.build(example, build_command(example, memo_oracle))
 
         else:
-            for d in example_build_directories():
-                b.build(d, build_command(d))
+            b.build_all(discovery.longest_first(examples(refresh)), lambda e: build_command(e, memo_oracle))
 
     finally:
         b.close()
+
+
+def oracle_cache_dirs() -> List[str]:
+    return [os.path.join(c.volumes[0].host_dir, PDBENCH_DIR, 'oracle-cache') for c in chisel_container.instances()]
+
+
+@chisel.group(
+    name="oracle-cache",
+    help="Manage the oracle results reused by the builds with --memo-oracle"
+)
+def chisel_oracle_cache():
+    pass
+
+
+@chisel_oracle_cache.command(
+    name="status",
+    help="Show the number of oracle results saved in the examples volumes"
+)
+def chisel_oracle_cache_status():
+    rows = []
+
+    for d in oracle_cache_dirs():
+        entries = sum(len(files) for _, _, files in os.walk(d))
+        rows.append([d, entries])
+
+    core.print_table(rows, ['Directory', 'Entries'])
+
+
+@chisel_oracle_cache.command(
+    name="clear",
+    help="Remove the oracle results, e.g., when the test inputs of the oracles changed"
+)
+def chisel_oracle_cache_clear():
+    for d in oracle_cache_dirs():
+        if os.path.isdir(d):
+            shutil.rmtree(d)
+
+        logging.info(f"Cleared {d}")
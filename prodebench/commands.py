@@ -16,7 +16,8 @@ def print_line(indent, name, help_msg=None):
 
 
 def print_command_hierarchy(indent, click_commands_obj):
-    for n, c in click_commands_obj.commands.items():
+    for n in click_commands_obj.list_commands(None):
+        c = click_commands_obj.get_command(None, n)
         if isinstance(c, click.core.Group):
             print_line(indent, n, '')
             print_command_hierarchy(indent + 1, c)
@@ -4,12 +4,15 @@
 
 import logging
 import os
-from typing import List
+import re
+import shutil
+import sys
+from typing import List, Dict, Any
 
-import docker
-from colorama import Fore
-
-from .core import Volume, make_dirs, process_check_call, cli, print_table, ProDeBenchError
+from .backend import get_backend
+from .cache import CACHE_VOLUME, install as install_cache
+from .core import Volume, make_dirs, cli, print_table, ProDeBenchError
+from .transfer import copy_from
 
 
 class ContainerWrapper:
@@ -19,48 +22,92 @@ class ContainerWrapper:
         self.name = name
         self.volumes = volumes
 
-    def start(self, additional_args: List[str] = None):
-        cmd = [
-            'docker', 'run',
-            '--name', self.name,
-        ]
+    def start(self, options: Dict[str, Any] = None, replicas: int = 1, cache: bool = False):
+        if replicas > 1:
+            for i in range(replicas):
+                self.replica(i).start(options, cache=cache)
 
-        if additional_args:
-            cmd.extend(additional_args)
+            return
 
         for v in self.volumes:
             make_dirs(v.host_dir)
 
-            cmd.append('-v')
-            cmd.append(f"{v.host_dir}:{v.container_dir}")
+        # All the containers and replicas share the same compiler cache
+        volumes = self.volumes
+        if cache:
+            install_cache()
+            volumes = volumes + [CACHE_VOLUME]
 
-        cmd.extend(['-t', '-d', self.image])
-        process_check_call(cmd)
+        logging.info(f"Starting container {self.name} from {self.image}")
+        get_backend().run(self.image, self.name, volumes, **(options or {}))
 
     def stop(self):
-        logging.info(f"Stopping container {self.name}")
-        process_check_call(["docker", "stop", self.name])
+        for c in self.instances(all=True):
+            logging.info(f"Stopping container {c.name}")
+            get_backend().stop(c.name)
 
-        self.remove()
+            c.remove()
 
     def remove(self):
         logging.info(f"Removing container {self.name}")
-        process_check_call(["docker", "rm", self.name])
+        get_backend().remove(self.name)
+
+    def image_id(self) -> str:
+        return get_backend().image_id(self.name)
+
+    def exec(self, cmd: List[str]):
+        # Output goes straight to the console, failures raise an error
+        for stream, data in get_backend().exec_check(self.name, cmd):
+            console = sys.stdout if stream == 'stdout' else sys.stderr
+            console.buffer.write(data)
+            console.flush()
+
+    def copy_to_volume(self, container_path: str, volume: Volume):
+        # Contents of a directory of the image are streamed to the volume on the host, once,
+        # the volumes of the other replicas get a copy of it
+        instances = self.instances()
+        host_dirs = [next(v.host_dir for v in c.volumes if v.container_dir == volume.container_dir) for c in instances]
+
+        copy_from(instances[0].name, container_path, host_dirs[0])
+
+        for host_dir in host_dirs[1:]:
+            logging.info(f"Copying {host_dirs[0]} to {host_dir}")
+            shutil.copytree(host_dirs[0], host_dir, symlinks=True, dirs_exist_ok=True)
+
+    def replica(self, index: int) -> 'ContainerWrapper':
+        # First replica shares the volumes of the container, the others get their own copy
+        volumes = [Volume(f"{v.host_dir}-{index}", v.container_dir) for v in self.volumes] if index else self.volumes
+
+        return ContainerWrapper(self.image, f"{self.name}-{index}", volumes)
+
+    def replicas(self, all: bool = False) -> List['ContainerWrapper']:
+        pattern = re.compile(rf"^{re.escape(self.name)}-(\d+)$")
+
+        indexes = []
+        for c in get_backend().containers(all=all, filters={'name': self.name}):
+            m = pattern.match(c.name)
+            if m:
+                indexes.append(int(m.group(1)))
+
+        return [self.replica(i) for i in sorted(indexes)]
+
+    def instances(self, all: bool = False) -> List['ContainerWrapper']:
+        return self.replicas(all) or [self]
 
     def status(self):
         print_colored_status({'name': self.name})
 
     def shell(self, cmd: str = 'bash'):
-        os.system(f'docker exec -it "{self.name}" {cmd}')
+        os.system(f'docker exec -it "{self.instances()[0].name}" {cmd}')
 
 
 def print_colored_status(filters=None):
-    client = docker.from_env()
+    from colorama import Fore
 
     headers = ['Image', 'Container', 'Status']
     rows = []
 
-    for c in client.containers.list(all=True, filters=filters):
+    for c in get_backend().containers(all=True, filters=filters):
         if c.status == 'exited':
             status_colored = Fore.RED + c.status + Fore.RESET
         elif c.status == 'running':
@@ -84,10 +131,8 @@ def status():
     help="Remove exited containers"
 )
 def remove():
-    client = docker.from_env()
-
     to_remove = []
-    for c in client.containers.list(all=True):
+    for c in get_backend().containers(all=True):
         if c.status == 'exited':
             to_remove.append(c.name)
 
@@ -98,6 +143,6 @@ def remove():
     for c in to_remove:
         try:
             logging.info(f"Removing container {c}")
-            process_check_call(["docker", "rm", c])
+            get_backend().remove(c)
         except ProDeBenchError as e:
             logging.warning(e.args[0])
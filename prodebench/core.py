@@ -2,21 +2,72 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import importlib
 import logging
 import os
 import shlex
 import subprocess
+import sys
 from collections import namedtuple
-from typing import List, Callable, Iterator
+from typing import List, Callable, Iterator, Dict
 import click
-import coloredlogs
-from tabulate import tabulate
 
 logging_format = '[%(asctime)s] %(levelname)s: %(message)s'
-coloredlogs.install(level='INFO', logger=logging.getLogger(), fmt=logging_format)
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
-cli = click.Group(name='prodebench', help="ProDeBench management script", context_settings=CONTEXT_SETTINGS)
+
+# Modules are only imported when one of their commands runs
+LAZY_COMMANDS = {
+    'commands': 'commands',
+    'status': 'container',
+    'remove': 'container',
+    'metrics': 'metrics',
+    'results': 'results',
+    'images': 'images',
+    'matrix': 'matrix',
+    'perf': 'perf',
+    'elf': 'elf',
+    'gadgets': 'gadgets',
+    'cache': 'cache',
+    'pool': 'runner',
+    'occam': 'occam',
+    'chisel': 'chisel',
+    'piecewise': 'piecewise',
+    'razor': 'razor',
+}
+
+
+class LazyGroup(click.Group):
+
+    def __init__(self, *args, lazy_commands: Dict[str, str] = None, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.lazy_commands = lazy_commands or {}
+
+    def list_commands(self, ctx):
+        return sorted(set(super().list_commands(ctx)) | set(self.lazy_commands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name not in self.commands and cmd_name in self.lazy_commands:
+            # The module registers its commands in this group when imported
+            importlib.import_module(f"{__package__}.{self.lazy_commands[cmd_name]}")
+
+        return super().get_command(ctx, cmd_name)
+
+
+def setup_logging():
+    # Colors only matter on a terminal, scripts calling pdbench skip importing coloredlogs
+    if not sys.stderr.isatty():
+        logging.basicConfig(level=logging.INFO, format=logging_format, datefmt='%Y-%m-%d %H:%M:%S')
+        return
+
+    import coloredlogs
+    coloredlogs.install(level='INFO', logger=logging.getLogger(), fmt=logging_format)
+
+
+cli = LazyGroup(
+    name='prodebench', help="ProDeBench management script", context_settings=CONTEXT_SETTINGS,
+    callback=setup_logging, lazy_commands=LAZY_COMMANDS
+)
 
 Volume = namedtuple('Volume', ['host_dir', 'container_dir'])
 
@@ -36,6 +87,7 @@ def process_check_call(cmd: List[str], cwd: str = None):
 
 
 def print_table(rows, headers):
+    from tabulate import tabulate
     print(tabulate(rows, headers=headers, tablefmt="pipe", numalign="right"))
 
 
@@ -0,0 +1,174 @@
+# Copyright (c) 2022 SRI International All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import json
+import logging
+import os
+import tempfile
+from typing import List, Dict, Any, Callable, Optional
+
+from . import core
+from .results import ResultStore, format_duration
+
+INDEX_FILE = core.project_relative_location('data/discovery-index.json')
+INDEX_VERSION = 1
+
+
+class Example:
+
+    def __init__(self, name: str, size: int, last_status: str = '', last_duration: Optional[float] = None) -> None:
+        super().__init__()
+        self.name = name
+        self.size = size
+        self.last_status = last_status
+        self.last_duration = last_duration
+
+
+def load_index(path: str = INDEX_FILE) -> Dict[str, Any]:
+    # An index that cannot be read is only a cache, the examples are listed again
+    try:
+        with open(path) as f:
+            index = json.load(f)
+    except (OSError, ValueError) as e:
+        if not isinstance(e, FileNotFoundError):
+            logging.warning(f"Ignoring unreadable discovery index {path}: {e}")
+        index = None
+
+    if not isinstance(index, dict) or index.get('version') != INDEX_VERSION or not isinstance(index.get('roots'), dict):
+        return {'version': INDEX_VERSION, 'roots': {}}
+
+    return index
+
+
+def save_index(index: Dict[str, Any], path: str = INDEX_FILE):
+    core.make_parent_dirs(path)
+
+    # The index is shared by the frameworks, each writer replaces it with its own temporary file
+    fd, tmp_path = tempfile.mkstemp(prefix=f"{os.path.basename(path)}.", suffix='.tmp', dir=os.path.dirname(path))
+
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f)
+
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def list_dir(path: str, mtime_ns: int) -> Dict[str, Any]:
+    # Same split as os.walk: links to directories are listed as directories but not followed
+    files, dirs, walk = [], [], []
+
+    with os.scandir(path) as entries:
+        for e in entries:
+            if e.is_dir():
+                dirs.append(e.name)
+                if not e.is_symlink():
+                    walk.append(e.name)
+            else:
+                files.append(e.name)
+
+    return {'mtime_ns': mtime_ns, 'files': sorted(files), 'dirs': sorted(dirs), 'walk': sorted(walk)}
+
+
+def tree_size(path: str) -> int:
+    size = 0
+    pending = [path]
+
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for e in entries:
+                if e.is_dir(follow_symlinks=False):
+                    pending.append(e.path)
+                else:
+                    size += e.stat(follow_symlinks=False).st_size
+
+    return size
+
+
+def find_examples(root: str, condition: Callable[[str, List[str]], bool], cached: Dict[str, Any],
+                  refresh: bool = False) -> Dict[str, Any]:
+    # Like core.find_rel_paths, the listing of a directory is reused while its mtime is unchanged,
+    # i.e., no entry was added, removed or renamed in it
+    dirs = {}
+    examples = []
+    pending = ['']
+    reused = 0
+
+    while pending:
+        rel = pending.pop()
+        path = os.path.join(root, rel) if rel else root
+
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            continue
+
+        listing = cached.get('dirs', {}).get(rel)
+        if refresh or not listing or listing['mtime_ns'] != mtime_ns:
+            listing = list_dir(path, mtime_ns)
+        else:
+            reused += 1
+
+        dirs[rel] = listing
+
+        if condition(path, listing['files']):
+            # Sub directories of an example are not searched
+            examples.append(rel)
+        else:
+            pending.extend(os.path.join(rel, d) for d in reversed(listing['walk']))
+
+    logging.debug(f"Listed {len(dirs) - reused} of {len(dirs)} directories of {root}")
+
+    # Sizes are only measured for new examples or with refresh, they are used for scheduling
+    sizes = {} if refresh else cached.get('sizes', {})
+    sizes = {e: sizes[e] if e in sizes else tree_size(os.path.join(root, e)) for e in examples}
+
+    return {'dirs': dirs, 'examples': examples, 'sizes': sizes}
+
+
+def discover(framework: str, root: str, condition: Callable[[str, List[str]], bool],
+             refresh: bool = False) -> List[Example]:
+    index = load_index()
+    key = os.path.realpath(root)
+    entry = find_examples(root, condition, index['roots'].get(key, {}), refresh)
+
+    if entry != index['roots'].get(key):
+        index['roots'][key] = entry
+        save_index(index)
+
+    with ResultStore() as store:
+        latest = store.latest(framework)
+
+    examples = []
+    for name in entry['examples']:
+        last = latest.get(name, {})
+        status = '' if not last else ('success' if last['return_code'] == 0 else 'failure')
+        examples.append(Example(name, entry['sizes'][name], status, last.get('duration')))
+
+    return examples
+
+
+def longest_first(examples: List[Example]) -> List[str]:
+    # The slowest examples start first so that parallel builds finish close together,
+    # examples never built are ordered by size after the ones with a known duration
+    return [e.name for e in sorted(examples, key=lambda e: (e.last_duration is not None, e.last_duration or 0, e.size),
+                                   reverse=True)]
+
+
+def print_examples(examples: List[Example], long: bool = False):
+    if not long:
+        for e in examples:
+            print(e.name)
+        return
+
+    from humanfriendly import format_size
+
+    rows = [
+        [e.name, format_size(e.size), e.last_status, format_duration(e.last_duration)]
+        for e in examples
+    ]
+    core.print_table(rows, ['Example', 'Size', 'Last build', 'Duration'])
+
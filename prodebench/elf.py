@@ -0,0 +1,332 @@
+# Copyright (c) 2022 SRI International All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import json
+import logging
+import mmap
+import os
+import struct
+from typing import List, Dict, Any, Tuple
+
+import click
+
+from . import core
+
+ELF_MAGIC = b'\x7fELF'
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2MSB = 2
+
+SHT_SYMTAB = 2
+SHT_NOBITS = 8
+SHT_DYNSYM = 11
+STT_FUNC = 2
+PF_X = 1
+SHN_UNDEF = 0
+SHN_XINDEX = 0xffff
+
+SECTION_TYPES = {0: 'NULL', 1: 'PROGBITS', 2: 'SYMTAB', 3: 'STRTAB', 4: 'RELA', 5: 'HASH', 6: 'DYNAMIC', 7: 'NOTE',
+                 8: 'NOBITS', 9: 'REL', 11: 'DYNSYM', 14: 'INIT_ARRAY', 15: 'FINI_ARRAY', 0x6ffffff6: 'GNU_HASH',
+                 0x6ffffffe: 'VERNEED', 0x6fffffff: 'VERSYM'}
+
+# Offset and format of e_shoff, and offset of e_shentsize followed by e_shnum and e_shstrndx
+SECTION_HEADER_FIELDS = {ELFCLASS32: (32, 'I', 46), ELFCLASS64: (40, 'Q', 58)}
+
+# Same for e_phoff, e_phentsize and e_phnum
+PROGRAM_HEADER_FIELDS = {ELFCLASS32: (28, 'I', 42), ELFCLASS64: (32, 'Q', 54)}
+E_MACHINE_OFFSET = 18
+
+
+def section_dtype(elf_class: int, byte_order: str):
+    import numpy as np
+
+    word = 'u8' if elf_class == ELFCLASS64 else 'u4'
+    return np.dtype([
+        ('name', 'u4'), ('type', 'u4'), ('flags', word), ('addr', word), ('offset', word), ('size', word),
+        ('link', 'u4'), ('info', 'u4'), ('addralign', word), ('entsize', word)
+    ]).newbyteorder(byte_order)
+
+
+def segment_dtype(elf_class: int, byte_order: str):
+    import numpy as np
+
+    # Flags come second in 64 bits, to keep the other fields aligned
+    if elf_class == ELFCLASS64:
+        fields = [('type', 'u4'), ('flags', 'u4'), ('offset', 'u8'), ('vaddr', 'u8'), ('paddr', 'u8'),
+                  ('filesz', 'u8'), ('memsz', 'u8'), ('align', 'u8')]
+    else:
+        fields = [('type', 'u4'), ('offset', 'u4'), ('vaddr', 'u4'), ('paddr', 'u4'), ('filesz', 'u4'),
+                  ('memsz', 'u4'), ('flags', 'u4'), ('align', 'u4')]
+
+    return np.dtype(fields).newbyteorder(byte_order)
+
+
+def symbol_dtype(elf_class: int, byte_order: str):
+    import numpy as np
+
+    # Same fields, in a different order for 32 and 64 bits
+    if elf_class == ELFCLASS64:
+        fields = [('name', 'u4'), ('info', 'u1'), ('other', 'u1'), ('shndx', 'u2'), ('value', 'u8'), ('size', 'u8')]
+    else:
+        fields = [('name', 'u4'), ('value', 'u4'), ('size', 'u4'), ('info', 'u1'), ('other', 'u1'), ('shndx', 'u2')]
+
+    return np.dtype(fields).newbyteorder(byte_order)
+
+
+class ElfFile:
+    # Headers and tables are read in place from the mapped file, as numpy views without copies
+
+    def __init__(self, path: str) -> None:
+        super().__init__()
+        self.path = path
+        self._headers = None
+        self._f = open(path, 'rb')
+
+        try:
+            self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._f.close()
+            raise core.ProDeBenchError(f"{path} is not an ELF file")
+
+        if self._mm[:4] != ELF_MAGIC or self._mm[4] not in SECTION_HEADER_FIELDS:
+            self.close()
+            raise core.ProDeBenchError(f"{path} is not an ELF file")
+
+        self.elf_class = self._mm[4]
+        self.byte_order = '>' if self._mm[5] == ELFDATA2MSB else '<'
+        self.machine, = struct.unpack_from(self.byte_order + 'H', self._mm, E_MACHINE_OFFSET)
+
+        shoff_offset, shoff_format, shentsize_offset = SECTION_HEADER_FIELDS[self.elf_class]
+        shoff, = struct.unpack_from(self.byte_order + shoff_format, self._mm, shoff_offset)
+        shentsize, shnum, shstrndx = struct.unpack_from(self.byte_order + 'HHH', self._mm, shentsize_offset)
+        dtype = section_dtype(self.elf_class, self.byte_order)
+
+        if shoff and shentsize != dtype.itemsize:
+            self.close()
+            raise core.ProDeBenchError(f"Unexpected section header size {shentsize} in {path}")
+
+        # More than 0xff00 sections, the counts are in the first section header
+        if shoff and (shnum == 0 or shstrndx == SHN_XINDEX):
+            first = self._array(dtype, shoff, 1)[0]
+            shnum = shnum or int(first['size'])
+            shstrndx = int(first['link']) if shstrndx == SHN_XINDEX else shstrndx
+
+        self._headers = self._array(dtype, shoff, shnum) if shoff else None
+        self._shstrndx = shstrndx
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        # Views of the mapping must be released before it can be closed
+        self._headers = None
+        self._mm.close()
+        self._f.close()
+
+    def _array(self, dtype, offset: int, count: int):
+        import numpy as np
+
+        if offset + count * dtype.itemsize > len(self._mm):
+            raise core.ProDeBenchError(f"Truncated ELF file {self.path}")
+
+        return np.frombuffer(self._mm, dtype=dtype, count=count, offset=offset)
+
+    def _names(self, table_index: int, offsets) -> List[str]:
+        import numpy as np
+
+        # End of each name from the positions of the NUL bytes of the string table, all at once
+        table = self._headers[table_index]
+        start, size = int(table['offset']), int(table['size'])
+        data = np.frombuffer(self._mm, dtype=np.uint8, count=size, offset=start)
+        nuls = np.flatnonzero(data == 0)
+        offsets = np.minimum(np.asarray(offsets, dtype=np.int64), size)
+        ends = nuls[np.minimum(np.searchsorted(nuls, offsets), len(nuls) - 1)] if len(nuls) else offsets
+
+        names = [self._mm[start + a:start + max(a, b)].decode(errors='replace') for a, b in zip(offsets, ends)]
+        del data
+        return names
+
+    def executable_segments(self) -> List[Tuple[int, int, int]]:
+        # (address, file offset, size) of the segments mapped executable
+        phoff_offset, phoff_format, phentsize_offset = PROGRAM_HEADER_FIELDS[self.elf_class]
+        phoff, = struct.unpack_from(self.byte_order + phoff_format, self._mm, phoff_offset)
+        phentsize, phnum = struct.unpack_from(self.byte_order + 'HH', self._mm, phentsize_offset)
+        dtype = segment_dtype(self.elf_class, self.byte_order)
+
+        if not phoff or not phnum:
+            return []
+
+        if phentsize != dtype.itemsize:
+            raise core.ProDeBenchError(f"Unexpected program header size {phentsize} in {self.path}")
+
+        segments = self._array(dtype, phoff, phnum)
+        executable = [
+            (int(s['vaddr']), int(s['offset']), min(int(s['memsz']), max(len(self._mm) - int(s['offset']), 0)))
+            for s in segments if s['flags'] & PF_X
+        ]
+        del segments
+
+        return [s for s in executable if s[2] > 0]
+
+    def view(self, offset: int, size: int) -> memoryview:
+        # Slice of the mapped file, to be released before the file is closed
+        return memoryview(self._mm)[offset:offset + size]
+
+    def sections(self) -> List[Dict[str, Any]]:
+        if self._headers is None:
+            return []
+
+        names = self._names(self._shstrndx, self._headers['name'])
+
+        return [
+            {
+                'Section': name,
+                'Type': SECTION_TYPES.get(int(h['type']), hex(int(h['type']))),
+                'Size': int(h['size']),
+                'FileSize': 0 if h['type'] == SHT_NOBITS else int(h['size']),
+            }
+            for name, h in zip(names, self._headers) if name
+        ]
+
+    def functions(self) -> Dict[str, int]:
+        # The static symbol table has all the functions, the dynamic one only those exported
+        if self._headers is None:
+            return {}
+
+        types = self._headers['type']
+        tables = [int(i) for i in (types == SHT_SYMTAB).nonzero()[0]] or \
+                 [int(i) for i in (types == SHT_DYNSYM).nonzero()[0]]
+
+        if tables and types[tables[0]] == SHT_DYNSYM:
+            logging.warning(f"{self.path} is stripped, only exported functions are listed")
+
+        dtype = symbol_dtype(self.elf_class, self.byte_order)
+        functions = {}
+
+        for i in tables:
+            h = self._headers[i]
+            symbols = self._array(dtype, int(h['offset']), int(h['size']) // dtype.itemsize)
+            selected = symbols[((symbols['info'] & 0xf) == STT_FUNC) & (symbols['shndx'] != SHN_UNDEF)]
+
+            # Local functions with the same name in different files are counted together
+            for name, size in zip(self._names(int(h['link']), selected['name']), selected['size']):
+                functions[name] = functions.get(name, 0) + int(size)
+
+            del symbols, selected
+
+        return functions
+
+
+def section_sizes(path: str) -> Dict[str, Dict[str, Any]]:
+    with ElfFile(path) as elf:
+        return {s['Section']: s for s in elf.sections()}
+
+
+def function_sizes(path: str) -> Dict[str, int]:
+    with ElfFile(path) as elf:
+        return elf.functions()
+
+
+def percent(saved: int, total: int) -> str:
+    return f"{100 * saved / total:.1f}%" if total else ''
+
+
+def diff(original: str, debloated: str) -> Dict[str, Any]:
+    sections = {'original': section_sizes(original), 'debloated': section_sizes(debloated)}
+    functions = {'original': function_sizes(original), 'debloated': function_sizes(debloated)}
+
+    names = list(sections['original']) + [n for n in sections['debloated'] if n not in sections['original']]
+    section_rows = []
+
+    for n in names:
+        before = sections['original'].get(n, {}).get('Size', 0)
+        after = sections['debloated'].get(n, {}).get('Size', 0)
+        section_rows.append({'Section': n, 'Original': before, 'Debloated': after, 'Saved': before - after,
+                             'SavedPercent': percent(before - after, before)})
+
+    removed = sorted(
+        ({'Function': f, 'Size': s} for f, s in functions['original'].items() if f not in functions['debloated']),
+        key=lambda r: r['Size'], reverse=True
+    )
+
+    return {
+        'Original': original,
+        'Debloated': debloated,
+        'OriginalSize': os.path.getsize(original),
+        'DebloatedSize': os.path.getsize(debloated),
+        'Sections': section_rows,
+        'OriginalFunctions': len(functions['original']),
+        'DebloatedFunctions': len(functions['debloated']),
+        'RemovedFunctions': removed,
+    }
+
+
+@core.cli.group(
+    name="elf",
+    help="Section and function sizes of ELF binaries"
+)
+def elf():
+    pass
+
+
+@elf.command(
+    name="sections",
+    help="Size of each section of a binary"
+)
+@click.argument('binary', type=click.Path(exists=True, dir_okay=False))
+def elf_sections(binary: str):
+    with ElfFile(binary) as e:
+        rows = e.sections()
+
+    headers = ['Section', 'Type', 'Size', 'FileSize']
+    core.print_table([[r[h] for h in headers] for r in rows], headers)
+
+
+@elf.command(
+    name="functions",
+    help="Size of the functions of a binary, largest first"
+)
+@click.argument('binary', type=click.Path(exists=True, dir_okay=False))
+@click.option('-n', '--top', default=20, show_default=True, type=click.IntRange(min=0),
+              help='Number of functions shown, 0 for all')
+def elf_functions(binary: str, top: int):
+    functions = sorted(function_sizes(binary).items(), key=lambda f: f[1], reverse=True)
+
+    core.print_table(functions[:top] if top else functions, ['Function', 'Size'])
+    logging.info(f"{len(functions)} functions, {sum(s for _, s in functions)} bytes")
+
+
+@elf.command(
+    name="diff",
+    help="Bytes saved per section and functions removed by debloating"
+)
+@click.argument('original', type=click.Path(exists=True, dir_okay=False))
+@click.argument('debloated', type=click.Path(exists=True, dir_okay=False))
+@click.option('-n', '--top', default=20, show_default=True, type=click.IntRange(min=0),
+              help='Number of removed functions shown, 0 for all')
+@click.option('-o', '--output', type=click.Path(dir_okay=False), help='Save the full comparison in a .json file')
+def elf_diff(original: str, debloated: str, top: int, output: str = None):
+    d = diff(original, debloated)
+
+    headers = ['Section', 'Original', 'Debloated', 'Saved', 'SavedPercent']
+    core.print_table([[r[h] for h in headers] for r in d['Sections']], headers)
+
+    removed = d['RemovedFunctions']
+    core.print_table([[r['Function'], r['Size']] for r in (removed[:top] if top else removed)], ['Removed function', 'Size'])
+
+    saved = d['OriginalSize'] - d['DebloatedSize']
+    logging.info(f"File size {d['OriginalSize']} -> {d['DebloatedSize']} bytes ({percent(saved, d['OriginalSize'])} saved)")
+    logging.info(f"Functions {d['OriginalFunctions']} -> {d['DebloatedFunctions']}, {len(removed)} removed "
+                 f"({sum(r['Size'] for r in removed)} bytes)")
+
+    if output:
+        core.make_parent_dirs(os.path.abspath(output))
+
+        with open(output, 'w') as f:
+            json.dump(d, f, indent=4)
+
+        logging.info(f"Comparison saved in {output}")
@@ -0,0 +1,145 @@
+# Copyright (c) 2022 SRI International All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import hashlib
+import logging
+import os
+import re
+from typing import Iterator, Tuple, Optional
+from urllib.parse import urlparse, unquote
+
+from . import core
+from .transfer import Progress
+
+CHUNK_SIZE = 1 << 20
+
+# A tar archive ends with two zero blocks of 512 bytes, padded up to a record of 10 KiB at most
+TAR_RECORD_SIZE = 10240
+
+
+def local_path(location: str) -> Optional[str]:
+    # A plain path or a file:// URL
+    url = urlparse(location)
+
+    if url.scheme == 'file':
+        return unquote(url.path)
+
+    return location if not url.scheme else None
+
+
+def open_location(location: str, offset: int = 0, session=None) -> Tuple[Iterator[bytes], bool, Optional[int]]:
+    # The chunks from the offset when the source supports ranges, from the start otherwise, and the total size
+    path = local_path(location)
+
+    if path is not None:
+        if not os.path.isfile(path):
+            raise core.ProDeBenchError(f"File not found: {path}")
+
+        def read():
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                yield from iter(lambda: f.read(CHUNK_SIZE), b'')
+
+        return read(), True, os.path.getsize(path)
+
+    if session is None:
+        import requests
+        session = requests.session()
+
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    r = session.get(location, headers=headers, stream=True)
+
+    # The partial download is already complete
+    if offset and r.status_code == 416:
+        r.close()
+        return iter([]), True, offset
+
+    if r.status_code >= 400:
+        r.close()
+        raise core.ProDeBenchError(f"Failed to download {location}: HTTP {r.status_code}")
+
+    resumed = r.status_code == 206
+    m = re.match(r'^bytes \d+-\d+/(\d+)$', r.headers.get('Content-Range', ''))
+    total = int(m.group(1)) if m else (int(r.headers['Content-Length']) if 'Content-Length' in r.headers else None)
+
+    def read():
+        with r:
+            yield from r.iter_content(CHUNK_SIZE)
+
+    return read(), resumed, total
+
+
+def check_digest(actual: str, expected: Optional[str], location: str):
+    if expected and actual != expected.lower():
+        raise core.ProDeBenchError(f"SHA-256 of {location} is {actual}, expected {expected}")
+
+
+def fetch(location: str, path: str, sha256: str = None, session=None) -> str:
+    # Downloads to <path>.part, resumed on the next call if interrupted, the file only
+    # gets its final name once complete and verified
+    part = f"{path}.part"
+    h = hashlib.sha256()
+    offset = 0
+
+    if os.path.exists(part):
+        with open(part, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                h.update(chunk)
+                offset += len(chunk)
+
+    chunks, resumed, total = open_location(location, offset, session)
+
+    if offset and resumed:
+        logging.info(f"Resuming download of {location} at {offset} bytes")
+    elif offset:
+        logging.info(f"Restarting download of {location}, the server does not support ranges")
+        h = hashlib.sha256()
+        offset = 0
+
+    core.make_parent_dirs(path)
+    progress = Progress(f"Downloading {os.path.basename(path)}", total)
+    progress.update(offset, files=0)
+
+    with open(part, 'ab' if offset else 'wb') as f:
+        for chunk in chunks:
+            h.update(chunk)
+            f.write(chunk)
+            progress.update(len(chunk), files=0)
+
+    progress.close()
+
+    try:
+        check_digest(h.hexdigest(), sha256, location)
+    except core.ProDeBenchError:
+        os.remove(part)
+        raise
+
+    os.replace(part, path)
+    return h.hexdigest()
+
+
+def stream(location: str, sha256: str, session=None) -> Iterator[bytes]:
+    # Bytes are passed on as they are received, except the last ones which are only sent once the digest
+    # is verified. They hold at least a whole tar record, so the end-of-archive marker of a corrupted
+    # tarball is never sent and the daemon never sees it complete
+    chunks, _, total = open_location(location, session=session)
+    h = hashlib.sha256()
+    progress = Progress(f"Streaming {location}", total)
+    hold_back = max(CHUNK_SIZE, TAR_RECORD_SIZE)
+    pending = bytearray()
+
+    for chunk in chunks:
+        h.update(chunk)
+        progress.update(len(chunk), files=0)
+        pending += chunk
+
+        if len(pending) > hold_back:
+            yield bytes(pending[:-hold_back])
+            del pending[:-hold_back]
+
+    progress.close()
+    check_digest(h.hexdigest(), sha256, location)
+
+    if pending:
+        yield bytes(pending)
@@ -0,0 +1,405 @@
+# Copyright (c) 2022 SRI International All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import csv
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
+
+import click
+
+from . import core
+from .elf import ElfFile
+
+# Gadgets ending with a return, an indirect jmp or call, a system call, or a direct jmp. Direct jmps do not
+# give control of the target, they are only counted because ROPgadget does
+KINDS = ['ROP', 'JOP', 'COP', 'SYS', 'DIRECT']
+
+# Gadgets are told apart by their instruction bytes, unlike the UniqueGadgets of the metrics command which
+# counts gadgets with different text like ROPgadget. The validate command compares the latter
+COLUMNS = ['File'] + KINDS + ['UniqueGadgetBytes', 'Seconds']
+
+VALIDATE_COLUMNS = ['File', 'ROPgadget', 'Scanner', 'Difference', 'ROPgadgetSeconds', 'ScannerSeconds']
+
+# Bytes searched back from each terminator, same as the ROPgadget default
+DEPTH = 10
+
+EM_386 = 3
+EM_X86_64 = 62
+
+ANY = range(256)
+
+
+def byte_range(first: int, last: int) -> List[int]:
+    return list(range(first, last + 1))
+
+
+# Byte patterns ending a gadget, each position is a byte or the bytes allowed there.
+# Same terminators as ROPgadget on x86, its `syscall ; ret` like patterns are left out
+# because it discards the gadgets they find
+RET_TERMINATORS = [
+    [0xc3],  # ret
+    [0xc2, ANY, ANY],  # ret <imm>
+    [0xcb],  # retf
+    [0xca, ANY, ANY],  # retf <imm>
+    [0xf2, 0xc3],  # bnd ret
+    [0xf2, 0xc2, ANY, ANY],  # bnd ret <imm>
+]
+
+# call/jmp through a register, rex.b variants address r8-r15 in 64 bits. ROPgadget's patterns for
+# call/jmp [rsp], [rsp + disp8] and [rsp + disp32] end their SIB byte with an unescaped 0x24, a `$` in its
+# regular expressions, so they never match and are left out too
+REGISTER_TERMINATORS = [
+    [0xff, byte_range(0xd0, 0xd7) + byte_range(0xe0, 0xe7)],  # call/jmp reg
+    [0xff, byte_range(0x10, 0x13) + [0x16, 0x17] + byte_range(0x20, 0x23) + [0x26, 0x27]],  # call/jmp [reg]
+    [0xff, byte_range(0x50, 0x53) + [0x55, 0x56, 0x57] + byte_range(0x60, 0x63) + [0x65, 0x66, 0x67], ANY],
+    [0xff, byte_range(0x90, 0x93) + [0x95, 0x96, 0x97] + byte_range(0xa0, 0xa3) + [0xa5, 0xa6, 0xa7], ANY, ANY, ANY, ANY],
+]
+
+JUMP_TERMINATORS = [
+    [0xeb, ANY],  # jmp <rel8>
+    [0xe9, ANY, ANY, ANY, ANY],  # jmp <rel32>
+    [0xf2, 0xff, byte_range(0x20, 0x23) + [0x26, 0x27]],  # bnd jmp [reg]
+    [0xf2, 0xff, byte_range(0xe0, 0xe4) + [0xe6, 0xe7]],  # bnd jmp reg
+    [0xf2, 0xff, byte_range(0x10, 0x13) + [0x16, 0x17]],  # bnd call [reg]
+    [0xf2, 0xff, byte_range(0xd0, 0xd4) + [0xd6, 0xd7]],  # bnd call reg
+]
+
+SYS_TERMINATORS = [
+    [0xcd, 0x80],  # int 0x80
+    [0x0f, 0x34],  # sysenter
+    [0x0f, 0x05],  # syscall
+    [0x65, 0xff, 0x15, 0x10, 0x00, 0x00, 0x00],  # call dword ptr gs:[0x10]
+]
+
+BRANCHES = {'ret', 'retf', 'int', 'sysenter', 'jmp', 'call', 'syscall'}
+
+
+def terminators(machine: int) -> List[List]:
+    patterns = RET_TERMINATORS + REGISTER_TERMINATORS
+
+    if machine == EM_X86_64:
+        patterns = patterns + [[0x41] + p for p in REGISTER_TERMINATORS]
+
+    return patterns + JUMP_TERMINATORS + SYS_TERMINATORS
+
+
+def non_overlapping(found, size: int):
+    import numpy as np
+
+    # Matches of a pattern are taken from the left and skip the ones they overlap, like the re.finditer of
+    # ROPgadget. Only files with overlapping matches are walked in Python
+    if found.size < 2 or (np.diff(found) >= size).all():
+        return found
+
+    kept, end = [], -1
+    for offset in found.tolist():
+        if offset >= end:
+            kept.append(offset)
+            end = offset + size
+
+    return np.array(kept, dtype=found.dtype)
+
+
+def find_terminators(code, patterns: List[List]) -> Tuple[Any, Any]:
+    import numpy as np
+
+    # Offsets and sizes of the matches, the first byte is compared over the whole code and the next ones only
+    # at the offsets still matching
+    offsets, sizes = [], []
+
+    for p in patterns:
+        n = len(code) - len(p) + 1
+        if n <= 0:
+            continue
+
+        found = np.arange(n)
+        for k, allowed in enumerate(p):
+            if allowed is ANY:
+                continue
+
+            table = np.zeros(256, dtype=bool)
+            table[allowed] = True
+            found = np.flatnonzero(table[code[:n]]) if k == 0 else found[table[code[found + k]]]
+
+        found = non_overlapping(found, len(p))
+        offsets.append(found)
+        sizes.append(np.full(found.size, len(p)))
+
+    if not offsets:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    return np.concatenate(offsets), np.concatenate(sizes)
+
+
+def candidate_windows(offsets, sizes, depth: int):
+    import numpy as np
+
+    # Windows from up to `depth` - 1 bytes before each terminator to its end, sorted by start so the
+    # longest window of a terminator comes first
+    starts = (offsets[None, :] - np.arange(depth)[:, None]).ravel()
+    ends = np.broadcast_to(offsets + sizes, (depth, offsets.size)).ravel()
+    keep = starts >= 0
+    starts, ends = starts[keep], ends[keep]
+
+    order = np.lexsort((ends, starts))
+    windows = np.stack([starts[order], ends[order]], axis=1)
+
+    return windows[np.concatenate([[True], (np.diff(windows, axis=0) != 0).any(axis=1)])]
+
+
+def classify(insns: List[Tuple]) -> Optional[str]:
+    # Same filtering as ROPgadget: a single branch, at the end, and no int3
+    mnemonics = [i[2] for i in insns]
+
+    if mnemonics[-1] not in BRANCHES:
+        return None
+
+    if any(m in BRANCHES or 'ret' in m or m == 'int3' for m in mnemonics[:-1]) or mnemonics[-1] == 'int3':
+        return None
+
+    last, op_str = mnemonics[-1], insns[-1][3]
+
+    if last in ('ret', 'retf'):
+        return 'ROP'
+
+    if last in ('int', 'syscall', 'sysenter') or 'gs:' in op_str:
+        return 'SYS'
+
+    if last == 'jmp':
+        return 'DIRECT' if op_str[:1].isdigit() else 'JOP'
+
+    return 'COP'
+
+
+def decode(md, window: bytes, chains: Dict[bytes, Optional[Tuple]]) -> Optional[Tuple]:
+    # The instructions of a window are its first ones followed by those of a shorter window ending at the
+    # same terminator, so decoding stops at the first window already known and the bytes before a terminator
+    # are decoded once whichever window reaches them. None when the instructions do not end with the window
+    if window in chains:
+        return chains[window]
+
+    path, rest, tail = [], window, None
+    for insn in md.disasm_lite(window, 0):
+        path.append((rest, insn))
+        rest = rest[insn[1]:]
+
+        if rest in chains:
+            tail = chains[rest]
+            break
+
+    chains[window] = None
+    for prefix, insn in reversed(path):
+        tail = None if tail is None else (insn,) + tail
+        chains[prefix] = tail
+
+    return chains[window]
+
+
+def gadget_text(insns: List[Tuple]) -> str:
+    return ' ; '.join(f"{m}{' ' if op else ''}{op}" for _, _, m, op in insns).replace('  ', ' ')
+
+
+def relative(insn: Tuple) -> bool:
+    # Relative branches are shown with their target address
+    return insn[2].startswith(('j', 'loop', 'call', 'xbegin')) and insn[3][:1].isdigit()
+
+
+def relocate(md, segment, offset: int, address: int, insns: Tuple, cache: Dict[int, Tuple]) -> List[Tuple]:
+    # Relative branches are decoded again at their address, most are the branch ending the gadget which all
+    # the windows of a terminator share
+    result = []
+    for insn in insns:
+        if relative(insn):
+            if offset not in cache:
+                cache[offset] = next(md.disasm_lite(segment[offset:offset + insn[1]].tobytes(), address + offset, 1))
+            insn = cache[offset]
+
+        result.append(insn)
+        offset += insn[1]
+
+    return result
+
+
+def scan(path: str, depth: int = DEPTH, text: bool = False) -> Dict[str, Any]:
+    import capstone
+    import numpy as np
+
+    start = time.monotonic()
+
+    with ElfFile(path) as elf:
+        modes = {EM_386: capstone.CS_MODE_32, EM_X86_64: capstone.CS_MODE_64}
+        if elf.machine not in modes:
+            raise core.ProDeBenchError(f"Unsupported architecture of {path}, only x86 and x86-64 are scanned")
+
+        md = capstone.Cs(capstone.CS_ARCH_X86, modes[elf.machine])
+        patterns = terminators(elf.machine)
+
+        # Windows with the same bytes are the same gadget wherever they are, the instructions of every
+        # window decoded so far are kept to be shared by the longer ones
+        chains = {b'': ()}
+        decoded = {}
+        texts = set()
+        relocated = {}
+
+        for vaddr, offset, size in elf.executable_segments():
+            segment = elf.view(offset, size)
+
+            try:
+                code = np.frombuffer(segment, dtype=np.uint8)
+                windows = candidate_windows(*find_terminators(code, patterns), depth)
+                del code
+
+                for a, b in windows.tolist():
+                    window = segment[a:b].tobytes()
+
+                    if window not in decoded:
+                        insns = decode(md, window, chains)
+                        kind = classify(insns) if insns else None
+
+                        # ROPgadget counts gadgets with different text, which only depends on the address of
+                        # relative branches
+                        if text and kind and not any(relative(i) for i in insns):
+                            texts.add(gadget_text(insns))
+                            insns = None
+
+                        decoded[window] = (kind, insns if text and kind else None)
+
+                    kind, insns = decoded[window]
+
+                    if insns:
+                        texts.add(gadget_text(relocate(md, segment, a, vaddr, insns, relocated)))
+            finally:
+                segment.release()
+                relocated.clear()
+
+    counts = {k: 0 for k in KINDS}
+    for kind, _ in decoded.values():
+        if kind:
+            counts[kind] += 1
+
+    result = {
+        'File': path,
+        **counts,
+        'UniqueGadgetBytes': sum(counts.values()),
+        'Seconds': round(time.monotonic() - start, 3),
+    }
+
+    if text:
+        result['UniqueText'] = len(texts)
+
+    return result
+
+
+def scan_file(path: str, depth: int = DEPTH) -> Dict[str, Any]:
+    # Like the metrics command, files that cannot be scanned get an empty row instead of stopping the others
+    try:
+        return scan(path, depth)
+    except (core.ProDeBenchError, OSError) as e:
+        logging.warning(f"Failed to scan gadgets of {path}: {e}")
+        return {'File': path, **{c: None for c in COLUMNS[1:]}}
+
+
+def scan_files(paths: List[str], jobs: int = None, depth: int = DEPTH) -> List[Dict[str, Any]]:
+    if not paths:
+        return []
+
+    with ProcessPoolExecutor(max_workers=min(jobs or os.cpu_count(), len(paths))) as executor:
+        return list(executor.map(scan_file, paths, [depth] * len(paths)))
+
+
+def validate(path: str) -> Dict[str, Any]:
+    from .metrics import count_unique_gadgets
+
+    start = time.monotonic()
+    try:
+        expected = count_unique_gadgets(path)
+    except Exception as e:
+        logging.warning(f"Failed to count gadgets of {path}: {e}")
+        expected = None
+    expected_time = time.monotonic() - start
+
+    try:
+        result = scan(path, text=True)
+    except (core.ProDeBenchError, OSError) as e:
+        logging.warning(f"Failed to scan gadgets of {path}: {e}")
+        result = {'UniqueText': None, 'Seconds': None}
+
+    return {
+        'File': path,
+        'ROPgadget': expected,
+        'Scanner': result['UniqueText'],
+        'Difference': None if expected is None or result['UniqueText'] is None else result['UniqueText'] - expected,
+        'ROPgadgetSeconds': round(expected_time, 3),
+        'ScannerSeconds': result['Seconds'],
+    }
+
+
+def input_files(paths: List[str]) -> List[str]:
+    from .metrics import binary_files
+
+    # Directories are expanded to the files they contain, like the metrics command
+    return [f for p in paths for f in (binary_files(p) if os.path.isdir(p) else [p])]
+
+
+def write_rows(rows: List[Dict[str, Any]], columns: List[str], path: str):
+    core.make_parent_dirs(os.path.abspath(path))
+
+    with open(path, 'w', newline='') as f:
+        if path.endswith('.csv'):
+            writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows)
+        else:
+            json.dump(rows, f, indent=4)
+
+    logging.info(f"Gadgets saved in {path}")
+
+
+@core.cli.group(
+    name="gadgets",
+    help="Find and classify the code reuse gadgets of x86 binaries"
+)
+def gadgets():
+    pass
+
+
+@gadgets.command(
+    name="scan",
+    help="Count the unique ROP, JOP, COP and syscall gadgets of binaries or of the binaries in directories"
+)
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('-j', '--jobs', type=click.IntRange(min=1), help='Number of binaries to scan in parallel [default: CPUs]')
+@click.option('--depth', default=DEPTH, show_default=True, type=click.IntRange(min=2),
+              help='Bytes searched back from each branch')
+@click.option('-o', '--output', type=click.Path(dir_okay=False), help='Save the results in a .json or .csv file')
+def gadgets_scan(paths: List[str], jobs: int = None, depth: int = DEPTH, output: str = None):
+    results = scan_files(input_files(paths), jobs, depth)
+
+    core.print_table([[r[c] for c in COLUMNS] for r in results], COLUMNS)
+
+    if output:
+        write_rows(results, COLUMNS, output)
+
+
+@gadgets.command(
+    name="validate",
+    help="Compare the unique gadgets found by the scanner with the count of ROPgadget"
+)
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('-j', '--jobs', type=click.IntRange(min=1), help='Number of binaries to check in parallel [default: CPUs]')
+def gadgets_validate(paths: List[str], jobs: int = None):
+    files = input_files(paths)
+
+    with ProcessPoolExecutor(max_workers=min(jobs or os.cpu_count(), max(len(files), 1))) as executor:
+        rows = list(executor.map(validate, files))
+
+    core.print_table([[r[c] for c in VALIDATE_COLUMNS] for r in rows], VALIDATE_COLUMNS)
+
+    mismatches = [r for r in rows if r['Difference']]
+    if mismatches:
+        logging.warning(f"Counts differ for {len(mismatches)} of {len(rows)} binaries")
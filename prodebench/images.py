@@ -0,0 +1,231 @@
+# Copyright (c) 2022 SRI International All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import gzip
+import io
+import json
+import logging
+import os
+import posixpath
+import tarfile
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Iterator, Tuple
+
+import click
+
+from . import core
+from .backend import get_backend
+from .transfer import CHUNK_SIZE, ChunkReader, Progress, archive_stream
+
+BUNDLE_VERSION = 1
+INDEX_NAME = 'pdbench-bundle.json'
+
+# Written again for each image when the bundle is imported
+SKIPPED_NAMES = {'manifest.json', 'repositories', 'index.json', 'oci-layout'}
+
+
+def framework_images() -> List[str]:
+    from .chisel import CHISEL_IMAGE
+    from .occam import OCCAM_IMAGE
+    from .piecewise import PIECEWISE_IMAGE
+    from .razor import RAZOR_IMAGE
+
+    return [OCCAM_IMAGE, PIECEWISE_IMAGE, CHISEL_IMAGE, RAZOR_IMAGE]
+
+
+def add_bytes(tar: tarfile.TarFile, name: str, data: bytes):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    tar.addfile(info, io.BytesIO(data))
+
+
+def export_bundle(names: List[str], path: str, level: int = 6):
+    missing = [n for n in names if not get_backend().images(n)]
+    if missing:
+        raise core.ProDeBenchError(f"Images not found: {', '.join(missing)}")
+
+    # The saved archive has the layers shared by the images once, each of its files is compressed
+    # on its own so that the archive of any image can be put together again without the others
+    entries = []
+    manifest = None
+    part = f"{path}.part"
+    progress = Progress(f"Exporting {len(names)} images")
+    core.make_parent_dirs(os.path.abspath(path))
+
+    saved = ChunkReader(get_backend().save_images(names))
+
+    with tarfile.open(part, 'w') as bundle, tarfile.open(fileobj=saved, mode='r|') as tar:
+        for m in tar:
+            name = posixpath.normpath(m.name)
+            entry = {'name': name, 'mode': m.mode, 'mtime': m.mtime}
+
+            if m.isdir():
+                entry['type'] = 'dir'
+            elif m.issym():
+                entry.update(type='symlink', linkname=m.linkname)
+            elif m.isreg() and name == 'manifest.json':
+                manifest = json.load(tar.extractfile(m))
+                continue
+            elif m.isreg() and name not in SKIPPED_NAMES:
+                entry.update(type='file', size=m.size)
+
+                with tempfile.TemporaryFile() as f:
+                    with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=level, mtime=0) as gz:
+                        src = tar.extractfile(m)
+                        for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                            gz.write(chunk)
+
+                    info = tarfile.TarInfo(f"{name}.gz")
+                    info.size = f.tell()
+                    info.mtime = m.mtime
+                    f.seek(0)
+                    bundle.addfile(info, f)
+
+                progress.update(m.size)
+            else:
+                continue
+
+            entries.append(entry)
+
+        if manifest is None:
+            raise core.ProDeBenchError("Saved images have no manifest.json")
+
+        index = {'version': BUNDLE_VERSION, 'images': names, 'manifest': manifest, 'entries': entries}
+        add_bytes(bundle, INDEX_NAME, json.dumps(index).encode())
+
+    progress.close()
+    os.replace(part, path)
+    logging.info(f"Exported {', '.join(names)} to {path} ({os.path.getsize(path)} bytes)")
+
+
+def read_bundle(path: str) -> Tuple[Dict[str, Any], Dict[str, Tuple[int, int]]]:
+    # Only the headers are read, the offsets are used to read the files of each image in parallel
+    with tarfile.open(path, 'r:') as bundle:
+        offsets = {m.name: (m.offset_data, m.size) for m in bundle}
+
+        if INDEX_NAME not in offsets:
+            raise core.ProDeBenchError(f"{path} is not an images bundle")
+
+        index = json.load(bundle.extractfile(INDEX_NAME))
+
+    if index.get('version') != BUNDLE_VERSION:
+        raise core.ProDeBenchError(f"Unsupported bundle version {index.get('version')} of {path}")
+
+    return index, offsets
+
+
+def image_entries(entries: List[Dict[str, Any]], image: Dict[str, Any]) -> List[Dict[str, Any]]:
+    by_name = {e['name']: e for e in entries}
+    needed = {image['Config'], *image['Layers']}
+
+    # Identical layers are links to the first one
+    pending = list(needed)
+    while pending:
+        e = by_name.get(pending.pop())
+        if e and e['type'] == 'symlink':
+            target = posixpath.normpath(posixpath.join(posixpath.dirname(e['name']), e['linkname']))
+            if target not in needed:
+                needed.add(target)
+                pending.append(target)
+
+    # Layer directories of the legacy format also have the layer metadata
+    layer_dirs = {posixpath.dirname(n) for n in needed if posixpath.dirname(n).count('/') == 0} - {''}
+    needed |= {n for n in by_name if posixpath.dirname(n) in layer_dirs}
+
+    for n in list(needed):
+        while posixpath.dirname(n):
+            n = posixpath.dirname(n)
+            needed.add(n)
+
+    return [e for e in entries if e['name'] in needed]
+
+
+def read_range(f, offset: int, size: int) -> Iterator[bytes]:
+    f.seek(offset)
+
+    while size > 0:
+        chunk = f.read(min(CHUNK_SIZE, size))
+        if not chunk:
+            raise core.ProDeBenchError(f"Unexpected end of {f.name}")
+
+        size -= len(chunk)
+        yield chunk
+
+
+def image_archive(path: str, offsets: Dict[str, Tuple[int, int]], entries: List[Dict[str, Any]],
+                  image: Dict[str, Any]) -> Iterator[bytes]:
+    # The `docker save` archive of one image, decompressed while it is loaded
+
+    def write(tar: tarfile.TarFile):
+        with open(path, 'rb') as bundle:
+            for e in entries:
+                info = tarfile.TarInfo(e['name'])
+                info.mode = e['mode']
+                info.mtime = e['mtime']
+
+                if e['type'] == 'dir':
+                    info.type = tarfile.DIRTYPE
+                    tar.addfile(info)
+                elif e['type'] == 'symlink':
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = e['linkname']
+                    tar.addfile(info)
+                else:
+                    info.size = e['size']
+                    with gzip.GzipFile(fileobj=ChunkReader(read_range(bundle, *offsets[f"{e['name']}.gz"]))) as gz:
+                        tar.addfile(info, gz)
+
+        add_bytes(tar, 'manifest.json', json.dumps([image]).encode())
+
+    return archive_stream(write, f"bundle-{'-'.join(image.get('RepoTags') or [image['Config']])}")
+
+
+def import_bundle(path: str, jobs: int = None):
+    index, offsets = read_bundle(path)
+    images = index['manifest']
+
+    def load(image: Dict[str, Any]) -> List[str]:
+        start = time.monotonic()
+        loaded = get_backend().load_image(image_archive(path, offsets, image_entries(index['entries'], image), image))
+        logging.info(f"Loaded {', '.join(loaded)} in {time.monotonic() - start:.1f} seconds")
+        return loaded
+
+    logging.info(f"Loading {', '.join(index['images'])} from {path}")
+
+    with ThreadPoolExecutor(max_workers=min(jobs or len(images), len(images))) as executor:
+        for _ in executor.map(load, images):
+            pass
+
+
+@core.cli.group(
+    name="images",
+    help="Export and import the framework images, e.g., for nodes without network access"
+)
+def images():
+    pass
+
+
+@images.command(
+    name="export",
+    help="Save the images in one compressed bundle, layers shared by the images are stored once"
+)
+@click.argument('bundle', type=click.Path(dir_okay=False))
+@click.option('-i', '--image', 'names', multiple=True,
+              help='Image to export, repeatable, defaults to the images of all the frameworks')
+@click.option('-l', '--level', default=6, show_default=True, type=click.IntRange(1, 9), help='Compression level')
+def images_export(bundle: str, names: List[str], level: int):
+    export_bundle(list(names) or framework_images(), bundle, level)
+
+
+@images.command(
+    name="import",
+    help="Load the images of a bundle, in parallel"
+)
+@click.argument('bundle', type=click.Path(exists=True, dir_okay=False))
+@click.option('-j', '--jobs', type=click.IntRange(min=1), help='Number of images to load in parallel [default: all]')
+def images_import(bundle: str, jobs: int = None):
+    import_bundle(bundle, jobs)
@@ -0,0 +1,77 @@
+# Copyright (c) 2022 SRI International All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import gzip
+import sys
+import threading
+from typing import BinaryIO, Dict, Iterable, Tuple
+
+CONSOLE_MODES = ['tee', 'prefix', 'quiet']
+
+# Lines of the parallel builds are written one at a time
+console_lock = threading.Lock()
+
+
+class LogPump:
+
+    def __init__(self, log_prefix: str, console: str = 'tee', name: str = '', compress: bool = False) -> None:
+        super().__init__()
+        self.console = console
+        self.name = name
+        self.logs: Dict[str, BinaryIO] = {}
+        self._partial: Dict[str, bytes] = {}
+
+        for stream in ['stdout', 'stderr']:
+            if compress:
+                self.logs[stream] = gzip.open(f"{log_prefix}.{stream}.gz", 'wb', compresslevel=1)
+            else:
+                self.logs[stream] = open(f"{log_prefix}.{stream}", 'wb')
+
+            self._partial[stream] = b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        for stream in self.logs:
+            if self._partial[stream]:
+                self._write_lines(stream, [self._partial[stream] + b'\n'])
+                self._partial[stream] = b''
+
+            self.logs[stream].close()
+
+    def feed(self, stream: str, data: bytes):
+        self.logs[stream].write(data)
+
+        if self.console == 'tee':
+            console = sys.stdout if stream == 'stdout' else sys.stderr
+            console.buffer.write(data)
+            console.flush()
+
+        elif self.console == 'prefix':
+            # Only complete lines go to the console, the rest waits for the next chunk
+            lines = (self._partial[stream] + data).split(b'\n')
+            self._partial[stream] = lines.pop()
+
+            if lines:
+                self._write_lines(stream, [l + b'\n' for l in lines])
+
+    def pump(self, chunks: Iterable[Tuple[str, bytes]]):
+        # Stream name and data pairs, e.g., the demultiplexed output of an exec
+        for stream, data in chunks:
+            self.feed(stream, data)
+
+    def _write_lines(self, stream: str, lines):
+        if self.console != 'prefix':
+            return
+
+        console = sys.stdout if stream == 'stdout' else sys.stderr
+        prefix = f"[{self.name}] ".encode()
+
+        with console_lock:
+            console.buffer.write(b''.join(prefix + l for l in lines))
+            console.flush()
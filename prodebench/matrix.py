@@ -0,0 +1,135 @@
+# Copyright (c) 2022 SRI International All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import csv
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any
+
+import click
+
+from . import core
+from .runner import Adapter, config_file
+
+COLUMNS = ['Framework', 'Program', 'Status', 'DebloatTime', 'StartupTime', 'Binaries', 'OutputSize', 'UniqueGadgets',
+           'ResultDir']
+
+FRAMEWORKS = ['occam', 'piecewise', 'chisel', 'razor']
+
+
+def framework_adapters() -> Dict[str, Adapter]:
+    from .chisel import chisel_adapter
+    from .occam import occam_adapter
+    from .piecewise import piecewise_adapter
+    from .razor import razor_adapter
+
+    return {a.framework: a for a in [occam_adapter, piecewise_adapter, chisel_adapter, razor_adapter]}
+
+
+def run_program(adapter: Adapter, program: str, config: Dict[str, Any]) -> Dict[str, Any]:
+    row = {'Framework': adapter.framework, 'Program': program}
+
+    with config_file(config) as config_path:
+        try:
+            run = adapter.run(config_path, f"{adapter.framework}-{program}", 'prefix')
+        except core.ProDeBenchError as e:
+            logging.error(f"{adapter.framework} failed on {program}: {e.message}")
+            return {**row, 'Status': 'failure'}
+
+    gadgets = [m['UniqueGadgets'] for m in run['Metrics'] if m['UniqueGadgets'] is not None]
+
+    return {
+        **row,
+        'Status': 'success',
+        'DebloatTime': round(run['AdapterTime'], 3),
+        'StartupTime': round(run['StartupTime'], 3),
+        'Binaries': len(run['Metrics']),
+        'OutputSize': sum(m['Size'] for m in run['Metrics']),
+        'UniqueGadgets': sum(gadgets) if gadgets else None,
+        'ResultDir': run['ResultDir'],
+    }
+
+
+def run_matrix(frameworks: List[str], programs: List[str], limits: Dict[str, int],
+               config_path: str = 'config.json') -> List[Dict[str, Any]]:
+    with open(config_path) as f:
+        config = json.load(f)
+
+    adapters = framework_adapters()
+    semaphores = {fw: threading.Semaphore(limits[fw]) for fw in frameworks}
+
+    tasks = []
+    for fw in frameworks:
+        configs = adapters[fw].programs(config)
+
+        for p in programs or configs:
+            tasks.append((adapters[fw], p, configs.get(p)))
+
+    def run(task) -> Dict[str, Any]:
+        adapter, program, program_config = task
+
+        if program_config is None:
+            return {'Framework': adapter.framework, 'Program': program, 'Status': 'not configured'}
+
+        # Frameworks run concurrently, each up to its own limit
+        with semaphores[adapter.framework]:
+            return run_program(adapter, program, program_config)
+
+    logging.info(f"Running {len(tasks)} framework and program combinations")
+
+    with ThreadPoolExecutor(max_workers=max(len(tasks), 1), thread_name_prefix='pdb-matrix') as executor:
+        return list(executor.map(run, tasks))
+
+
+def parse_limits(values: List[str], frameworks: List[str], default: int) -> Dict[str, int]:
+    limits = {fw: default for fw in frameworks}
+
+    for v in values:
+        fw, _, n = v.partition('=')
+        if fw not in limits or not n.isdigit() or int(n) < 1:
+            raise click.BadParameter(f"Expected <framework>=<N> with one of {', '.join(frameworks)}, got {v}")
+
+        limits[fw] = int(n)
+
+    return limits
+
+
+@core.cli.command(
+    name="matrix",
+    help="Run the configurations of several frameworks on the same programs and compare the results"
+)
+@click.option('-f', '--framework', 'frameworks', multiple=True, type=click.Choice(FRAMEWORKS),
+              help='Framework to run, repeatable, defaults to all')
+@click.option('-p', '--program', 'programs', multiple=True,
+              help='Program of the configurations to run, repeatable, defaults to all the configured programs')
+@click.option('-j', '--jobs', default=1, show_default=True, type=click.IntRange(min=1),
+              help='Number of programs run at the same time by each framework')
+@click.option('--limit', 'limits', multiple=True, metavar='FRAMEWORK=N',
+              help='Number of programs run at the same time by a framework, overrides --jobs, repeatable')
+@click.option('-c', '--config', 'config_path', default='config.json', show_default=True,
+              type=click.Path(exists=True, dir_okay=False), help='Configuration file')
+@click.option('-o', '--output', type=click.Path(dir_okay=False), help='Save the comparison in a .csv or .json file')
+def matrix(frameworks: List[str], programs: List[str], jobs: int, limits: List[str], config_path: str,
+           output: str = None):
+    frameworks = list(frameworks) or FRAMEWORKS
+    rows = run_matrix(frameworks, list(programs), parse_limits(limits, frameworks, jobs), config_path)
+    rows.sort(key=lambda r: (r['Program'], r['Framework']))
+
+    core.print_table([[r.get(c, '') for c in COLUMNS] for r in rows], COLUMNS)
+
+    if output:
+        core.make_parent_dirs(os.path.abspath(output))
+
+        with open(output, 'w', newline='') as f:
+            if output.endswith('.csv'):
+                writer = csv.DictWriter(f, fieldnames=COLUMNS, restval='')
+                writer.writeheader()
+                writer.writerows(rows)
+            else:
+                json.dump(rows, f, indent=4)
+
+        logging.info(f"Comparison saved in {output}")
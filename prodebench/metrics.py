@@ -0,0 +1,191 @@
+# Copyright (c) 2022 SRI International All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import contextlib
+import csv
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from importlib.metadata import version
+from typing import List, Dict, Any, Optional
+
+import click
+
+from . import core
+
+COLUMNS = ['File', 'Size', 'UniqueGadgets']
+
+# Bump the suffix whenever the way metrics are computed changes, it invalidates the cached results
+ANALYZER_VERSION = f"ropgadget-{version('ropgadget')}.1"
+
+CACHE_FILE = core.project_relative_location('data/metrics-cache.sqlite')
+CACHE_MAX_ENTRIES = 100000
+
+
+class MetricsCache:
+
+    def __init__(self, path: str = CACHE_FILE, max_entries: int = CACHE_MAX_ENTRIES) -> None:
+        super().__init__()
+        self.max_entries = max_entries
+
+        core.make_parent_dirs(path)
+        self._db = sqlite3.connect(path, timeout=30)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS metrics ('
+            ' digest TEXT NOT NULL, analyzer TEXT NOT NULL, result TEXT NOT NULL, last_used REAL NOT NULL,'
+            ' PRIMARY KEY (digest, analyzer))'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS metrics_last_used ON metrics (last_used)')
+
+        with self._db:
+            self._evict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def get(self, digest: str) -> Optional[Dict[str, Any]]:
+        key = (digest, ANALYZER_VERSION)
+        row = self._db.execute('SELECT result FROM metrics WHERE digest = ? AND analyzer = ?', key).fetchone()
+
+        if not row:
+            return None
+
+        with self._db:
+            self._db.execute('UPDATE metrics SET last_used = ? WHERE digest = ? AND analyzer = ?', (time.time(), *key))
+
+        return json.loads(row[0])
+
+    def put(self, digest: str, result: Dict[str, Any]):
+        with self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO metrics (digest, analyzer, result, last_used) VALUES (?, ?, ?, ?)',
+                (digest, ANALYZER_VERSION, json.dumps(result), time.time())
+            )
+            self._evict()
+
+    def _evict(self):
+        # Least recently used entries are evicted beyond the size limit
+        self._db.execute(
+            'DELETE FROM metrics WHERE rowid IN '
+            '(SELECT rowid FROM metrics ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,)
+        )
+
+
+def file_digest(path: str) -> str:
+    h = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def binary_files(dir_path: str) -> List[str]:
+    paths = [os.path.join(dir_path, f) for f in os.listdir(dir_path)]
+    return sorted(p for p in paths if os.path.isfile(p))
+
+
+def count_unique_gadgets(path: str) -> Optional[int]:
+    # Same search and de-duplication as `ROPgadget --binary <path>`, without a process per binary
+    from ropgadget.args import Args
+    from ropgadget.core import Core
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        rop_core = Core(Args(['--binary', path]).getArgs())
+
+        if rop_core.do_binary(path, silent=True) is False:
+            return None
+
+        rop_core.do_load(None, silent=True)
+        return len(rop_core.gadgets())
+
+
+def analyze_binary(path: str) -> Dict[str, Any]:
+    try:
+        gadgets = count_unique_gadgets(path)
+    except Exception as e:
+        logging.warning(f"Failed to count gadgets of {path}: {e}")
+        gadgets = None
+
+    return {
+        'File': path,
+        'Size': os.path.getsize(path),
+        'UniqueGadgets': gadgets
+    }
+
+
+def analyze_binaries(paths: List[str], jobs: int = None, cache: MetricsCache = None) -> List[Dict[str, Any]]:
+    if not paths:
+        return []
+
+    with ProcessPoolExecutor(max_workers=min(jobs or os.cpu_count(), len(paths))) as executor:
+        if cache is None:
+            return list(executor.map(analyze_binary, paths))
+
+        digests = dict(zip(paths, executor.map(file_digest, paths)))
+        results = {p: cache.get(d) for p, d in digests.items()}
+
+        missing = [p for p, r in results.items() if r is None]
+        logging.info(f"Found {len(paths) - len(missing)} of {len(paths)} binaries in metrics cache")
+
+        for p, r in zip(missing, executor.map(analyze_binary, missing)):
+            results[p] = r
+
+            if r['UniqueGadgets'] is not None:
+                cache.put(digests[p], {c: r[c] for c in COLUMNS if c != 'File'})
+
+    return [{**results[p], 'File': p} for p in paths]
+
+
+def write_results(results: List[Dict[str, Any]], path: str):
+    core.make_parent_dirs(os.path.abspath(path))
+
+    with open(path, 'w', newline='') as f:
+        if path.endswith('.csv'):
+            writer = csv.DictWriter(f, fieldnames=COLUMNS)
+            writer.writeheader()
+            writer.writerows(results)
+        else:
+            json.dump(results, f, indent=4)
+
+    logging.info(f"Metrics saved in {path}")
+
+
+@core.cli.command(
+    name="metrics",
+    help="Measure size and unique ROP gadgets of the binaries in a directory"
+)
+@click.argument('binary_dir', type=click.Path(exists=True, file_okay=False))
+@click.option('-j', '--jobs', type=click.IntRange(min=1), help='Number of binaries to analyze in parallel [default: CPUs]')
+@click.option('-o', '--output', type=click.Path(dir_okay=False),
+              help='Save the results in a .json or .csv file')
+@click.option('--no-cache', is_flag=True, help='Analyze all binaries again instead of using the metrics cache')
+@click.option('--cache-size', default=CACHE_MAX_ENTRIES, show_default=True, type=click.IntRange(min=1),
+              help='Number of results to keep in the metrics cache')
+def metrics(binary_dir: str, jobs: int = None, output: str = None, no_cache: bool = False,
+            cache_size: int = CACHE_MAX_ENTRIES):
+    paths = binary_files(binary_dir)
+
+    if no_cache:
+        results = analyze_binaries(paths, jobs)
+    else:
+        with MetricsCache(max_entries=cache_size) as cache:
+            results = analyze_binaries(paths, jobs, cache)
+
+    core.print_table([[r[c] for c in COLUMNS] for r in results], COLUMNS)
+
+    if output:
+        write_results(results, output)
@@ -4,14 +4,17 @@
 
 from typing import List
 import json
-import os
 import pprint
 
 import click
 
 from . import builder
+from . import cache
 from . import container
 from . import core
+from . import discovery
+from . import runner
+from . import stats
 
 OCCAM_IMAGE = "sricsl/occam:bionic"
 OCCAM_CONTAINER_NAME = "pdb-occam"
@@ -34,6 +37,10 @@ occam_container = container.ContainerWrapper(
     [occam_config.examples_volume]
 )
 
+occam_adapter = runner.Adapter(
+    'occam', 'OCCAM', OCCAM_IMAGE, ['python3', 'adapter_occam.py'], 'Occam', '/occam_bins'
+)
+
 
 @core.cli.group(
     name="occam",
@@ -47,8 +54,11 @@ def occam():
     name="start",
     help="Pull the occam image and start the container"
 )
-def occam_start():
-    occam_container.start()
+@click.option('-r', '--replicas', default=1, show_default=True, type=click.IntRange(min=1),
+              help='Number of containers to start, examples are built across all of them')
+@click.option('--cache', is_flag=True, help='Mount the compiler cache shared by the containers, see the cache command')
+def occam_start(replicas: int = 1, cache: bool = False):
+    occam_container.start(replicas=replicas, cache=cache)
 
 
 @occam.command(
@@ -120,12 +130,10 @@ def occam_reset():
     name="run-config",
     help="Run the configurations for Occam in the config file"
 )
-def occam_run():
-    OUTPUT_DIR=json.load(open('config.json','r+'))['OUTPUT_DIR']
-    OUTPUT_DIR_OCCAM=os.path.join(OUTPUT_DIR,'Occam')
-    OCCAM_CONTAINER_OUTPUT='/occam_bins'
-    ARGS=['./sources/management_script.sh',OCCAM_IMAGE,'config.json','python3','adapter_occam.py',OUTPUT_DIR_OCCAM,OCCAM_CONTAINER_OUTPUT]
-    core.process_check_call(ARGS)
+@stats.repeat_options
+@runner.jobs_option
+def occam_run(**options):
+    runner.run_trials(occam_adapter, **options)
 
 @occam.group(
     name="examples",
@@ -142,27 +150,17 @@ def occam_examples():
     help="Copy defaults examples into examples volume"
 )
 def occam_copy_examples():
-    # passing --interactive to keep the stdin active
-    # in case the command requires some interactions
-    core.process_check_call(
-        [
-            'docker', 'exec',
-            '--interactive', OCCAM_CONTAINER_NAME,
-            'cp', '-rv', f'{occam_config.container_example_path}/.',
-            occam_config.examples_volume.container_dir
-        ]
-    )
-    # The `/.` in the end of source indicates copy contents of
-    # the directory instead of the directory itself
+    occam_container.copy_to_volume(occam_config.container_example_path, occam_config.examples_volume)
 
 
 @occam_examples.command(
     name="list",
     help="List copied examples"
 )
-def occam_build_examples():
-    for d in example_build_directories():
-        print(d)
+@click.option('--refresh', is_flag=True, help='List every directory again instead of using the discovery index')
+@click.option('-l', '--long', is_flag=True, help='Show the size and last build of the examples')
+def occam_build_examples(refresh: bool = False, long: bool = False):
+    discovery.print_examples(examples(refresh), long)
 
 
 def filter_condition(dir_path: str, files: List[str]) -> bool:
@@ -172,14 +170,19 @@ def filter_condition(dir_path: str, files: List[str]) -> bool:
            not ('darwin' in dir_path or 'freebsd' in dir_path)
 
 
-def example_build_directories():
-    example_dir = occam_config.examples_volume.host_dir
-    return core.find_rel_paths(example_dir, filter_condition)
+def examples(refresh: bool = False) -> List[discovery.Example]:
+    return discovery.discover('occam', occam_config.examples_volume.host_dir, filter_condition, refresh)
+
+
+def example_build_directories(refresh: bool = False) -> List[str]:
+    return [e.name for e in examples(refresh)]
 
 
 def build_command(example: str) -> str:
     container_project_path = f"{occam_config.examples_volume.container_dir}/{example}"
-    return f"cd {container_project_path} && make && ./build.sh"
+    return f"cd {container_project_path} && {cache.setup_command()}" \
+           f" && {builder.stage_command('make', 'make')}" \
+           f" && {builder.stage_command('build', './build.sh')}"
 
 
 @occam_examples.command(
@@ -187,16 +190,17 @@ def build_command(example: str) -> str:
     help="Build example(s) in examples volume"
 )
 @click.option('-e', '--example', help='Name of the example, if not specified, build all')
-def occam_build_examples(example: str = None):
-    b = builder.PdbBuilder('occam', OCCAM_CONTAINER_NAME)
+@click.option('--refresh', is_flag=True, help='List every directory again instead of using the discovery index')
+@builder.build_options
+def occam_build_examples(example: str = None, refresh: bool = False, **options):
+    b = builder.PdbBuilder('occam', occam_container.instances(), **options)
 
     try:
         if example:
             b.build(example, build_command(example))
 
         else:
-            for d in example_build_directories():
-                b.build(d, build_command(d))
+            b.build_all(discovery.longest_first(examples(refresh)), build_command)
 
     finally:
         b.close()
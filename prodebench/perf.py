@@ -0,0 +1,199 @@
+# Copyright (c) 2022 SRI International All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import csv
+import json
+import logging
+import os
+import shlex
+import subprocess
+import threading
+import time
+from typing import List, Dict, Any, Tuple
+
+import click
+
+from . import core
+from .stats import mann_whitney
+
+COLUMNS = ['Workload', 'Metric', 'Original', 'Debloated', 'Ratio', 'PValue', 'Significant']
+
+# Lower is better for all of them, ratios above 1 mean the debloated binary does better
+METRICS = ['WallTime', 'UserTime', 'SysTime', 'MaxRssBytes']
+
+BINARIES = ['original', 'debloated']
+
+STARTUP_WORKLOAD = 'startup'
+
+
+def workload_args(workload) -> List[str]:
+    return list(workload) if isinstance(workload, list) else shlex.split(workload)
+
+
+def config_workloads(config_path: str, program: str) -> List[List[str]]:
+    with open(config_path) as f:
+        config = json.load(f)
+
+    workloads = []
+    for section in ['RAZOR', 'OCCAM']:
+        app = config.get(section, {}).get('target-apps', {}).get(program)
+        if not app:
+            continue
+
+        # OCCAM groups the arguments, each group with its static arguments
+        args = app.get('args', [])
+        if isinstance(args, dict):
+            args = [a for group in args.values() for a in group.get('static_args', [])]
+
+        workloads.extend(workload_args(w) for w in args + app.get('train', []))
+
+    if not workloads:
+        raise core.ProDeBenchError(f"No args or train inputs of {program} in the RAZOR or OCCAM sections of {config_path}")
+
+    # Same workload in both sections is run once
+    return [list(w) for w in dict.fromkeys(tuple(w) for w in workloads)]
+
+
+def run_once(cmd: List[str], cwd: str = None, timeout: float = None) -> Dict[str, Any]:
+    start = time.perf_counter_ns()
+    p = subprocess.Popen(cmd, cwd=cwd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    timer = threading.Timer(timeout, p.kill) if timeout else None
+    if timer:
+        timer.start()
+
+    # Resource usage of this child only, unlike getrusage(RUSAGE_CHILDREN)
+    _, status, rusage = os.wait4(p.pid, 0)
+    wall_time_ns = time.perf_counter_ns() - start
+    p.returncode = os.waitstatus_to_exitcode(status)
+
+    if timer:
+        timer.cancel()
+
+    return {
+        'ReturnCode': p.returncode,
+        'WallTime': wall_time_ns / 1e9,
+        'UserTime': rusage.ru_utime,
+        'SysTime': rusage.ru_stime,
+        'MaxRssBytes': rusage.ru_maxrss * 1024,
+    }
+
+
+def measure(binaries: Dict[str, str], workloads: Dict[str, List[str]], repeat: int, warmup: int = 0,
+            cwd: str = None, timeout: float = None) -> Dict[Tuple[str, str], List[Dict[str, Any]]]:
+    samples = {(w, b): [] for w in workloads for b in binaries}
+
+    for i in range(warmup + repeat):
+        # Runs of the binaries alternate, each one goes first every other round, so that drifts
+        # of the host (frequency scaling, caches, other load) affect both the same way
+        order = BINARIES if i % 2 == 0 else BINARIES[::-1]
+
+        for w, args in workloads.items():
+            for b in order:
+                run = run_once([binaries[b]] + args, cwd, timeout)
+
+                if i >= warmup:
+                    samples[(w, b)].append(run)
+
+        if i >= warmup and (i - warmup + 1) % 10 == 0:
+            logging.info(f"Completed {i - warmup + 1} of {repeat} rounds")
+
+    return samples
+
+
+def compare(workloads: List[str], samples: Dict[Tuple[str, str], List[Dict[str, Any]]],
+            alpha: float = 0.05) -> List[Dict[str, Any]]:
+    import numpy as np
+
+    rows = []
+    for w in workloads:
+        original, debloated = samples[(w, 'original')], samples[(w, 'debloated')]
+
+        codes = {b: sorted({r['ReturnCode'] for r in samples[(w, b)]}) for b in BINARIES}
+        if codes['original'] != codes['debloated']:
+            logging.warning(f"Exit codes of {w} differ, original {codes['original']}, debloated {codes['debloated']}")
+
+        # Only the wall time is compared for startup, the other metrics are too small to measure
+        for m in METRICS[:1] if w == STARTUP_WORKLOAD else METRICS:
+            x = np.array([r[m] for r in original], dtype=np.float64)
+            y = np.array([r[m] for r in debloated], dtype=np.float64)
+            mx, my = float(np.median(x)), float(np.median(y))
+            p = mann_whitney(x, y)
+
+            rows.append({
+                'Workload': w,
+                'Metric': m,
+                'Original': mx,
+                'Debloated': my,
+                'Ratio': mx / my if my else None,
+                'PValue': p,
+                'Significant': p < alpha,
+            })
+
+    return rows
+
+
+def write_rows(rows: List[Dict[str, Any]], path: str):
+    core.make_parent_dirs(os.path.abspath(path))
+
+    with open(path, 'w', newline='') as f:
+        if path.endswith('.csv'):
+            writer = csv.DictWriter(f, fieldnames=COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+        else:
+            json.dump(rows, f, indent=4)
+
+    logging.info(f"Comparison saved in {path}")
+
+
+@core.cli.command(
+    name="perf",
+    help="Compare the run time performance of an original binary and its debloated version on the same workloads"
+)
+@click.argument('original', type=click.Path(exists=True, dir_okay=False))
+@click.argument('debloated', type=click.Path(exists=True, dir_okay=False))
+@click.option('-a', '--args', 'workloads', multiple=True,
+              help='Arguments of a workload, e.g., "-l /tmp", repeatable')
+@click.option('-p', '--program', help='Use the args and train inputs of this program in the configuration file')
+@click.option('-c', '--config', 'config_path', default='config.json', show_default=True,
+              type=click.Path(dir_okay=False), help='Configuration file')
+@click.option('--startup-args', default='--version', show_default=True,
+              help='Arguments of the run measuring the startup latency, empty to skip it')
+@click.option('-n', '--repeat', default=30, show_default=True, type=click.IntRange(min=2),
+              help='Number of measured runs of each binary and workload')
+@click.option('--warmup', default=3, show_default=True, type=click.IntRange(min=0),
+              help='Runs of each binary and workload before the measured ones')
+@click.option('--cwd', type=click.Path(exists=True, file_okay=False), help='Working directory of the runs')
+@click.option('--timeout', type=click.FloatRange(min=0), help='Kill runs taking longer (seconds)')
+@click.option('--alpha', default=0.05, show_default=True, type=click.FloatRange(0, 1),
+              help='Significance level of the Mann-Whitney U test')
+@click.option('-o', '--output', type=click.Path(dir_okay=False), help='Save the comparison in a .csv or .json file')
+def perf(original: str, debloated: str, workloads: List[str], program: str, config_path: str, startup_args: str,
+         repeat: int, warmup: int, cwd: str = None, timeout: float = None, alpha: float = 0.05, output: str = None):
+    runs = {w: workload_args(w) for w in workloads}
+
+    if program:
+        runs.update({shlex.join(w): w for w in config_workloads(config_path, program)})
+
+    if startup_args:
+        runs[STARTUP_WORKLOAD] = workload_args(startup_args)
+
+    if not runs:
+        raise core.ProDeBenchError("No workloads, use --args or --program")
+
+    binaries = {'original': os.path.abspath(original), 'debloated': os.path.abspath(debloated)}
+    logging.info(f"Running {len(runs)} workloads {repeat} times with each binary, after {warmup} warm-up runs")
+
+    rows = compare(list(runs), measure(binaries, runs, repeat, warmup, cwd, timeout), alpha)
+
+    for r in rows:
+        if r['Metric'] == 'WallTime' and r['Significant'] and r['Ratio'] is not None and r['Ratio'] < 1:
+            logging.warning(f"Debloated binary is slower on {r['Workload']}, {r['Ratio']:.3f}x the original speed")
+
+    core.print_table([[('yes' if r[c] else '') if c == 'Significant' else r[c] for c in COLUMNS] for r in rows],
+                     COLUMNS)
+
+    if output:
+        write_rows(rows, output)
@@ -5,16 +5,20 @@
 import logging
 import os
 import re
-import shutil
 import json
 import pprint
+from typing import List
 
-import docker
-import requests
+import click
 
 from . import builder
 from . import container
 from . import core
+from . import fetch
+from . import runner
+from . import stats
+from .backend import get_backend
+from .cache import CACHE_VOLUME
 
 PIECEWISE_IMAGE = "piecewise0001bloat/piecewise"
 PIECEWISE_CONTAINER_NAME = "pdb-piecewise"
@@ -28,6 +32,10 @@ piecewise_container = container.ContainerWrapper(
     PIECEWISE_IMAGE, PIECEWISE_CONTAINER_NAME, [examples_volume]
 )
 
+piecewise_adapter = runner.Adapter(
+    'piecewise', 'PWISE', PIECEWISE_IMAGE, ['python3', 'adapter_piecewise.py'], 'Piecewise', '/piecewise_bins'
+)
+
 
 @core.cli.group(
     name="piecewise",
@@ -37,43 +45,92 @@ def piecewise():
     pass
 
 
+PIECEWISE_GOOGLE_FILE_ID = "1-7gYC63Aaps7KGkGgWisEF_96ChxI9jV"
+
+
 @piecewise.command(
     name='load-image',
     help="Download and load piecewise docker image"
 )
-def piecewise_build_image_cmd():
-    piecewise_load_image()
+@click.option('--source', help='Mirror URL or local file of the image tarball, defaults to Google Drive')
+@click.option('--sha256', help='Expected SHA-256 of the tarball, defaults to the one recorded by the first download')
+@click.option('--stream', is_flag=True,
+              help='Load the image while it is downloaded, without saving the tarball, requires --sha256')
+def piecewise_build_image_cmd(source: str = None, sha256: str = None, stream: bool = False):
+    piecewise_load_image(source, sha256, stream)
 
 
-def piecewise_load_image():
-    client = docker.from_env()
-    existing_images = client.images.list(PIECEWISE_IMAGE)
+def piecewise_load_image(source: str = None, sha256: str = None, stream: bool = False):
+    existing_images = get_backend().images(PIECEWISE_IMAGE)
 
     if existing_images:
         logging.info("Piecewise image found; to re-load remove from docker image")
         return
 
+    # A streamed image is loaded before it can be saved and checked, the digest must be known beforehand
+    if stream and not sha256:
+        raise core.ProDeBenchError("Loading the image while it is downloaded requires its --sha256")
+
     piecewise_dir = core.project_relative_location('data/piecewise')
     docker_image_path = os.path.join(piecewise_dir, 'piece-wise.docker')
+    digest_path = f"{docker_image_path}.sha256"
+
+    if not sha256 and os.path.exists(digest_path):
+        with open(digest_path) as f:
+            sha256 = f.read().strip()
+
+    session = None
+    if not source and (stream or not os.path.exists(docker_image_path)):
+        import requests
+
+        # Download cookies of the confirmation page are needed for the file itself
+        session = requests.session()
+        source = google_drive_url(session)
+
+    if stream:
+        logging.info("Loading piecewise image while it is downloaded")
+
+        loaded = []
 
-    if os.path.exists(docker_image_path):
-        logging.info("Piecewise docker image found, to re-download remove it manually")
+        try:
+            get_backend().load_image(fetch.stream(source, sha256, session), loaded)
+        except BaseException:
+            # Images are only kept once verified. The ones reported by the daemon are removed, and the
+            # piecewise image as it did not exist before, in case the daemon loaded it without reporting it
+            remove_images(loaded)
+            remove_images([image.id for image in get_backend().images(PIECEWISE_IMAGE)])
+            raise
     else:
-        download_piecewise_image(docker_image_path)
+        if os.path.exists(docker_image_path):
+            logging.info("Piecewise docker image found, to re-download remove it manually")
+        else:
+            logging.info("Starting piecewise docker image download; might take a while")
+            digest = fetch.fetch(source, docker_image_path, sha256, session)
 
-    logging.info("Loading piecewise image")
+            if not sha256:
+                logging.warning(f"Piecewise docker image not verified, its SHA-256 {digest} is saved in {digest_path}")
+                with open(digest_path, 'w') as f:
+                    f.write(f"{digest}\n")
 
-    core.process_check_call(
-        ['docker', 'load', '--input', docker_image_path],
-        cwd=piecewise_dir
-    )
+            logging.info("Download complete")
 
+        logging.info("Loading piecewise image")
+        with open(docker_image_path, 'rb') as f:
+            loaded = get_backend().load_image(iter(lambda: f.read(fetch.CHUNK_SIZE), b''))
 
-def download_piecewise_image(docker_image_path):
-    requests_session = requests.session()
-    google_file_id = "1-7gYC63Aaps7KGkGgWisEF_96ChxI9jV"
+    logging.info(f"Loaded {', '.join(loaded)}")
 
-    file_url = f"https://docs.google.com/uc?export=download&id={google_file_id}"
+
+def remove_images(names: List[str]):
+    for name in names:
+        try:
+            get_backend().remove_image(name)
+        except core.ProDeBenchError as e:
+            logging.warning(e.message)
+
+
+def google_drive_url(requests_session) -> str:
+    file_url = f"https://docs.google.com/uc?export=download&id={PIECEWISE_GOOGLE_FILE_ID}"
     r = requests_session.get(file_url)
 
     m = re.search(r'confirm=([0-9A-Za-z_]+)', r.text)
@@ -82,23 +139,17 @@ def download_piecewise_image(docker_image_path):
 
     confirm_id = m.group(1)
 
-    url = f"https://docs.google.com/uc?export=download&confirm={confirm_id}&id={google_file_id}"
-
-    logging.info("Starting piecewise docker image download from google drive; might take a while")
-    with requests_session.get(url, stream=True) as r:
-        with open(docker_image_path, 'wb') as f:
-            shutil.copyfileobj(r.raw, f)
-
-    logging.info("Download complete")
+    return f"https://docs.google.com/uc?export=download&confirm={confirm_id}&id={PIECEWISE_GOOGLE_FILE_ID}"
 
 
 @piecewise.command(
     name="start",
     help="Pull the piecewise image and start the container"
 )
-def piecewise_start():
+@click.option('--cache', is_flag=True, help='Mount the compiler cache shared by the containers, see the cache command')
+def piecewise_start(cache: bool = False):
     piecewise_load_image()
-    piecewise_container.start(['--cap-add=SYS_PTRACE', '--security-opt', 'seccomp=unconfined'])
+    piecewise_container.start({'cap_add': ['SYS_PTRACE'], 'security_opt': ['seccomp=unconfined']}, cache=cache)
 
 
 @piecewise.command(
@@ -168,12 +219,10 @@ def piecewise_reset():
     name="run-config",
     help="Run the configurations for Piecewise in the config file"
 )
-def piecewise_run():
-    OUTPUT_DIR=json.load(open('config.json','r+'))['OUTPUT_DIR']
-    OUTPUT_DIR_PIECEWISE=os.path.join(OUTPUT_DIR,'Piecewise')
-    PIECEWISE_CONTAINER_OUTPUT='/piecewise_bins'
-    ARGS=['./sources/management_script.sh',PIECEWISE_IMAGE,'config.json','python3','adapter_piecewise.py',OUTPUT_DIR_PIECEWISE,PIECEWISE_CONTAINER_OUTPUT]
-    core.process_check_call(ARGS)
+@stats.repeat_options
+@runner.jobs_option
+def piecewise_run(**options):
+    runner.run_trials(piecewise_adapter, **options)
 
 @piecewise.group(
     name='examples',
@@ -192,12 +241,20 @@ if [[ ! -d coreutils-8.25 ]]; then
     tar xvf coreutils_8.25.orig.tar.xz
 fi
 
+# Compilations go through the shared cache when the container was started with it,
+# musl-clang is a script calling clang so it is wrapped explicitly
+CC=musl-clang
+if [[ -d CACHE_DIR/bin ]]; then
+    export PATH="CACHE_DIR/bin:$PATH"
+    CC="pdbench-cc musl-clang"
+fi
+
 cd coreutils-8.25/
-./configure --enable-no-install-program=csplit CC=musl-clang CFLAGS='-flto -O0' FORCE_UNSAFE_CONFIGURE=1
+./configure --enable-no-install-program=csplit CC="$CC" CFLAGS='-flto -O0' FORCE_UNSAFE_CONFIGURE=1
 sed -i '152s/.*/#define FUNC_FFLUSH_STDIN -1/' ./lib/config.h
 sed -i '148s/.*/#define FTELLO_BROKEN_AFTER_SWITCHING_FROM_READ_TO_WRITE 0/' ./lib/config.h
-make || exit 1
-'''
+make -j"$(nproc)" || exit 1
+'''.replace('CACHE_DIR', CACHE_VOLUME.container_dir)
 
     core.make_dirs(examples_volume.host_dir)
 
@@ -209,10 +266,20 @@ make || exit 1
     name="build",
     help="Build core utils with piecewise"
 )
-def piecewise_examples_build():
+@builder.build_options
+def piecewise_examples_build(**options):
+    # Core utils are built at once as the `all` example, which has no directory of its own to fingerprint
+    if options['incremental']:
+        raise core.ProDeBenchError("--incremental cannot be used with piecewise, core utils are built at once")
+
     write_build_script()
 
     logging.info("Building core utils in piecewise")
 
-    b = builder.PdbBuilder('piecewise', PIECEWISE_CONTAINER_NAME)
-    b.build('all', f'{examples_volume.container_dir}/build-core-utils.sh')
+    b = builder.PdbBuilder('piecewise', [piecewise_container], **options)
+
+    try:
+        b.build('all', f'{examples_volume.container_dir}/build-core-utils.sh')
+
+    finally:
+        b.close()
@@ -2,17 +2,38 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import csv
+import glob
+import gzip
 import os
-from typing import List
+import re
+import shlex
+import stat
+import time
+from typing import List, Dict, Any, Optional, Tuple
 
 import click
-from . import core, container, builder
+from . import core, container, builder, discovery, runner, stats
 
 import json
 import pprint
 RAZOR_IMAGE = "martianmorning/razor:1.1"
 RAZOR_CONTAINER_NAME = "pdb-razor"
 
+# Stages completed by the previous builds, in the directory of each example
+CHECKPOINT_DIR = '.pdbench-checkpoints'
+
+HEURISTIC_LEVELS = [0, 1, 2, 3, 4]
+
+# Copies of an example debloated with each heuristic level, next to the example
+SWEEP_SUFFIX = '.heuristic-'
+
+SWEEP_COLUMNS = ['Level', 'ReturnCode', 'Binary', 'Size', 'Passed', 'Failed', 'PassRate']
+
+TEST_MARKER = f'{builder.STAGE_MARKER} begin test '
+PASSED_PATTERN = re.compile(r'\b(pass(ed)?|succe(ss|ssful|eded))\b', re.IGNORECASE)
+FAILED_PATTERN = re.compile(r'\b(fail(s|ed|ure)?|crash(ed)?)\b', re.IGNORECASE)
+
 examples_volume = core.Volume(
     core.project_relative_location('data/razor/volumes/examples'),
     '/pdbench/examples'
@@ -23,6 +44,10 @@ razor_container = container.ContainerWrapper(
     RAZOR_IMAGE, RAZOR_CONTAINER_NAME, [examples_volume]
 )
 
+razor_adapter = runner.Adapter(
+    'razor', 'RAZOR', RAZOR_IMAGE, ['python3', 'adapter_razor.py'], 'Razor', '/razor_bins'
+)
+
 
 @core.cli.group(
     name="razor",
@@ -36,8 +61,10 @@ def razor():
     name="start",
     help="Pull the razor image and start the container"
 )
-def razor_start():
-    razor_container.start()
+@click.option('-r', '--replicas', default=1, show_default=True, type=click.IntRange(min=1),
+              help='Number of containers to start, examples are built across all of them')
+def razor_start(replicas: int = 1):
+    razor_container.start(replicas=replicas)
 
 
 @razor.command(
@@ -108,12 +135,10 @@ def razor_reset():
     name="run-config",
     help="Run the configurations for Razor in the config file"
 )
-def razor_run():
-    OUTPUT_DIR=json.load(open('config.json','r+'))['OUTPUT_DIR']
-    OUTPUT_DIR_RAZOR=os.path.join(OUTPUT_DIR,'Razor')
-    RAZOR_CONTAINER_OUTPUT='/razor_bins'
-    ARGS=['./sources/management_script.sh',RAZOR_IMAGE,'config.json','python3','adapter_razor.py',OUTPUT_DIR_RAZOR,RAZOR_CONTAINER_OUTPUT]
-    core.process_check_call(ARGS)
+@stats.repeat_options
+@runner.jobs_option
+def razor_run(**options):
+    runner.run_trials(razor_adapter, **options)
 
 @razor.group(
     name="examples",
@@ -128,67 +153,176 @@ def razor_examples():
     help="Copy defaults examples into examples volume"
 )
 def razor_examples_copy():
-    core.process_check_call(
-        [
-            'docker', 'exec',
-            '--interactive', RAZOR_CONTAINER_NAME,
-            'cp', '-rv', f'{container_example_path}/.',
-            examples_volume.container_dir
-        ]
-    )
+    razor_container.copy_to_volume(container_example_path, examples_volume)
 
 
 @razor_examples.command(
     name="list",
     help="List examples"
 )
-def razor_examples_list():
-    for d in example_build_directories():
-        print(d)
+@click.option('--refresh', is_flag=True, help='List every directory again instead of using the discovery index')
+@click.option('-l', '--long', is_flag=True, help='Show the size and last build of the examples')
+def razor_examples_list(refresh: bool = False, long: bool = False):
+    discovery.print_examples(examples(refresh), long)
 
 
 def filter_condition(dir_path: str, files: List[str]) -> bool:
-    # Skipping lib and original dirs
+    # Skipping lib and original dirs, and the copies of the heuristic sweep
+    if SWEEP_SUFFIX in os.path.basename(dir_path):
+        return False
+
     return 'run_razor.py' in files or 'debloat_simple.py' in files
 
 
-def example_build_directories():
-    example_dir = examples_volume.host_dir
-    return core.find_rel_paths(example_dir, filter_condition)
+def examples(refresh: bool = False) -> List[discovery.Example]:
+    return discovery.discover('razor', examples_volume.host_dir, filter_condition, refresh)
+
+
+def example_build_directories(refresh: bool = False) -> List[str]:
+    return [e.name for e in examples(refresh)]
+
+
+class Stage:
+
+    def __init__(self, name: str, cmd: str) -> None:
+        super().__init__()
+        self.name = name
+        self.cmd = cmd
+
+
+def stages(example: str) -> List[Stage]:
+    if example == 'simple-demo':
+        return [
+            Stage('trace-1', 'python debloat_simple.py -c trace -a 1 -b y'),
+            Stage('trace-0', 'python debloat_simple.py -c trace -a 0 -b y'),
+            Stage('merge_log', 'python debloat_simple.py -c merge_log'),
+            Stage('dump_inst', 'python debloat_simple.py -c dump_inst'),
+            Stage('instrument', 'python debloat_simple.py -c instrument'),
+            Stage('rewrite', 'python debloat_simple.py -c rewrite'),
+        ]
+
+    if example == 'heuristic-demo':
+        return [
+            Stage('trace-2', 'python debloat_simple.py -c trace -a 2 -b 1'),
+            Stage('trace-3', 'python debloat_simple.py -c trace -a 3 -b 1'),
+            Stage('merge_log', 'python debloat_simple.py -c merge_log'),
+            Stage('dump_inst', 'python debloat_simple.py -c dump_inst'),
+            Stage('instrument', 'python debloat_simple.py -c instrument'),
+            Stage('rewrite', 'python debloat_simple.py -c rewrite'),
+        ]
+
+    return [
+        Stage('train', 'python run_razor.py train'),
+        Stage('debloat', 'python run_razor.py debloat'),
+        Stage('test', 'python run_razor.py test'),
+        Stage('extend_debloat-1', 'python run_razor.py extend_debloat 1'),
+    ]
+
+
+def staged_command(example: str, example_stages: List[Stage], until: str = None, resume: bool = False) -> str:
+    cmds = [f'cd {examples_volume.container_dir}/{example}']
+
+    # The checkpoints are always written, a build only resumes from them when asked
+    if not resume:
+        cmds.append(f'rm -rf {CHECKPOINT_DIR}')
+
+    cmds.append(f'mkdir -p {CHECKPOINT_DIR}')
+
+    # A stage saves its command in its checkpoint when it succeeds. A rerun skips the stages checkpointed
+    # with the same command and resumes from the first one that failed, running a stage again
+    # invalidates the checkpoints of all the stages after it
+    for i, stage in enumerate(example_stages):
+        checkpoint = f'{CHECKPOINT_DIR}/{stage.name}'
+        later = ' '.join(f'{CHECKPOINT_DIR}/{s.name}' for s in example_stages[i + 1:])
+        invalidate = f'rm -f {later}; ' if later else ''
+
+        cmds.append(
+            f'if [ "$(cat {checkpoint} 2>/dev/null)" = {shlex.quote(stage.cmd)} ];'
+            f' then echo "Skipping stage {stage.name}, checkpoint found";'
+            f' else {invalidate}{builder.stage_command(stage.name, stage.cmd)}'
+            f' && echo {shlex.quote(stage.cmd)} > {checkpoint}; fi'
+        )
+
+        if stage.name == until:
+            break
+
+    return ' && '.join(cmds)
+
+
+def build_command(example: str, resume: bool = False) -> str:
+    return staged_command(example, stages(example), resume=resume)
 
 
-def build_command(example: str) -> str:
-    # TODO add params for different heuristic of debloating
-    # Might need to remember the current state manually
+def sweep_directory(example: str, level: int) -> str:
+    return f'{example}{SWEEP_SUFFIX}{level}'
 
-    if os.path.join(examples_volume.host_dir, example, 'debloat_simple.py'):
-        if example == 'simple-demo':
 
-            return f'cd {examples_volume.container_dir}/{example}' \
-                    f' && python debloat_simple.py -c trace -a 1 -b y' \
-                    f' && python debloat_simple.py -c trace -a 0 -b y' \
-                    f' && python debloat_simple.py -c merge_log' \
-                    f' && python debloat_simple.py -c dump_inst' \
-                    f' && python debloat_simple.py -c instrument' \
-                    f' && python debloat_simple.py -c rewrite'
+def sweep_command(example: str, level: int) -> str:
+    # Copy next to the example, the scripts of run_razor.py are found relative to it
+    copy = sweep_directory(example, level)
 
-        if example == 'heuristic-demo':
+    copy_stage = builder.stage_command('copy', f'rm -rf {copy} && cp -a {example} {copy}')
+    debloat_stage = builder.stage_command(f'extend_debloat-{level}', f'python run_razor.py extend_debloat {level}')
+    test_stage = builder.stage_command('test', 'python run_razor.py test')
 
-            return f'cd {examples_volume.container_dir}/{example}' \
-                    f' && python debloat_simple.py -c trace -a 2 -b 1' \
-                    f' && python debloat_simple.py -c trace -a 3 -b 1' \
-                    f' && python debloat_simple.py -c merge_log' \
-                    f' && python debloat_simple.py -c dump_inst' \
-                    f' && python debloat_simple.py -c instrument' \
-                    f' && python debloat_simple.py -c rewrite'
+    return f'cd {examples_volume.container_dir} && {copy_stage} && cd {copy} && {debloat_stage} && {test_stage}'
 
-    if os.path.join(examples_volume.host_dir, example, 'run_razor.py'):
 
-        return f'cd {examples_volume.container_dir}/{example}' \
-               ' && python run_razor.py train' \
-               ' && python run_razor.py debloat' \
-               ' && python run_razor.py test' \
-               ' && python run_razor.py extend_debloat 1'
+def test_counts(log_file: str) -> Tuple[int, int]:
+    # Test cases reported as passed or failed in the output of the test stage
+    passed, failed = 0, 0
+
+    with (gzip.open if log_file.endswith('.gz') else open)(log_file, 'rt', errors='replace') as f:
+        lines = iter(f)
+
+        for line in lines:
+            if line.startswith(TEST_MARKER):
+                break
+
+        for line in lines:
+            if FAILED_PATTERN.search(line):
+                failed += 1
+            elif PASSED_PATTERN.search(line):
+                passed += 1
+
+    return passed, failed
+
+
+def debloated_binary(path: str, since: float) -> Tuple[Optional[str], Optional[int]]:
+    # The newest ELF file written by the level, files copied from the example keep their modification time
+    found = None
+
+    for folder, _, files in os.walk(path):
+        for name in files:
+            file_path = os.path.join(folder, name)
+            st = os.lstat(file_path)
+
+            if not stat.S_ISREG(st.st_mode) or st.st_mtime < since or (found and st.st_mtime <= found[1]):
+                continue
+
+            with open(file_path, 'rb') as f:
+                if f.read(4) == b'\x7fELF':
+                    found = (file_path, st.st_mtime, st.st_size)
+
+    return (os.path.relpath(found[0], path), found[2]) if found else (None, None)
+
+
+def sweep_row(level: int, result: Dict[str, Any], since: float) -> Dict[str, Any]:
+    host_dir = os.path.join(examples_volume.host_dir, result['Project'])
+    binary, size = debloated_binary(host_dir, since)
+
+    logs = glob.glob(core.project_relative_location(f"{result['LogPrefix']}.stdout*"))
+    passed, failed = test_counts(logs[0]) if logs else (0, 0)
+
+    return {
+        'Level': level,
+        'ReturnCode': result['ReturnCode'],
+        'Binary': binary,
+        'Size': size,
+        'Passed': passed,
+        'Failed': failed,
+        'PassRate': passed / (passed + failed) if passed + failed else None,
+    }
 
 
 @razor_examples.command(
@@ -196,16 +330,73 @@ def build_command(example: str) -> str:
     help="Build example(s) in examples volume"
 )
 @click.option('-e', '--example', help='Name of the example, if not specified, build all')
-def razor_examples_build(example: str = None):
-    b = builder.PdbBuilder('razor', RAZOR_CONTAINER_NAME)
+@click.option('--refresh', is_flag=True, help='List every directory again instead of using the discovery index')
+@click.option('--resume', is_flag=True, help='Skip the stages completed by the last build, from their checkpoints')
+@builder.build_options
+def razor_examples_build(example: str = None, refresh: bool = False, resume: bool = False, **options):
+    # Resumed trials would only time the stages left
+    if resume and (options['repeat'] > 1 or options['warmup']):
+        raise core.ProDeBenchError("--resume cannot be used with --repeat or --warmup, each trial runs all the stages")
+
+    b = builder.PdbBuilder('razor', razor_container.instances(), **options)
 
     try:
         if example:
-            b.build(example, build_command(example))
+            b.build(example, build_command(example, resume))
 
         else:
-            for d in example_build_directories():
-                b.build(d, build_command(d))
+            b.build_all(discovery.longest_first(examples(refresh)), lambda e: build_command(e, resume))
 
     finally:
         b.close()
+
+
+@razor_examples.command(
+    name="sweep",
+    help="Debloat an example with each heuristic level from the same training traces, and compare the levels"
+)
+@click.option('-e', '--example', required=True, help='Name of the example, a run_razor.py one')
+@click.option('-l', '--level', 'levels', multiple=True, type=click.IntRange(min=0, max=max(HEURISTIC_LEVELS)),
+              help='Heuristic level, repeatable [default: 0 to 4]')
+@click.option('--restart', is_flag=True, help='Train again instead of resuming from the checkpoints')
+@click.option('--no-stats', is_flag=True, help='Do not sample CPU, memory, I/O and PIDs of the container')
+@click.option('--compress-logs', is_flag=True, help='Write gzip compressed build logs')
+@click.option('-o', '--output', type=click.Path(dir_okay=False), help='Save the comparison in a .csv or .json file')
+def razor_examples_sweep(example: str, levels: List[int], restart: bool = False, no_stats: bool = False,
+                         compress_logs: bool = False, output: str = None):
+    levels = sorted(set(levels)) or HEURISTIC_LEVELS
+    example_stages = stages(example)
+
+    if 'train' not in [s.name for s in example_stages]:
+        raise core.ProDeBenchError(f"Heuristic sweep of {example} is not supported, it has no run_razor.py")
+
+    # Copies are made in the examples volume of the first container, the levels run concurrently in it
+    b = builder.PdbBuilder('razor', razor_container.instances()[:1], jobs=len(levels), no_stats=no_stats,
+                           compress_logs=compress_logs)
+
+    try:
+        if b.build(example, staged_command(example, example_stages, until='debloat', resume=not restart)) != 0:
+            raise core.ProDeBenchError(f"Training of {example} failed, no heuristic level was run")
+
+        since = time.time()
+        commands = {sweep_directory(example, level): sweep_command(example, level) for level in levels}
+        b.build_all(list(commands), commands.get)
+
+        results = {r['Project']: r for r in b.results.store.results(b.results.result_ids)}
+        rows = [sweep_row(level, results[sweep_directory(example, level)], since) for level in levels]
+
+    finally:
+        b.close()
+
+    core.print_table([[r[c] for c in SWEEP_COLUMNS] for r in rows], SWEEP_COLUMNS)
+
+    if output:
+        core.make_parent_dirs(os.path.abspath(output))
+
+        with open(output, 'w', newline='') as f:
+            if output.endswith('.csv'):
+                writer = csv.DictWriter(f, fieldnames=SWEEP_COLUMNS)
+                writer.writeheader()
+                writer.writerows(rows)
+            else:
+                json.dump(rows, f, indent=4)
@@ -0,0 +1,238 @@
+# Copyright (c) 2022 SRI International All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import logging
+import os
+import threading
+from typing import Dict, Any, Optional, Iterator, Tuple, Callable
+
+from .backend import get_backend
+
+RESOURCE_COLUMNS = ['CpuTimeNs', 'PeakMemoryBytes', 'BlockReadBytes', 'BlockWriteBytes', 'PeakPids']
+
+SAMPLE_INTERVAL = 0.5
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+
+def cgroup_v2_sample(path: str) -> Dict[str, int]:
+    sample = {'read': 0, 'write': 0}
+
+    with open(os.path.join(path, 'cpu.stat')) as f:
+        for line in f:
+            key, value = line.split()
+            if key == 'usage_usec':
+                sample['cpu_ns'] = int(value) * 1000
+
+    with open(os.path.join(path, 'memory.current')) as f:
+        sample['memory'] = int(f.read())
+
+    with open(os.path.join(path, 'pids.current')) as f:
+        sample['pids'] = int(f.read())
+
+    with open(os.path.join(path, 'io.stat')) as f:
+        for line in f:
+            for field in line.split()[1:]:
+                key, value = field.split('=')
+                if key in ('rbytes', 'wbytes'):
+                    sample['read' if key == 'rbytes' else 'write'] += int(value)
+
+    return sample
+
+
+def cgroup_v1_sample(paths: Dict[str, str]) -> Dict[str, int]:
+    sample = {'read': 0, 'write': 0}
+
+    with open(os.path.join(paths['cpuacct'], 'cpuacct.usage')) as f:
+        sample['cpu_ns'] = int(f.read())
+
+    with open(os.path.join(paths['memory'], 'memory.usage_in_bytes')) as f:
+        sample['memory'] = int(f.read())
+
+    with open(os.path.join(paths['pids'], 'pids.current')) as f:
+        sample['pids'] = int(f.read())
+
+    with open(os.path.join(paths['blkio'], 'blkio.throttle.io_service_bytes')) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 3 and fields[1] in ('Read', 'Write'):
+                sample['read' if fields[1] == 'Read' else 'write'] += int(fields[2])
+
+    return sample
+
+
+def docker_api_sample(stats: Dict[str, Any]) -> Dict[str, int]:
+    io = stats.get('blkio_stats', {}).get('io_service_bytes_recursive') or []
+
+    return {
+        'cpu_ns': stats['cpu_stats']['cpu_usage']['total_usage'],
+        'memory': stats.get('memory_stats', {}).get('usage', 0),
+        'pids': stats.get('pids_stats', {}).get('current', 0),
+        'read': sum(e['value'] for e in io if e['op'].lower() == 'read'),
+        'write': sum(e['value'] for e in io if e['op'].lower() == 'write'),
+    }
+
+
+def find_cgroup(container_id: str) -> Tuple[Optional[Callable[[], Dict[str, int]]], Optional[str]]:
+    # Systemd and cgroupfs drivers, cgroup v2 (unified) and v1 hierarchies, with the file of the memory high-water mark
+    names = [f'system.slice/docker-{container_id}.scope', f'docker/{container_id}']
+
+    for name in names:
+        path = os.path.join(CGROUP_ROOT, name)
+        if os.path.exists(os.path.join(path, 'cpu.stat')):
+            return lambda: cgroup_v2_sample(path), os.path.join(path, 'memory.peak')
+
+    for name in names:
+        paths = {c: os.path.join(CGROUP_ROOT, c, name) for c in ['cpuacct', 'memory', 'pids', 'blkio']}
+        if all(os.path.isdir(p) for p in paths.values()):
+            return lambda: cgroup_v1_sample(paths), os.path.join(paths['memory'], 'memory.max_usage_in_bytes')
+
+    return None, None
+
+
+class PeakMemory:
+    # High-water mark of the memory of the cgroup, spikes between two samples are not missed. The mark is
+    # reset when the command starts if the kernel allows it (memory.peak since Linux 6.12, for reads through
+    # the same file, or memory.max_usage_in_bytes with write access). Otherwise it is only known when the
+    # command raised the mark above its value at the start
+
+    def __init__(self, path: str) -> None:
+        super().__init__()
+        self.path = path
+        self.reset = False
+        self.start_value = 0
+        self._file = None
+
+    def start(self):
+        try:
+            self._file = open(self.path, 'rb+', buffering=0)
+            self._file.write(b'0\n')
+            self.reset = True
+        except OSError:
+            if not self._file and os.path.exists(self.path):
+                self._file = open(self.path, 'rb', buffering=0)
+
+        if self._file:
+            self.start_value = self._read()
+
+    def stop(self) -> Optional[int]:
+        if not self._file:
+            return None
+
+        try:
+            peak = self._read()
+        finally:
+            self._file.close()
+            self._file = None
+
+        return peak if self.reset or peak > self.start_value else None
+
+    def _read(self) -> int:
+        self._file.seek(0)
+        return int(self._file.read())
+
+
+class ResourceSampler:
+    # Samples the resource usage of a container while a command runs in it, the values are
+    # for the whole container, builds sharing a container are not sampled
+
+    def __init__(self, container_name: str, interval: float = SAMPLE_INTERVAL) -> None:
+        super().__init__()
+        self.container_name = container_name
+        self.interval = interval
+        self.first: Optional[Dict[str, int]] = None
+        self.last: Optional[Dict[str, int]] = None
+        self.peak_memory = 0
+        self.peak_pids = 0
+
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f'stats-{container_name}', daemon=True)
+        self._read_cgroup = None
+        self._peak: Optional[PeakMemory] = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def start(self):
+        try:
+            self._read_cgroup, peak_file = find_cgroup(get_backend().container_id(self.container_name))
+        except Exception as e:
+            logging.warning(f"Failed to find cgroup of {self.container_name}: {e}")
+
+        if self._read_cgroup:
+            self._peak = PeakMemory(peak_file)
+            try:
+                self._peak.start()
+            except (OSError, ValueError) as e:
+                logging.warning(f"Failed to read the peak memory of {self.container_name}: {e}")
+                self._peak = None
+
+            self._add(self._read_cgroup())
+
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+        if self._read_cgroup:
+            self._thread.join()
+            self._add(self._read_cgroup())
+
+        if self._peak:
+            try:
+                peak = self._peak.stop()
+            except (OSError, ValueError):
+                peak = None
+
+            with self._lock:
+                self.peak_memory = max(self.peak_memory, peak or 0)
+
+    def results(self) -> Dict[str, Any]:
+        with self._lock:
+            return self._results()
+
+    def _results(self) -> Dict[str, Any]:
+        if not self.first:
+            return {c: '' for c in RESOURCE_COLUMNS}
+
+        return {
+            'CpuTimeNs': self.last['cpu_ns'] - self.first['cpu_ns'],
+            'PeakMemoryBytes': self.peak_memory,
+            'BlockReadBytes': self.last['read'] - self.first['read'],
+            'BlockWriteBytes': self.last['write'] - self.first['write'],
+            'PeakPids': self.peak_pids,
+        }
+
+    def _samples(self) -> Iterator[Dict[str, int]]:
+        if self._read_cgroup:
+            while not self._stopped.wait(self.interval):
+                yield self._read_cgroup()
+
+            return
+
+        # Without access to the cgroup files, the stats API sends a sample about every second
+        for stats in get_backend().stats(self.container_name):
+            if self._stopped.is_set():
+                return
+
+            yield docker_api_sample(stats)
+
+    def _run(self):
+        try:
+            for sample in self._samples():
+                self._add(sample)
+        except Exception as e:
+            logging.warning(f"Stopped sampling resources of {self.container_name}: {e}")
+
+    def _add(self, sample: Dict[str, int]):
+        with self._lock:
+            self.first = self.first or sample
+            self.last = sample
+            self.peak_memory = max(self.peak_memory, sample['memory'])
+            self.peak_pids = max(self.peak_pids, sample['pids'])
@@ -0,0 +1,411 @@
+# Copyright (c) 2022 SRI International All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import csv
+import glob
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+from typing import Dict, Any, List, Iterator, Optional
+
+import click
+
+from . import core
+from .stats import print_summary, CONFIDENCE, CV_THRESHOLD
+
+RESULTS_DB = core.project_relative_location('data/pdbench-results.sqlite')
+
+# Result keys stored in their own columns, any other key goes in the `extra` JSON column
+BASE_COLUMNS = {
+    'Project': 'project',
+    'ReturnCode': 'return_code',
+    'StartTime': 'start_time',
+    'Duration': 'duration',
+    'LogPrefix': 'log_prefix',
+}
+
+GROUP_BY_COLUMNS = ['framework', 'project']
+
+STAGE_COLUMNS = ['stage', 'runs', 'failed', 'mean', 'median', 'max', 'total', 'share']
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS results ('
+    ' id INTEGER PRIMARY KEY, framework TEXT NOT NULL, project TEXT NOT NULL, return_code INTEGER,'
+    ' start_time TEXT NOT NULL, duration REAL, log_prefix TEXT, extra TEXT NOT NULL DEFAULT \'{}\')',
+    'CREATE INDEX IF NOT EXISTS results_framework ON results (framework, start_time)',
+    'CREATE INDEX IF NOT EXISTS results_project ON results (project, start_time)',
+    'CREATE INDEX IF NOT EXISTS results_start_time ON results (start_time)',
+    'CREATE TABLE IF NOT EXISTS stages ('
+    ' result_id INTEGER NOT NULL REFERENCES results (id), seq INTEGER NOT NULL, stage TEXT NOT NULL,'
+    ' return_code INTEGER, duration REAL, PRIMARY KEY (result_id, seq))',
+]
+
+
+def parse_duration(duration: str) -> Optional[float]:
+    # Durations are saved as str(timedelta), e.g., `1 day, 2:03:04` or `0:00:05.250000`
+    m = re.match(r'^(?:(\d+) days?, )?(\d+):(\d+):(\d+(?:\.\d+)?)$', str(duration).strip())
+
+    if not m:
+        return None
+
+    days, hours, minutes, seconds = m.groups()
+    return int(days or 0) * 86400 + int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def format_duration(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return ''
+
+    minutes, s = divmod(int(seconds), 60)
+    hours, m = divmod(minutes, 60)
+    return f"{hours}:{m:02}:{s:02}"
+
+
+class ResultStore:
+
+    def __init__(self, path: str = RESULTS_DB) -> None:
+        super().__init__()
+        core.make_parent_dirs(path)
+
+        # Parallel builds share the connection, other pdbench processes are serialized by sqlite
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+
+        with self._db:
+            for statement in SCHEMA:
+                self._db.execute(statement)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def add(self, framework: str, result: Dict[str, Any], skip_existing: bool = False) -> int:
+        row = {c: result.get(k) for k, c in BASE_COLUMNS.items()}
+        row['duration'] = parse_duration(row['duration']) if isinstance(row['duration'], str) else row['duration']
+
+        # Builds measured with nanosecond precision
+        if result.get('WallTimeNs') not in (None, ''):
+            row['duration'] = int(result['WallTimeNs']) / 1e9
+
+        row['extra'] = json.dumps({k: v for k, v in result.items() if k not in BASE_COLUMNS})
+
+        # Imported rows are skipped if a result of the same build is already saved
+        existing = ' WHERE NOT EXISTS (SELECT 1 FROM results WHERE framework = :framework AND project = :project' \
+                   ' AND start_time = :start_time AND log_prefix IS :log_prefix)' if skip_existing else ''
+
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                'INSERT INTO results (framework, project, return_code, start_time, duration, log_prefix, extra)'
+                ' SELECT :framework, :project, :return_code, :start_time, :duration, :log_prefix, :extra' + existing,
+                {'framework': framework, **row}
+            )
+
+        return cursor.lastrowid
+
+    def add_stages(self, result_id: int, stages: List[Dict[str, Any]]):
+        rows = [
+            (result_id, i, s['Stage'], s['ReturnCode'], None if s['DurationNs'] is None else s['DurationNs'] / 1e9)
+            for i, s in enumerate(stages)
+        ]
+
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT INTO stages (result_id, seq, stage, return_code, duration) VALUES (?, ?, ?, ?, ?)', rows
+            )
+
+    def has_results(self, framework: str) -> bool:
+        row = self._db.execute('SELECT 1 FROM results WHERE framework = ? LIMIT 1', (framework,)).fetchone()
+        return row is not None
+
+    def import_csv(self, framework: str, path: str) -> int:
+        with open(path, newline='') as f:
+            rows = [
+                {**r, 'ReturnCode': int(r['ReturnCode']) if r.get('ReturnCode', '').lstrip('-').isdigit() else None}
+                for r in csv.DictReader(f)
+            ]
+
+        before = self._db.total_changes
+        for r in rows:
+            self.add(framework, {k: v for k, v in r.items() if v != '' or k in BASE_COLUMNS}, skip_existing=True)
+
+        return self._db.total_changes - before
+
+    def latest(self, framework: str) -> Dict[str, Dict[str, Any]]:
+        # Last result of each project, SQLite takes the other columns from the row with the maximum
+        rows = self._db.execute(
+            'SELECT project, return_code, duration, MAX(start_time) AS start_time FROM results'
+            ' WHERE framework = ? GROUP BY project',
+            (framework,)
+        )
+
+        return {r['project']: dict(r) for r in rows}
+
+    def results(self, ids: List[int] = None, last: int = None, **filters) -> Iterator[Dict[str, Any]]:
+        where, params = self._where(ids=ids, **filters)
+
+        # Large histories are streamed from the cursor instead of loaded at once, only the last rows
+        # are selected in SQL and put back in chronological order
+        query = f'SELECT * FROM results {where} ORDER BY start_time, id'
+        if last:
+            query = f'SELECT * FROM (SELECT * FROM results {where} ORDER BY start_time DESC, id DESC LIMIT :last)' \
+                    f' ORDER BY start_time, id'
+
+        for r in self._db.execute(query, {**params, 'last': last}):
+            yield to_result(r)
+
+    def extra_columns(self, **filters) -> List[str]:
+        where, params = self._where(**filters)
+        query = f'SELECT DISTINCT e.key FROM (SELECT extra FROM results {where}) r, json_each(r.extra) e ORDER BY e.key'
+
+        return [r[0] for r in self._db.execute(query, params)]
+
+    def aggregate(self, group_by: List[str], last: int = None, **filters) -> List[Dict[str, Any]]:
+        where, params = self._where(**filters)
+        groups = ', '.join(group_by)
+
+        # Median is the average of the one or two middle durations of each group
+        query = f'''
+            WITH filtered AS (
+                SELECT {groups}, return_code, duration,
+                    ROW_NUMBER() OVER (PARTITION BY {groups} ORDER BY start_time DESC) AS recent
+                FROM results {where}
+            ), selected AS (
+                SELECT * FROM filtered WHERE :last IS NULL OR recent <= :last
+            ), ranked AS (
+                SELECT *,
+                    ROW_NUMBER() OVER (PARTITION BY {groups} ORDER BY duration) AS k,
+                    COUNT(duration) OVER (PARTITION BY {groups}) AS n
+                FROM selected
+            )
+            SELECT {groups},
+                COUNT(*) AS runs,
+                SUM(return_code = 0) AS succeeded,
+                AVG(duration) AS mean,
+                AVG(CASE WHEN duration IS NOT NULL AND k IN ((n + 1) / 2, (n + 2) / 2) THEN duration END) AS median,
+                MIN(duration) AS min,
+                MAX(duration) AS max
+            FROM ranked GROUP BY {groups} ORDER BY {groups}
+        '''
+
+        return [dict(r) for r in self._db.execute(query, {**params, 'last': last})]
+
+    def durations(self, group_by: List[str], last: int = None, **filters) -> Dict[tuple, List[float]]:
+        where, params = self._where(**filters)
+        groups = ', '.join(group_by)
+
+        query = f'''
+            WITH filtered AS (
+                SELECT {groups}, duration,
+                    ROW_NUMBER() OVER (PARTITION BY {groups} ORDER BY start_time DESC) AS recent
+                FROM (SELECT * FROM results {where}) WHERE duration IS NOT NULL
+            )
+            SELECT {groups}, duration FROM filtered WHERE :last IS NULL OR recent <= :last ORDER BY {groups}
+        '''
+
+        samples = {}
+        for r in self._db.execute(query, {**params, 'last': last}):
+            samples.setdefault(tuple(r[g] for g in group_by), []).append(r['duration'])
+
+        return samples
+
+    def stage_profile(self, group_by: List[str], **filters) -> List[Dict[str, Any]]:
+        where, params = self._where(**filters)
+        groups = ', '.join(group_by)
+
+        # Share of the time of all the stages of the group, stages are listed in the order they run
+        query = f'''
+            WITH selected AS (
+                SELECT {groups}, s.seq, s.stage, s.return_code, s.duration
+                FROM stages s JOIN (SELECT * FROM results {where}) r ON r.id = s.result_id
+            ), ranked AS (
+                SELECT *,
+                    ROW_NUMBER() OVER (PARTITION BY {groups}, stage ORDER BY duration) AS k,
+                    COUNT(duration) OVER (PARTITION BY {groups}, stage) AS n
+                FROM selected
+            )
+            SELECT {groups}, stage,
+                COUNT(*) AS runs,
+                SUM(return_code IS NULL OR return_code != 0) AS failed,
+                AVG(duration) AS mean,
+                AVG(CASE WHEN duration IS NOT NULL AND k IN ((n + 1) / 2, (n + 2) / 2) THEN duration END) AS median,
+                MAX(duration) AS max,
+                SUM(duration) AS total,
+                SUM(duration) / SUM(SUM(duration)) OVER (PARTITION BY {groups}) AS share
+            FROM ranked GROUP BY {groups}, stage ORDER BY {groups}, AVG(seq)
+        '''
+
+        return [dict(r) for r in self._db.execute(query, params)]
+
+    @staticmethod
+    def _where(ids: List[int] = None, frameworks: List[str] = None, projects: List[str] = None,
+               since: str = None, until: str = None, status: str = None):
+        conditions = []
+        params = {}
+
+        for column, values in [('id', ids), ('framework', frameworks), ('project', projects)]:
+            if values is None:
+                continue
+
+            names = [f'{column}{i}' for i in range(len(values))]
+            conditions.append(f"{column} IN ({', '.join(':' + n for n in names)})")
+            params.update(zip(names, values))
+
+        if since:
+            conditions.append('start_time >= :since')
+            params['since'] = since
+
+        if until:
+            conditions.append('start_time < :until')
+            params['until'] = until
+
+        if status == 'success':
+            conditions.append('return_code = 0')
+        elif status == 'failure':
+            conditions.append('(return_code IS NULL OR return_code != 0)')
+
+        return ('WHERE ' + ' AND '.join(conditions)) if conditions else '', params
+
+
+def to_result(row: sqlite3.Row) -> Dict[str, Any]:
+    result = {'Framework': row['framework']}
+    result.update({k: row[c] for k, c in BASE_COLUMNS.items()})
+    result['Duration'] = format_duration(row['duration'])
+    result.update(json.loads(row['extra']))
+
+    return result
+
+
+def print_stage_profile(rows: List[Dict[str, Any]], group_by: List[str]):
+    headers = group_by + STAGE_COLUMNS
+    core.print_table([[f"{r[h]:.1%}" if h == 'share' and r[h] is not None else r[h] for h in headers] for r in rows],
+                     headers)
+
+
+def results_csv_files() -> Dict[str, str]:
+    paths = glob.glob(core.project_relative_location('data/*/*-pdbench.csv'))
+    return {os.path.basename(p)[:-len('-pdbench.csv')]: p for p in sorted(paths)}
+
+
+@core.cli.group(
+    name="results",
+    help="Query and export the build results"
+)
+def results():
+    pass
+
+
+@results.command(
+    name="import",
+    help="Import results CSV files, defaults to data/<framework>/<framework>-pdbench.csv"
+)
+@click.argument('csv_files', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option('-f', '--framework', help='Framework of the CSV files, defaults to the file name prefix')
+def results_import(csv_files: List[str], framework: str = None):
+    files = {framework or os.path.basename(p).split('-')[0]: p for p in csv_files} if csv_files \
+        else results_csv_files()
+
+    with ResultStore() as store:
+        for fw, path in files.items():
+            logging.info(f"Imported {store.import_csv(fw, path)} new results of {fw} from {path}")
+
+
+def filter_options(f):
+    f = click.option('--status', type=click.Choice(['success', 'failure']), help='Only successful or failed builds')(f)
+    f = click.option('--until', help='Builds started before this time, e.g., 2022-06-30')(f)
+    f = click.option('--since', help='Builds started at or after this time, e.g., 2022-06-01')(f)
+    f = click.option('-p', '--project', 'projects', multiple=True, help='Project (example) name, repeatable')(f)
+    f = click.option('-f', '--framework', 'frameworks', multiple=True, help='Framework name, repeatable')(f)
+    return f
+
+
+def filters(frameworks, projects, since, until, status) -> Dict[str, Any]:
+    return dict(frameworks=list(frameworks) or None, projects=list(projects) or None,
+                since=since, until=until, status=status)
+
+
+@results.command(
+    name="query",
+    help="List the results or aggregate their durations"
+)
+@filter_options
+@click.option('-g', '--group-by', type=click.Choice(GROUP_BY_COLUMNS), multiple=True,
+              help='Aggregate durations (seconds) per group, repeatable')
+@click.option('-n', '--last', type=click.IntRange(min=1), help='Only the last N results of each group')
+def results_query(frameworks, projects, since, until, status, group_by, last):
+    with ResultStore() as store:
+        if group_by:
+            rows = store.aggregate(list(group_by), last, **filters(frameworks, projects, since, until, status))
+            headers = list(group_by) + ['runs', 'succeeded', 'mean', 'median', 'min', 'max']
+            core.print_table([[r[h] for h in headers] for r in rows], headers)
+            return
+
+        headers = ['Framework'] + list(BASE_COLUMNS)
+        selected = filters(frameworks, projects, since, until, status)
+        rows = [[r[h] for h in headers] for r in store.results(last=last, **selected)]
+        core.print_table(rows, headers)
+
+
+@results.command(
+    name="stats",
+    help="Summarize the durations (seconds) of repeated builds with bootstrap confidence intervals"
+)
+@filter_options
+@click.option('-g', '--group-by', type=click.Choice(GROUP_BY_COLUMNS), multiple=True,
+              help='Group the durations, repeatable [default: framework and project]')
+@click.option('-n', '--last', type=click.IntRange(min=1), help='Only the last N results of each group')
+@click.option('--confidence', default=CONFIDENCE, show_default=True, type=click.FloatRange(0, 1),
+              help='Confidence level of the intervals of the mean')
+@click.option('--cv-threshold', default=CV_THRESHOLD, show_default=True, type=click.FloatRange(min=0),
+              help='Flag groups whose coefficient of variation (std / mean) is above this threshold')
+def results_stats(frameworks, projects, since, until, status, group_by, last, confidence, cv_threshold):
+    group_by = list(group_by) or GROUP_BY_COLUMNS
+
+    # Failed builds usually stop early, they are left out unless asked for
+    with ResultStore() as store:
+        samples = store.durations(group_by, last, **filters(frameworks, projects, since, until, status or 'success'))
+
+    print_summary(samples, group_by, cv_threshold, confidence)
+
+
+@results.command(
+    name="stages",
+    help="Profile the stages of the builds, time (seconds) and failures of each stage"
+)
+@filter_options
+@click.option('-g', '--group-by', type=click.Choice(GROUP_BY_COLUMNS), multiple=True,
+              help='Group the stages, repeatable [default: framework]')
+def results_stages(frameworks, projects, since, until, status, group_by):
+    group_by = list(group_by) or GROUP_BY_COLUMNS[:1]
+
+    with ResultStore() as store:
+        rows = store.stage_profile(group_by, **filters(frameworks, projects, since, until, status))
+
+    print_stage_profile(rows, group_by)
+
+
+@results.command(
+    name="export",
+    help="Export the results as CSV"
+)
+@filter_options
+@click.option('-o', '--output', type=click.Path(dir_okay=False), help='CSV file, defaults to stdout')
+def results_export(frameworks, projects, since, until, status, output=None):
+    selected = filters(frameworks, projects, since, until, status)
+
+    with ResultStore() as store, open(output or sys.stdout.fileno(), 'w', newline='', closefd=bool(output)) as f:
+        writer = csv.DictWriter(f, fieldnames=['Framework'] + list(BASE_COLUMNS) + store.extra_columns(**selected))
+        writer.writeheader()
+        writer.writerows(store.results(**selected))
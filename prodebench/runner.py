@@ -0,0 +1,529 @@
+# Copyright (c) 2022 SRI International All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import List, Dict, Any, Iterator, Optional, Tuple
+
+import click
+
+from . import core
+from .backend import get_backend
+from .logpump import LogPump
+from .results import ResultStore
+from .stats import print_summary, CV_THRESHOLD
+from .transfer import copy_from, copy_to
+
+# Pool containers are labeled with their image, whatever their name is
+POOL_LABEL = 'pdbench.pool'
+POOL_DIR = core.project_relative_location('data/pool')
+
+# Idle containers kept per image, and for how long (seconds) they are kept
+POOL_MAX_IDLE = 4
+POOL_IDLE_TIMEOUT = 24 * 60 * 60
+
+# Key of the program of the default configurations
+DEFAULT_PROGRAM = 'program1'
+
+# Paths added by the runs are removed before a container is reused, except in these
+RESET_KEEP = ['/dev', '/proc', '/sys']
+
+
+class Lease:
+    # Exclusive use of a pool container, also between pdbench processes
+
+    def __init__(self, name: str, lock_file) -> None:
+        super().__init__()
+        self.name = name
+        self.lock_file = lock_file
+
+    @property
+    def idle_time(self) -> float:
+        return time.time() - os.fstat(self.lock_file.fileno()).st_mtime
+
+    def release(self, remove: bool = False):
+        if remove:
+            os.remove(self.lock_file.name)
+        else:
+            os.utime(self.lock_file.name)
+
+        self.lock_file.close()
+
+
+def try_lock(name: str) -> Optional[Lease]:
+    core.make_dirs(POOL_DIR)
+    path = os.path.join(POOL_DIR, f"{name}.lock")
+
+    f = open(path, 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+
+    # The lock file may have been removed with its container in the meantime
+    if not os.path.exists(path) or not os.path.samestat(os.fstat(f.fileno()), os.stat(path)):
+        f.close()
+        return None
+
+    return Lease(name, f)
+
+
+def kept(p: str) -> bool:
+    return any(p == k or p.startswith(k + '/') for k in RESET_KEEP)
+
+
+def added_roots(changes: List[Tuple[str, int]]) -> List[str]:
+    added = {p for p, kind in changes if kind == 1}
+
+    def parent_added(p: str) -> bool:
+        while p != '/':
+            p = os.path.dirname(p)
+            if p in added:
+                return True
+
+        return False
+
+    return sorted(p for p in added if not parent_added(p) and not kept(p))
+
+
+def modified_leaves(changes: List[Tuple[str, int]]) -> List[str]:
+    # Paths of the image modified by the runs. Directories are also reported as modified when files are
+    # added or removed in them, so only the modified paths without changed descendants count
+    ancestors = set()
+    for p, _ in changes:
+        while p != '/':
+            p = os.path.dirname(p)
+            ancestors.add(p)
+
+    return sorted(p for p, kind in changes if kind == 0 and p not in ancestors and not kept(p))
+
+
+def modified_files(name: str, paths: List[str]) -> List[str]:
+    # Directories emptied by a previous reset stay modified, only the other paths are changed files
+    if not paths:
+        return []
+
+    output = b''.join(
+        data for stream, data in get_backend().exec_check(name, ['find'] + paths + ['-maxdepth', '0', '!', '-type', 'd'])
+        if stream == 'stdout'
+    )
+
+    return output.decode(errors='replace').splitlines()
+
+
+def reset_container(name: str):
+    # Added files and directories are removed, a container whose image files were changed is not reused
+    changes = get_backend().diff(name)
+
+    deleted = [p for p, kind in changes if kind == 2 and not kept(p)]
+    changed = deleted or modified_files(name, modified_leaves(changes))
+    if changed:
+        raise core.ProDeBenchError(f"{len(changed)} files of the image were modified or deleted, e.g., {changed[0]}")
+
+    paths = added_roots(changes)
+
+    if paths:
+        for _ in get_backend().exec_check(name, ['rm', '-rf', '--'] + paths):
+            pass
+
+
+def remove_container(name: str):
+    logging.info(f"Removing container {name}")
+
+    try:
+        get_backend().stop(name)
+        get_backend().remove(name)
+    except core.ProDeBenchError as e:
+        logging.warning(e.message)
+
+
+def pool_containers(image: str = None, all: bool = True) -> List:
+    label = f"{POOL_LABEL}={image}" if image else POOL_LABEL
+    return get_backend().containers(all=all, filters={'label': label})
+
+
+def is_stale(c, lease: Lease, idle_timeout: float) -> bool:
+    if c.status != 'running' or lease.idle_time > idle_timeout:
+        return True
+
+    # Containers of an outdated or removed image
+    images = get_backend().images(c.labels[POOL_LABEL])
+    return not images or images[0].id != c.attrs.get('Image')
+
+
+def cleanup_pool(image: str = None, idle_timeout: float = POOL_IDLE_TIMEOUT, everything: bool = False) -> int:
+    # Containers in use by a run are skipped
+    removed = 0
+
+    for c in pool_containers(image):
+        lease = try_lock(c.name)
+        if lease is None:
+            continue
+
+        if everything or is_stale(c, lease, idle_timeout):
+            remove_container(c.name)
+            lease.release(remove=True)
+            removed += 1
+        else:
+            lease.lock_file.close()
+
+    return removed
+
+
+class ContainerPool:
+
+    def __init__(self, image: str, max_idle: int = POOL_MAX_IDLE, idle_timeout: float = POOL_IDLE_TIMEOUT) -> None:
+        super().__init__()
+        self.image = image
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.prefix = 'pdb-pool-' + re.sub(r'[^a-zA-Z0-9_.-]', '-', image)
+
+    @contextlib.contextmanager
+    def container(self) -> Iterator[str]:
+        lease = self.acquire()
+
+        try:
+            yield lease.name
+        except BaseException:
+            # A failed run may leave the container in any state
+            self.discard(lease)
+            raise
+
+        self.release(lease)
+
+    def acquire(self) -> Lease:
+        cleanup_pool(self.image, self.idle_timeout)
+
+        for c in pool_containers(self.image, all=False):
+            lease = try_lock(c.name)
+            if lease:
+                logging.info(f"Reusing warm container {c.name}")
+                return lease
+
+        name = f"{self.prefix}-{uuid.uuid4().hex[:8]}"
+        lease = try_lock(name)
+
+        logging.info(f"Starting container {name} from {self.image}")
+        try:
+            get_backend().run(self.image, name, [], labels={POOL_LABEL: self.image})
+        except BaseException:
+            lease.release(remove=True)
+            raise
+
+        return lease
+
+    def release(self, lease: Lease):
+        try:
+            reset_container(lease.name)
+        except core.ProDeBenchError as e:
+            logging.warning(f"Failed to reset container {lease.name}: {e.message}")
+            self.discard(lease)
+            return
+
+        idle = 0
+        for c in pool_containers(self.image, all=False):
+            other = try_lock(c.name) if c.name != lease.name else None
+            if other:
+                idle += 1
+                other.lock_file.close()
+
+        if idle >= self.max_idle:
+            self.discard(lease)
+            return
+
+        lease.release()
+
+    def discard(self, lease: Lease):
+        remove_container(lease.name)
+        lease.release(remove=True)
+
+
+def evaluate(result_dir: str, dirs: List[str] = None) -> List[Dict[str, Any]]:
+    from . import metrics
+
+    # Binaries of the result directory, or of its program directories
+    files = [f for d in dirs or [result_dir] if os.path.isdir(d) for f in metrics.binary_files(d)]
+
+    with metrics.MetricsCache() as cache:
+        results = metrics.analyze_binaries(files, cache=cache)
+
+    metrics.write_results(results, f"{result_dir}-metrics.json")
+    return results
+
+
+def run_config(framework: str, image: str, invoke_cmd: List[str], output_dir: str, container_output: str,
+               config_path: str = 'config.json', label: str = None, console: str = 'tee', result_dir: str = None,
+               analyze: bool = True) -> Dict[str, Any]:
+    pool = ContainerPool(image)
+    start = time.monotonic()
+    suffix = f"-{label}" if label else ''
+
+    with pool.container() as name:
+        startup = time.monotonic() - start
+        copy_to(name, config_path, '/')
+
+        d = datetime.now()
+        log_name = f"logs/{framework}/run-config-{d:%Y-%m-%d_%H-%M-%S}{suffix}"
+        log_prefix = core.project_relative_location(log_name)
+        core.make_parent_dirs(log_prefix)
+
+        adapter_start = time.monotonic()
+        stream = get_backend().exec_stream(name, invoke_cmd + [os.path.basename(config_path)])
+
+        with LogPump(log_prefix, console, label or framework) as pump:
+            pump.pump(stream)
+
+        adapter = time.monotonic() - adapter_start
+
+        if stream.exit_code != 0:
+            raise core.ProDeBenchError(
+                f"Failed to execute {core.command_list_to_str(invoke_cmd)} in {name}, see {log_prefix}.stderr",
+                stream.exit_code
+            )
+
+        result_dir = result_dir or os.path.join(output_dir, f"result-{d:%b-%d-%H.%M.%S}{suffix}")
+        copy_from(name, container_output, result_dir)
+
+    logging.info(f"Binary copied to {result_dir}/")
+    logging.info(f"Runtime: container startup {startup:.2f} seconds, adapter {adapter:.2f} seconds")
+
+    return {
+        'ResultDir': result_dir,
+        'StartTime': d.strftime('%Y-%m-%d %H:%M:%S'),
+        'LogPrefix': log_name,
+        'StartupTime': startup,
+        'AdapterTime': adapter,
+        'Metrics': evaluate(result_dir) if analyze else None
+    }
+
+
+@contextlib.contextmanager
+def config_file(config: Dict[str, Any]) -> Iterator[str]:
+    # Adapters expect the configuration file to be named config.json
+    with tempfile.TemporaryDirectory() as d:
+        config_path = os.path.join(d, 'config.json')
+        with open(config_path, 'w') as f:
+            json.dump(config, f, indent=4)
+
+        yield config_path
+
+
+def program_name(section: Dict[str, Any]) -> str:
+    # Programs are named by their key in the configuration, Chisel configurations have a single
+    # program whose key is its `name`
+    return section.get('Program', {}).get('name') or DEFAULT_PROGRAM
+
+
+def split_config(config: Dict[str, Any], section: str) -> Dict[str, Dict[str, Any]]:
+    # A configuration for each program of the framework section
+    body = config[section]
+
+    if 'target-apps' in body:
+        return {n: {**config, section: {**body, 'target-apps': {n: app}}} for n, app in body['target-apps'].items()}
+
+    if section == 'PWISE':
+        return {n: {**config, section: {n: program}} for n, program in body.items()}
+
+    return {program_name(body): config}
+
+
+class Adapter:
+    # How the configurations of a framework are run, i.e., its `run-config` command
+
+    def __init__(self, framework: str, section: str, image: str, invoke_cmd: List[str], output_name: str,
+                 container_output: str) -> None:
+        super().__init__()
+        self.framework = framework
+        self.section = section
+        self.image = image
+        self.invoke_cmd = invoke_cmd
+        self.output_name = output_name
+        self.container_output = container_output
+
+    def programs(self, config: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        return split_config(config, self.section)
+
+    def run(self, config_path: str = 'config.json', label: str = None, console: str = 'tee', result_dir: str = None,
+            analyze: bool = True) -> Dict[str, Any]:
+        with open(config_path) as f:
+            output_dir = os.path.join(json.load(f)['OUTPUT_DIR'], self.output_name)
+
+        return run_config(self.framework, self.image, self.invoke_cmd, output_dir, self.container_output,
+                          config_path, label, console, result_dir, analyze)
+
+    def run_programs(self, jobs: int, config_path: str = 'config.json', label: str = None) -> Dict[str, Any]:
+        with open(config_path) as f:
+            config = json.load(f)
+
+        programs = self.programs(config)
+        d = datetime.now()
+        suffix = f"-{label}" if label else ''
+        result_dir = os.path.join(config['OUTPUT_DIR'], self.output_name, f"result-{d:%b-%d-%H.%M.%S}{suffix}")
+
+        # Every program runs in its own pool container, its binaries are copied to its own directory of the
+        # result directory so that files with the same name in several outputs are all kept
+        def run(program: str) -> Dict[str, Any]:
+            with config_file(programs[program]) as path:
+                try:
+                    return self.run(path, f"{label}-{program}" if label else program, 'prefix',
+                                    os.path.join(result_dir, program), False)
+                except core.ProDeBenchError as e:
+                    logging.error(f"{self.framework} failed on {program}: {e.message}")
+                    return {'ReturnCode': e.exit_code, 'StartTime': f"{datetime.now():%Y-%m-%d %H:%M:%S}"}
+
+        logging.info(f"Running {len(programs)} programs of {self.framework} with {jobs} parallel jobs")
+        start = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=max(min(jobs, len(programs)), 1),
+                                thread_name_prefix=f'pdb-{self.framework}') as executor:
+            runs = dict(zip(programs, executor.map(run, programs)))
+
+        wall_time = time.monotonic() - start
+        failed = [p for p, r in runs.items() if 'ResultDir' not in r]
+
+        if len(failed) == len(runs):
+            raise core.ProDeBenchError(f"All the programs of {self.framework} failed")
+
+        logging.info(f"Binaries of {len(runs) - len(failed)} programs copied to {result_dir}/<program>/")
+
+        return {
+            'ResultDir': result_dir,
+            'StartTime': d.strftime('%Y-%m-%d %H:%M:%S'),
+            'LogPrefix': None,
+            'StartupTime': max(r['StartupTime'] for r in runs.values() if 'StartupTime' in r),
+            'AdapterTime': wall_time,
+            'Metrics': evaluate(result_dir, [r['ResultDir'] for r in runs.values() if 'ResultDir' in r]),
+            'Programs': runs,
+        }
+
+
+def jobs_option(f):
+    return click.option('-j', '--jobs', default=1, show_default=True, type=click.IntRange(min=1),
+                        help='Run the programs of the configuration in this many parallel containers')(f)
+
+
+def print_metrics(run: Dict[str, Any]):
+    from .metrics import COLUMNS
+
+    core.print_table([[r[c] for c in COLUMNS] for r in run['Metrics']], COLUMNS)
+
+
+def print_programs(run: Dict[str, Any]):
+    rows = [
+        [p, 'failure' if r.get('ReturnCode') else 'success', r.get('StartupTime'), r.get('AdapterTime')]
+        for p, r in run['Programs'].items()
+    ]
+    core.print_table(rows, ['Program', 'Status', 'StartupTime', 'AdapterTime'])
+
+
+def run_trials(adapter: Adapter, repeat: int = 1, warmup: int = 0, cv_threshold: float = CV_THRESHOLD, jobs: int = 1):
+    def run(label: str = None) -> Dict[str, Any]:
+        return adapter.run_programs(jobs, label=label) if jobs > 1 else adapter.run(label=label)
+
+    for i in range(1, warmup + 1):
+        logging.info(f"Warm-up run {i} of {warmup}")
+        run(f'w{i}')
+
+    # Each trial is recorded with the example builds, the adapter time is its duration.
+    # With parallel jobs, each program is also recorded on its own as run-config/<program>
+    series = uuid.uuid4().hex[:12]
+    runs = []
+
+    with ResultStore() as store:
+        for trial in range(1, repeat + 1):
+            if repeat > 1:
+                logging.info(f"Trial {trial} of {repeat}")
+
+            r = run(f't{trial}' if repeat > 1 else None)
+            runs.append(r)
+            programs = r.get('Programs', {})
+
+            store.add(adapter.framework, {
+                'Project': 'run-config',
+                'ReturnCode': next((p['ReturnCode'] for p in programs.values() if p.get('ReturnCode')), 0),
+                'StartTime': r['StartTime'],
+                'Duration': r['AdapterTime'],
+                'LogPrefix': r['LogPrefix'],
+                'ResultDir': r['ResultDir'],
+                'StartupTime': r['StartupTime'],
+                'Series': series,
+                'Trial': trial,
+            })
+
+            for program, p in programs.items():
+                store.add(adapter.framework, {
+                    'Project': f'run-config/{program}',
+                    'ReturnCode': p.get('ReturnCode', 0),
+                    'StartTime': p['StartTime'],
+                    'Duration': p.get('AdapterTime'),
+                    'LogPrefix': p.get('LogPrefix'),
+                    'ResultDir': p.get('ResultDir'),
+                    'StartupTime': p.get('StartupTime'),
+                    'Series': series,
+                    'Trial': trial,
+                })
+
+    if jobs > 1:
+        print_programs(runs[-1])
+
+    print_metrics(runs[-1])
+
+    if repeat > 1:
+        times = {('startup',): [r['StartupTime'] for r in runs], ('adapter',): [r['AdapterTime'] for r in runs]}
+
+        # Programs that failed in every trial have no times
+        for program in runs[-1].get('Programs', {}):
+            program_times = [r['Programs'][program].get('AdapterTime') for r in runs]
+            if any(t is not None for t in program_times):
+                times[(program,)] = [t for t in program_times if t is not None]
+
+        print_summary(times, ['time'], cv_threshold)
+
+
+@core.cli.group(
+    name="pool",
+    help="Manage the warm containers used by run-config"
+)
+def pool():
+    pass
+
+
+@pool.command(
+    name="status",
+    help="List the pool containers"
+)
+def pool_status():
+    rows = []
+
+    for c in pool_containers():
+        lease = try_lock(c.name)
+        if lease:
+            idle = f"{lease.idle_time:.0f}"
+            lease.lock_file.close()
+
+        rows.append([c.labels[POOL_LABEL], c.name, c.status, 'no' if lease else 'yes', idle if lease else ''])
+
+    core.print_table(rows, ['Image', 'Container', 'Status', 'In use', 'Idle (s)'])
+
+
+@pool.command(
+    name="clear",
+    help="Remove stale pool containers"
+)
+@click.option('-a', '--all', 'everything', is_flag=True, help='Remove all the pool containers that are not in use')
+@click.option('--idle-timeout', default=POOL_IDLE_TIMEOUT, show_default=True, type=click.IntRange(min=0),
+              help='Seconds after which idle containers are stale')
+def pool_clear(everything: bool, idle_timeout: int):
+    logging.info(f"Removed {cleanup_pool(idle_timeout=idle_timeout, everything=everything)} pool containers")
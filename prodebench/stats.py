@@ -0,0 +1,118 @@
+# Copyright (c) 2022 SRI International All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import logging
+import math
+from typing import Dict, Any, List, Sequence, Tuple
+
+import click
+
+from . import core
+
+SUMMARY_COLUMNS = ['runs', 'mean', 'median', 'std', 'p95', 'ci_low', 'ci_high', 'cv', 'unstable']
+
+CONFIDENCE = 0.95
+CV_THRESHOLD = 0.05
+RESAMPLES = 10000
+
+# Resampled trials held in memory at once
+RESAMPLE_BLOCK = 1 << 22
+
+
+def repeat_options(f):
+    f = click.option('--cv-threshold', default=CV_THRESHOLD, show_default=True, type=click.FloatRange(min=0),
+                     help='Flag measurements whose coefficient of variation (std / mean) is above this threshold')(f)
+    f = click.option('--warmup', default=0, show_default=True, type=click.IntRange(min=0),
+                     help='Runs before the measured trials, they are not recorded')(f)
+    f = click.option('--repeat', default=1, show_default=True, type=click.IntRange(min=1),
+                     help='Number of measured trials')(f)
+    return f
+
+
+def bootstrap_means(x, resamples: int, seed: int = 0):
+    import numpy as np
+
+    # Means of the trials resampled with replacement, computed a block of resamples at a time
+    rng = np.random.default_rng(seed)
+    block = max(1, RESAMPLE_BLOCK // x.size)
+
+    return np.concatenate([
+        x[rng.integers(0, x.size, size=(min(block, resamples - i), x.size))].mean(axis=1)
+        for i in range(0, resamples, block)
+    ])
+
+
+def summarize(samples: Sequence[float], confidence: float = CONFIDENCE, cv_threshold: float = CV_THRESHOLD,
+              resamples: int = RESAMPLES) -> Dict[str, Any]:
+    import numpy as np
+
+    x = np.asarray(samples, dtype=np.float64)
+
+    if not x.size:
+        return {'runs': 0}
+
+    mean = x.mean()
+    std = x.std(ddof=1) if x.size > 1 else 0.0
+    p50, p95 = np.percentile(x, [50, 95])
+
+    # Percentile bootstrap interval of the mean, the seed is fixed so that reports can be reproduced
+    alpha = (1 - confidence) / 2
+    ci_low, ci_high = np.quantile(bootstrap_means(x, resamples), [alpha, 1 - alpha]) if x.size > 1 else (mean, mean)
+
+    cv = std / mean if mean else 0.0
+
+    return {
+        'runs': int(x.size),
+        'mean': float(mean),
+        'median': float(p50),
+        'std': float(std),
+        'p95': float(p95),
+        'ci_low': float(ci_low),
+        'ci_high': float(ci_high),
+        'cv': float(cv),
+        'unstable': bool(x.size > 1 and cv > cv_threshold),
+    }
+
+
+def print_summary(groups: Dict[Tuple, Sequence[float]], headers: List[str], cv_threshold: float = CV_THRESHOLD,
+                  confidence: float = CONFIDENCE):
+    rows = []
+
+    for key, samples in groups.items():
+        s = summarize(samples, confidence, cv_threshold)
+
+        if s.get('unstable'):
+            logging.warning(f"Unstable measurements of {' '.join(map(str, key))}: "
+                            f"coefficient of variation {s['cv']:.1%} above {cv_threshold:.1%}")
+
+        rows.append(list(key) + [('yes' if s[c] else '') if c == 'unstable' else s.get(c) for c in SUMMARY_COLUMNS])
+
+    core.print_table(rows, headers + SUMMARY_COLUMNS)
+
+
+def mann_whitney(x: Sequence[float], y: Sequence[float]) -> float:
+    import numpy as np
+
+    # Two-sided p-value of the Mann-Whitney U test, normal approximation with tie correction
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n1, n2 = x.size, y.size
+
+    if not n1 or not n2:
+        return float('nan')
+
+    # Tied values get the average of their ranks
+    values, inverse, counts = np.unique(np.concatenate([x, y]), return_inverse=True, return_counts=True)
+    ranks = (np.cumsum(counts) - (counts - 1) / 2)[inverse]
+
+    n = n1 + n2
+    u = ranks[:n1].sum() - n1 * (n1 + 1) / 2
+    ties = (counts ** 3 - counts).sum()
+    sigma = math.sqrt(n1 * n2 / 12 * ((n + 1) - ties / (n * (n - 1))))
+
+    if sigma == 0:
+        return 1.0
+
+    z = max(abs(u - n1 * n2 / 2) - 0.5, 0) / sigma
+    return float(min(1.0, math.erfc(z / math.sqrt(2))))
@@ -0,0 +1,288 @@
+# Copyright (c) 2022 SRI International All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import hashlib
+import io
+import logging
+import os
+import posixpath
+import queue
+import sys
+import tarfile
+import threading
+import time
+from typing import Dict, Iterator, Tuple, Callable
+
+from . import core
+from .backend import get_backend
+
+CHUNK_SIZE = 1 << 20
+
+# Reject absolute paths, links outside of the destination, etc. where supported
+EXTRACT_OPTIONS = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+
+# Seconds between updates of the progress line
+PROGRESS_INTERVAL = 0.2
+
+
+class ChunkReader(io.RawIOBase):
+    # File-like view of a stream of chunks, e.g., an archive coming from the Docker API
+
+    def __init__(self, chunks: Iterator[bytes]) -> None:
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._buffer = b''
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._buffer:
+            self._buffer = next(self._chunks, None)
+            if self._buffer is None:
+                self._buffer = b''
+                return 0
+
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+class QueueWriter(io.RawIOBase):
+    # Chunks written by the archive thread are consumed by the request sending them
+
+    def __init__(self, chunks: queue.Queue) -> None:
+        super().__init__()
+        self._chunks = chunks
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.put(bytes(b))
+        return len(b)
+
+
+class HashingReader:
+
+    def __init__(self, f) -> None:
+        super().__init__()
+        self._f = f
+        self.hash = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._f.read(size)
+        self.hash.update(data)
+        return data
+
+
+class Progress:
+    # A single line updated in place on a terminal, a summary otherwise
+
+    def __init__(self, label: str, total: int = None) -> None:
+        super().__init__()
+        self.label = label
+        self.total = total
+        self.files = 0
+        self.size = 0
+        self._start = time.monotonic()
+        self._shown = 0.0
+        self._tty = sys.stderr.isatty()
+
+    def update(self, size: int, files: int = 1):
+        self.files += files
+        self.size += size
+
+        now = time.monotonic()
+        if self._tty and now - self._shown >= PROGRESS_INTERVAL:
+            self._shown = now
+            sys.stderr.write(f"\r{self._line()}\033[K")
+            sys.stderr.flush()
+
+    def close(self):
+        if self._tty:
+            sys.stderr.write('\r\033[K')
+            sys.stderr.flush()
+
+        logging.info(f"{self._line()} in {time.monotonic() - self._start:.1f} seconds")
+
+    def _line(self) -> str:
+        from humanfriendly import format_size
+
+        if self.total:
+            return f"{self.label}: {format_size(self.size)} of {format_size(self.total)}"
+
+        return f"{self.label}: {self.files} files, {format_size(self.size)}"
+
+
+def checked_member(m: tarfile.TarInfo, dest: str) -> tarfile.TarInfo:
+    if EXTRACT_OPTIONS:
+        return tarfile.data_filter(m, dest)
+
+    path = os.path.realpath(os.path.join(dest, m.name))
+    if os.path.commonpath([path, os.path.realpath(dest)]) != os.path.realpath(dest):
+        raise core.ProDeBenchError(f"Refusing to extract {m.name} outside of {dest}")
+
+    return m
+
+
+def extract_file(tar: tarfile.TarFile, m: tarfile.TarInfo, path: str) -> str:
+    # Contents are hashed while they are written, without reading the file again
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.islink(path):
+        os.remove(path)
+
+    h = hashlib.sha256()
+    src = tar.extractfile(m)
+
+    with open(path, 'wb') as f:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+            f.write(chunk)
+
+    os.chmod(path, m.mode & 0o777)
+    os.utime(path, (m.mtime, m.mtime))
+    return h.hexdigest()
+
+
+def container_checksums(name: str, parent: str, root: str) -> Dict[str, str]:
+    output = b''.join(
+        data for stream, data in
+        get_backend().exec_check(name, ['find', root, '-type', 'f', '-exec', 'sha256sum', '--', '{}', '+'], workdir=parent)
+        if stream == 'stdout'
+    )
+
+    # Names with a newline or a backslash are escaped by sha256sum, they are not verified
+    checksums = {}
+    for line in output.decode(errors='surrogateescape').splitlines():
+        if line and not line.startswith('\\'):
+            digest, path = line.split('  ', 1)
+            checksums[posixpath.normpath(path)] = digest
+
+    return checksums
+
+
+def verify_checksums(copied: Dict[str, str], expected: Dict[str, str], what: str):
+    different = sorted(p for p in copied.keys() | expected.keys() if copied.get(p) != expected.get(p))
+
+    if different:
+        raise core.ProDeBenchError(
+            f"Checksums of {len(different)} files copied from {what} differ, e.g., {', '.join(different[:5])}"
+        )
+
+    logging.info(f"Verified checksums of {len(copied)} files")
+
+
+def copy_from(name: str, container_path: str, host_dir: str, verify: bool = True) -> Dict[str, str]:
+    # Contents of the container directory are extracted in host_dir as they are received
+    parent, root = posixpath.split(container_path.rstrip('/'))
+    os.makedirs(host_dir, exist_ok=True)
+
+    checksums = {}
+    progress = Progress(f"Copying {name}:{container_path}")
+
+    with tarfile.open(fileobj=ChunkReader(get_backend().get_archive(name, container_path)), mode='r|') as tar:
+        for m in tar:
+            arcname = posixpath.normpath(m.name)
+            m.name = posixpath.relpath(arcname, root)
+            if m.name == '.':
+                continue
+
+            if m.islnk():
+                link = posixpath.normpath(m.linkname)
+                m.linkname = posixpath.relpath(link, root)
+
+            m = checked_member(m, host_dir)
+
+            if m.isreg():
+                checksums[arcname] = extract_file(tar, m, os.path.join(host_dir, m.name))
+                progress.update(m.size)
+            else:
+                # Links of a previous copy are replaced
+                path = os.path.join(host_dir, m.name)
+                if not m.isdir() and os.path.lexists(path) and not os.path.isdir(path):
+                    os.remove(path)
+
+                tar.extract(m, host_dir, **EXTRACT_OPTIONS)
+
+            if m.islnk():
+                checksums[arcname] = checksums.get(link)
+
+    progress.close()
+
+    if verify:
+        verify_checksums(checksums, container_checksums(name, parent or '/', root), f"{name}:{container_path}")
+
+    return checksums
+
+
+def walk(host_path: str, root: str) -> Iterator[Tuple[str, str]]:
+    yield host_path, root
+
+    for folder, dirs, files in os.walk(host_path):
+        dirs.sort()
+        rel = os.path.relpath(folder, host_path)
+
+        for n in dirs + sorted(files):
+            yield os.path.join(folder, n), posixpath.normpath(posixpath.join(root, rel, n))
+
+
+def archive_stream(write: Callable[[tarfile.TarFile], None], name: str = 'archive') -> Iterator[bytes]:
+    # The archive is written by a thread while its chunks are consumed, e.g., sent to the Docker API
+    chunks = queue.Queue(maxsize=16)
+
+    def archive():
+        try:
+            with tarfile.open(fileobj=QueueWriter(chunks), mode='w|', bufsize=CHUNK_SIZE) as tar:
+                write(tar)
+        except BaseException as e:
+            chunks.put(e)
+        else:
+            chunks.put(None)
+
+    thread = threading.Thread(target=archive, name=name, daemon=True)
+    thread.start()
+
+    while True:
+        chunk = chunks.get()
+        if isinstance(chunk, BaseException):
+            raise chunk
+        if chunk is None:
+            break
+        yield chunk
+
+    thread.join()
+
+
+def copy_to(name: str, host_path: str, container_dir: str, verify: bool = True) -> Dict[str, str]:
+    # A file or directory is archived while it is sent, it is created as container_dir/<basename>
+    root = os.path.basename(host_path.rstrip('/'))
+    checksums = {}
+    progress = Progress(f"Copying {host_path} to {name}:{container_dir}")
+
+    def write(tar: tarfile.TarFile):
+        for path, arcname in walk(host_path, root):
+            info = tar.gettarinfo(path, arcname)
+
+            if info.isreg():
+                with open(path, 'rb') as f:
+                    reader = HashingReader(f)
+                    tar.addfile(info, reader)
+                    checksums[arcname] = reader.hash.hexdigest()
+
+                progress.update(info.size)
+            else:
+                tar.addfile(info)
+
+            if info.islnk():
+                checksums[arcname] = checksums.get(info.linkname)
+
+    get_backend().put_archive(name, container_dir, archive_stream(write, f'archive-{name}'))
+    progress.close()
+
+    if verify:
+        verify_checksums(checksums, container_checksums(name, container_dir, root), f"{host_path} to {name}")
+
+    return checksums
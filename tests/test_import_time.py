@@ -0,0 +1,69 @@
+# Copyright (c) 2022 SRI International All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Measured around 20 ms for the import and 60 ms for `pdbench commands`, the budgets leave room for slow hosts
+IMPORT_BUDGET = 0.25
+COMMANDS_BUDGET = 1.0
+
+# Modules only needed when a command talks to Docker or analyzes binaries
+HEAVY_MODULES = ['docker', 'requests', 'numpy', 'capstone']
+
+RUNS = 3
+
+SCRIPT = '''
+import json, sys, time
+
+start = time.perf_counter()
+from prodebench import core
+imported = time.perf_counter() - start
+
+try:
+    core.cli(sys.argv[1:], standalone_mode=False)
+except SystemExit:
+    pass
+
+print(json.dumps({
+    'import': imported,
+    'total': time.perf_counter() - start,
+    'modules': [m for m in HEAVY_MODULES if m in sys.modules],
+}))
+'''
+
+
+def measure(*args: str) -> dict:
+    # A fresh interpreter for each run, the fastest of a few runs is kept
+    runs = []
+
+    for _ in range(RUNS):
+        out = subprocess.run(
+            [sys.executable, '-c', f"HEAVY_MODULES = {HEAVY_MODULES!r}\n{SCRIPT}", *args],
+            cwd=PROJECT_DIR, stdout=subprocess.PIPE, check=True, universal_newlines=True
+        ).stdout
+        runs.append(json.loads(out.splitlines()[-1]))
+
+    return min(runs, key=lambda r: r['total'])
+
+
+def test_import_core():
+    r = measure('--help')
+
+    assert r['modules'] == []
+    assert r['import'] < IMPORT_BUDGET
+
+
+@pytest.mark.parametrize('args', [['commands'], ['occam', '--help'], ['results', '--help']])
+def test_commands(args):
+    r = measure(*args)
+
+    assert r['modules'] == []
+    assert r['total'] < COMMANDS_BUDGET